@@ -0,0 +1,85 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# annotations of games, stored in the .cba file. the .cbh record of a game has the
+# offset of its annotations in the .cba file (0 = no annotations). there, a header
+# of 14 bytes (game number, total length of the annotations of the game including
+# the header at byte 10) is followed by the annotations, each with a header of
+# 6 bytes:
+#   - position (24 bit): number of moves up to the annotated one, in the order in
+#     which they are encoded in the .cbg file (including moves of variations).
+#     0 is the start of the game
+#   - type (8 bit), see below
+#   - length (16 bit), including the header
+# only text and symbols are converted, other annotations (e.g. colored squares
+# and arrows) are skipped
+
+import struct
+
+GAME_HEADER_SIZE = 14
+ANNOTATION_HEADER_SIZE = 6
+
+TEXT_AFTER_MOVE = 0x02
+SYMBOLS = 0x03
+TEXT_BEFORE_MOVE = 0x82
+
+UINT32 = struct.Struct(">I")
+UINT16 = struct.Struct(">H")
+
+
+def get_length(cba_file, offset):
+    """
+    :param cba_file: the .cba file (or a part of it)
+    :param offset: offset of the annotations of a game
+    :return: length of the annotations of the game, including their header
+    """
+    return UINT32.unpack_from(cba_file, offset + 10)[0]
+
+
+def decode_text(data):
+    """
+    :param data: data of a text annotation: 2 bytes (the language of the text), followed by the text
+    :return: the text, on a single line
+    """
+    # texts are stored in the windows code page, not in UTF-8
+    text = bytes(data[2:]).decode("cp1252", errors="replace").split("\x00")[0]
+    # line breaks are stored as \r\n
+    return " ".join(text.split())
+
+
+def parse_annotations(block):
+    """
+    :param block: the annotations of a game, including their header (see get_length)
+    :return: dict of position to a triple of (text in front of the move or None, text after the move
+             or None, list of NAGs), see game.visit
+    """
+    annotations = {}
+    if len(block) < GAME_HEADER_SIZE:
+        raise ValueError("annotations shorter than their header")
+    pos = GAME_HEADER_SIZE
+    while pos + ANNOTATION_HEADER_SIZE <= len(block):
+        position = UINT32.unpack_from(block, pos)[0] >> 8
+        kind = block[pos + 3]
+        length = UINT16.unpack_from(block, pos + 4)[0]
+        if length < ANNOTATION_HEADER_SIZE or pos + length > len(block):
+            raise ValueError("invalid length " + str(length) + " of annotation at byte " + str(pos))
+        data = block[pos + ANNOTATION_HEADER_SIZE:pos + length]
+        pos += length
+        if kind == TEXT_BEFORE_MOVE or kind == TEXT_AFTER_MOVE:
+            text = decode_text(data)
+            if text == "":
+                continue
+            before, after, nags = annotations.get(position, (None, None, []))
+            if kind == TEXT_BEFORE_MOVE:
+                before = text if before is None else before + " " + text
+            else:
+                after = text if after is None else after + " " + text
+            annotations[position] = (before, after, nags)
+        elif kind == SYMBOLS:
+            # the symbol of the move, of the position, and a prefix (e.g. "with the idea"),
+            # all numbered like NAGs. 0 = none
+            symbols = [symbol for symbol in data[:3] if symbol != 0]
+            if len(symbols) > 0:
+                annotations.setdefault(position, (None, None, []))[2].extend(symbols)
+    return annotations
@@ -0,0 +1,304 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# conversion of one or many databases with a pool of worker processes.
+# the games of all databases are split into chunks of records which are
+# scheduled through one long-lived pool (largest databases first), so
+# interpreter startup, imports and JIT warm-up are paid only once per worker.
+# the parent process writes the output of each database in record order.
+#
+# if a worker process dies (e.g. it is killed because a corrupted game made it
+# run out of memory), the pool is restarted. the chunks that were being converted
+# are then run again one at a time, and a chunk that crashes again is split into
+# single records, so that only the record that crashes is quarantined (skipped).
+#
+# the output of a chunk is handed back to the parent process by a transport (see
+# transport.py): through the pipe of the pool, or through shared memory or a
+# temporary file, so that only a small descriptor is sent through the pipe.
+
+import collections
+import concurrent.futures
+import io
+import json
+import os
+import time
+import database
+import transport as transports
+
+CHUNK_SIZE = 250
+MAX_OPEN_DATABASES = 4
+
+# databases opened by a worker process, keyed by filename, least recently used first
+worker_dbs = collections.OrderedDict()
+
+
+def worker_database(filename, max_variation_depth, limits, io_strategy="mmap", opening_cache_size=0,
+                    annotations=True):
+    db = worker_dbs.get(filename)
+    if db is None:
+        db = database.Database(filename, max_variation_depth=max_variation_depth, limits=limits,
+                               io_strategy=io_strategy, opening_cache_size=opening_cache_size,
+                               annotations=annotations)
+        worker_dbs[filename] = db
+        if len(worker_dbs) > MAX_OPEN_DATABASES:
+            worker_dbs.popitem(last=False)[1].close()
+    worker_dbs.move_to_end(filename)
+    return db
+
+
+def convert_chunk(filename, first, last, max_variation_depth, limits, io_strategy="mmap", opening_cache_size=0,
+                  annotations=True, descriptor=None):
+    """
+    convert a range of records in a worker process
+    :param filename: filename of the .cbh file
+    :param first: first record number
+    :param last: record number after the last one
+    :param max_variation_depth: see game.decode
+    :param limits: game.Limits for decoding a single game
+    :param io_strategy: see database.IO_STRATEGIES
+    :param opening_cache_size: number of positions in the opening cache of the worker process
+    :param annotations: convert the annotations of the .cba file
+    :param descriptor: how the PGN is sent to the parent process, see transport.send
+    :return: tuple of (PGN of the converted games as utf-8 encoded bytes, or where to find them (see
+             transport.send), number of games, list of errors, number of .cbg bytes consumed)
+    """
+    db = worker_database(filename, max_variation_depth, limits, io_strategy, opening_cache_size, annotations)
+    cbg_bytes_read = db.cbg_bytes_read
+    db.prefetch(range(first, last))
+    out = io.StringIO()
+    errors = []
+    nr_games = 0
+    for i in range(first, last):
+        # an unexpected error only skips the record, not the whole chunk
+        try:
+            pgn, errs = db.render_game(i)
+        except Exception as e:
+            errors.append((i, None, "skipped: " + type(e).__name__ + ": " + str(e)))
+            continue
+        errors.extend(errs)
+        if pgn is not None:
+            out.write(pgn)
+            nr_games += 1
+    return transports.send(out.getvalue().encode("utf-8"), descriptor), nr_games, errors, db.cbg_bytes_read - cbg_bytes_read
+
+
+def find_databases(path, output_dir):
+    """
+    find the databases to convert
+    :param path: a directory (all .cbh files in it and its subdirectories are converted), or a
+                 manifest file with one database per line, optionally followed by the output filename
+                 (empty lines and lines starting with # are ignored)
+    :param output_dir: directory for outputs without an explicit filename
+    :return: list of (filename of .cbh, filename of output .pgn)
+    """
+    inputs = []
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".cbh"):
+                    inputs.append((os.path.join(root, name), None))
+    else:
+        with open(path, encoding="utf-8") as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line == "" or line.startswith("#"):
+                    continue
+                parts = line.split(None, 1)
+                inputs.append((parts[0], parts[1] if len(parts) > 1 else None))
+    databases = []
+    for filename_cbh, filename_out in inputs:
+        if filename_out is None:
+            name = os.path.basename(filename_cbh)
+            if name.lower().endswith(".cbh"):
+                name = name[:-4]
+            filename_out = os.path.join(output_dir, name + ".pgn")
+        databases.append((filename_cbh, filename_out))
+    return databases
+
+
+class Job:
+    """
+    conversion of one database, or of a range of its records
+    """
+
+    def __init__(self, filename_cbh, filename_out, first=1, last=None):
+        """
+        :param filename_cbh: filename of the .cbh file
+        :param filename_out: filename of the output .pgn
+        :param first: first record number
+        :param last: record number after the last one (default: all records)
+        """
+        if filename_cbh.endswith(".cbh"):
+            filename_cbh = filename_cbh[:-4]
+        self.filename_cbh = filename_cbh
+        self.filename_out = filename_out
+        self.nr_records = os.path.getsize(filename_cbh + ".cbh") // database.CBH_RECORD_SIZE
+        self.cbg_size = os.path.getsize(filename_cbh + ".cbg")
+        self.first = max(first, 1)
+        self.last = self.nr_records if last is None else min(last, self.nr_records)
+        self.nr_games = 0
+        self.errors = []
+        self.bytes_written = 0
+        self.started = None
+        self.seconds = None
+        self.out = None
+        self.records_done = 0
+
+    def chunks(self):
+        for first in range(self.first, self.last, CHUNK_SIZE):
+            yield first, min(first + CHUNK_SIZE, self.last)
+
+    def summary(self):
+        return {
+            "input": self.filename_cbh + ".cbh",
+            "output": self.filename_out,
+            "records": max(self.last - self.first, 0),
+            "games": self.nr_games,
+            "errors": len(self.errors),
+            "cbg_bytes": self.cbg_size,
+            "pgn_bytes": self.bytes_written,
+            "seconds": self.seconds,
+            "error_list": [list(err) for err in self.errors]
+        }
+
+
+def run_batch(jobs, workers=None, max_variation_depth=None, limits=None, progress=None, io_strategy="mmap",
+              opening_cache_size=0, annotations=True, transport="pipe"):
+    """
+    convert databases with one pool of worker processes
+    :param jobs: list of Job
+    :param workers: number of worker processes (default: number of CPUs)
+    :param max_variation_depth: see game.decode
+    :param limits: game.Limits for decoding a single game
+    :param progress: progress.Progress that is updated after every chunk, or None
+    :param io_strategy: see database.IO_STRATEGIES
+    :param opening_cache_size: number of positions in the opening cache of each worker process
+    :param annotations: convert the annotations of the .cba files
+    :param transport: how the workers hand the output back, one of transport.TRANSPORTS
+    :return: number of times the pool was restarted after a worker process died
+    """
+    # largest databases first, so that the pool does not end with one large database.
+    # a task is (job, first record, record after the last one, whether it has to run alone)
+    ordered = sorted(jobs, key=lambda job: job.cbg_size, reverse=True)
+    pending = collections.deque((job, first, last, False) for job in ordered for (first, last) in job.chunks())
+    for job in ordered:
+        if job.last <= job.first:
+            open(job.filename_out, "wb").close()
+            job.seconds = 0.0
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # keep a bounded number of chunks in flight. results are consumed in
+    # submission order, so every output is written in record order
+    max_in_flight = 4 * workers
+    in_flight = collections.deque()
+    restarts = 0
+    # totals for the progress reports
+    records_done = 0
+    nr_games = 0
+    nr_errors = 0
+    cbg_bytes = 0
+    bytes_written = 0
+    # created before the pool, so that the worker processes inherit it
+    transport = transports.create(transport, max_in_flight,
+                                  os.path.dirname(os.path.abspath(ordered[0].filename_out)) if ordered else ".")
+    pool = None
+    try:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        while len(pending) > 0 or len(in_flight) > 0:
+            while len(pending) > 0 and len(in_flight) < max_in_flight:
+                job, first, last, alone = pending[0]
+                if alone and len(in_flight) > 0:
+                    break
+                pending.popleft()
+                if job.started is None:
+                    job.started = time.time()
+                in_flight.append((job, first, last, alone,
+                                  pool.submit(convert_chunk, job.filename_cbh, first, last, max_variation_depth,
+                                              limits, io_strategy, opening_cache_size, annotations,
+                                              transport.task())))
+                if alone:
+                    break
+            job, first, last, alone, future = in_flight.popleft()
+            try:
+                data, chunk_games, errors, chunk_cbg_bytes = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died, and with it all chunks in flight. restart the pool and
+                # run them again, one at a time, to find out which one crashes
+                pool.shutdown(wait=True)
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+                restarts += 1
+                retry = [(job, first, last)] + [(j, f, l) for (j, f, l, _, _) in in_flight]
+                in_flight.clear()
+                if not alone:
+                    pending.extendleft(reversed([(j, f, l, True) for (j, f, l) in retry]))
+                    continue
+                if last - first > 1:
+                    # the chunk crashed on its own, now find the record
+                    pending.extendleft(reversed([(job, i, i + 1, True) for i in range(first, last)]))
+                    continue
+                data, chunk_games, chunk_cbg_bytes = b"", 0, 0
+                errors = [(first, None, "quarantined: worker process crashed")]
+            if job.out is None:
+                job.out = open(job.filename_out, "wb", buffering=0)
+            length = transport.write(data, job.out.fileno())
+            job.bytes_written += length
+            job.nr_games += chunk_games
+            job.errors.extend(errors)
+            job.records_done += last - first
+            if job.records_done == job.last - job.first:
+                job.out.close()
+                job.seconds = time.time() - job.started
+            if progress is not None:
+                records_done += last - first
+                nr_games += chunk_games
+                nr_errors += len(errors)
+                cbg_bytes += chunk_cbg_bytes
+                bytes_written += length
+                progress.update(records_done, nr_games, nr_errors, cbg_bytes, bytes_written)
+    finally:
+        if progress is not None:
+            progress.close()
+        if pool is not None:
+            pool.shutdown(wait=True)
+        transport.close()
+    return restarts
+
+
+def print_summary(jobs, elapsed, restarts=0):
+    total_games = 0
+    total_errors = 0
+    total_bytes = 0
+    for job in jobs:
+        print(job.filename_cbh + ".cbh -> " + job.filename_out + ": " + str(job.nr_games) + " games, " +
+              str(len(job.errors)) + " errors, " + "{:.1f}s".format(job.seconds))
+        total_games += job.nr_games
+        total_errors += len(job.errors)
+        total_bytes += job.cbg_size
+    print("")
+    print("databases....: " + str(len(jobs)))
+    print("games........: " + str(total_games))
+    print("errors.......: " + str(total_errors))
+    print("input........: {:.1f} MB".format(total_bytes / 1e6))
+    print("restarts.....: " + str(restarts))
+    print("time.........: {:.1f}s".format(elapsed))
+    if elapsed > 0:
+        print("games/s......: {:.0f}".format(total_games / elapsed))
+
+
+def write_report(jobs, elapsed, filename, restarts=0):
+    report = {
+        "databases": [job.summary() for job in jobs],
+        "total": {
+            "databases": len(jobs),
+            "games": sum(job.nr_games for job in jobs),
+            "errors": sum(len(job.errors) for job in jobs),
+            "cbg_bytes": sum(job.cbg_size for job in jobs),
+            "pgn_bytes": sum(job.bytes_written for job in jobs),
+            "restarts": restarts,
+            "seconds": elapsed
+        }
+    }
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
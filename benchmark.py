@@ -0,0 +1,507 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# micro benchmarks for the performance critical parts of the converter
+# usage: python3 benchmark.py <benchmark> [options]
+
+import argparse
+import collections
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import zlib
+import chess.pgn
+import batch
+import database
+import game
+import header
+import transport
+import writer
+
+
+def decrease_piece_nr_full_scan(piece_list, cb_position, target_piece_type, target_nr):
+    """
+    reference implementation of game.decrease_piece_nr that
+    renumbers the pieces by scanning all 64 squares
+    """
+    for nr in range(target_nr, 7):
+        piece_list[target_piece_type][nr] = piece_list[target_piece_type][nr + 1]
+    piece_list[target_piece_type][7] = None
+    for x in range(0, 8):
+        for y in range(0, 8):
+            p, t = cb_position[x][y]
+            if p == target_piece_type and t > target_nr:
+                cb_position[x][y] = (p, t - 1)
+
+
+def capture_heavy_position():
+    """
+    initial position plus three additional queens for each side on the empty squares,
+    i.e. a position with many pieces of one kind that need to be renumbered on captures
+    :return: tuple of (cb_position, piece_list)
+    """
+    cb_position, piece_list = game.initial_position()
+    for nr, x in enumerate([0, 3, 6]):
+        cb_position[x][2] = (game.W_QUEEN, nr + 1)
+        piece_list[game.W_QUEEN][nr + 1] = (x, 2)
+        cb_position[x][5] = (game.B_QUEEN, nr + 1)
+        piece_list[game.B_QUEEN][nr + 1] = (x, 5)
+    return cb_position, piece_list
+
+
+def capture_all(decrease_piece_nr):
+    """
+    captures all pieces except kings and pawns, always the first one of a kind
+    :param decrease_piece_nr: the renumbering function to use
+    :return: number of captures
+    """
+    cb_position, piece_list = capture_heavy_position()
+    captures = 0
+    for piece_type in range(game.W_QUEEN, game.B_ROOK + 1):
+        while piece_list[piece_type][0] is not None:
+            x, y = piece_list[piece_type][0]
+            decrease_piece_nr(piece_list, cb_position, piece_type, 0)
+            cb_position[x][y] = (0, None)
+            captures += 1
+    return captures
+
+
+def bench_captures(args):
+    captures = capture_all(game.decrease_piece_nr)
+    # make sure that both implementations agree
+    cb_position, piece_list = capture_heavy_position()
+    cb_position_ref, piece_list_ref = capture_heavy_position()
+    for piece_type in [game.W_QUEEN, game.B_ROOK, game.W_KNIGHT]:
+        game.decrease_piece_nr(piece_list, cb_position, piece_type, 0)
+        decrease_piece_nr_full_scan(piece_list_ref, cb_position_ref, piece_type, 0)
+    if cb_position != cb_position_ref or piece_list != piece_list_ref:
+        raise ValueError("decrease_piece_nr differs from reference implementation")
+
+    number = args.number if args.number is not None else 2000
+    t_setup = min(timeit.repeat(capture_heavy_position, number=number, repeat=args.repeat))
+    t_ref = min(timeit.repeat(lambda: capture_all(decrease_piece_nr_full_scan),
+                              number=number, repeat=args.repeat))
+    t_new = min(timeit.repeat(lambda: capture_all(game.decrease_piece_nr),
+                              number=number, repeat=args.repeat))
+    n = number * captures
+    us_ref = (t_ref - t_setup) / n * 1e6
+    us_new = (t_new - t_setup) / n * 1e6
+    print("captures per position.....: " + str(captures))
+    print("full board scan...........: {:.3f} us/capture".format(us_ref))
+    print("piece list renumbering....: {:.3f} us/capture".format(us_new))
+    print("speedup...................: {:.1f}x".format(us_ref / us_new))
+
+
+def export_tags(db, record_offset):
+    """
+    reference implementation of database.Database.format_tags that sets the
+    headers of a python-chess game and writes them with its exporter
+    """
+    pgn_game = chess.pgn.Game()
+    db.set_headers(pgn_game, record_offset)
+    return pgn_game.accept(chess.pgn.StringExporter())
+
+
+def format_tags(db, record_offset):
+    roster, elos, _ = db.format_tags(record_offset)
+    return roster + elos
+
+
+def game_records(db):
+    """
+    :return: list of the offsets of all records of a database that are games
+    """
+    return [db.record_offset(i) for i in range(1, db.nr_records)
+            if header.is_game(db.cbh_file, db.record_offset(i)) and
+            not header.is_marked_as_deleted(db.cbh_file, db.record_offset(i))]
+
+
+def time_headers(filename, render, passes):
+    """
+    :return: best time to render the tags of all games of a database the given number of times.
+             the database is opened anew for each measurement, so that its caches start empty
+    """
+    with database.Database(filename) as db:
+        record_offsets = game_records(db)
+        start = time.perf_counter()
+        for _ in range(passes):
+            for record_offset in record_offsets:
+                render(db, record_offset)
+        return time.perf_counter() - start, len(record_offsets) * passes
+
+
+def bench_headers(args):
+    if args.input is None:
+        parser.error("the headers benchmark needs a database (-i)")
+    with database.Database(args.input) as db:
+        for record_offset in game_records(db):
+            if not export_tags(db, record_offset).startswith(format_tags(db, record_offset) + "\n"):
+                raise ValueError("format_tags differs from reference implementation")
+    passes = args.number if args.number is not None else 1
+    t_ref, n = min(time_headers(args.input, export_tags, passes) for _ in range(args.repeat))
+    t_new, n = min(time_headers(args.input, format_tags, passes) for _ in range(args.repeat))
+    print("games.....................: " + str(n))
+    print("python-chess headers......: {:.0f} games/s".format(n / t_ref))
+    print("cached tag formatting.....: {:.0f} games/s".format(n / t_new))
+    print("speedup...................: {:.1f}x".format(t_ref / t_new))
+
+
+def write_syscalls():
+    """
+    :return: number of write system calls of this process so far, or None if unknown (not on Linux)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class FragmentRecorder:
+    """
+    file-like object that records the strings written to it
+    """
+
+    def __init__(self):
+        self.fragments = []
+
+    def write(self, text):
+        self.fragments.append(text)
+        return len(text)
+
+
+def write_fragments(filename, games, passes):
+    """
+    reference: replays the writes of chess.pgn.FileExporter (one per line and line break)
+    into a text file with default buffering
+    """
+    with open(filename, "w", encoding="utf-8") as pgn_out:
+        for _ in range(passes):
+            for fragments, _ in games:
+                for text in fragments:
+                    pgn_out.write(text)
+
+
+def write_text_file(filename, games, passes):
+    with open(filename, "w", encoding="utf-8") as pgn_out:
+        for _ in range(passes):
+            for _, pgn in games:
+                pgn_out.write(pgn)
+
+
+def write_buffered(filename, games, passes, buffer_size, background):
+    with writer.BufferedWriter(filename, buffer_size=buffer_size, background=background) as pgn_out:
+        for _ in range(passes):
+            for _, pgn in games:
+                pgn_out.write(pgn)
+
+
+def bench_writer(args):
+    if args.input is None:
+        parser.error("the writer benchmark needs a database (-i)")
+    # decode and render all games beforehand, only writing them is measured
+    games = []
+    with database.Database(args.input) as db:
+        for i in range(1, db.nr_records):
+            pgn_game, _ = db.read_game(i)
+            if pgn_game is not None:
+                recorder = FragmentRecorder()
+                pgn_game.accept(chess.pgn.FileExporter(recorder))
+                games.append((recorder.fragments, db.render_game(i)[0]))
+    passes = args.number if args.number is not None else 20
+    buffer_size = args.buffer_size << 20
+    variants = [
+        ("FileExporter, text file", lambda f: write_fragments(f, games, passes)),
+        ("PGN strings, text file", lambda f: write_text_file(f, games, passes)),
+        ("BufferedWriter", lambda f: write_buffered(f, games, passes, buffer_size, False)),
+        ("BufferedWriter, thread", lambda f: write_buffered(f, games, passes, buffer_size, True)),
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "out.pgn")
+        print("games.....................: " + str(len(games) * passes))
+        print("buffer size...............: " + str(args.buffer_size) + " MB")
+        expected = None
+        for name, write in variants:
+            best = None
+            for _ in range(args.repeat):
+                syscalls = write_syscalls()
+                start = time.perf_counter()
+                write(filename)
+                elapsed = time.perf_counter() - start
+                if syscalls is not None:
+                    syscalls = write_syscalls() - syscalls
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, syscalls)
+            with open(filename, "rb") as f:
+                output = f.read()
+            if expected is None:
+                expected = output
+            elif output != expected:
+                raise ValueError(name + ": output differs from FileExporter")
+            elapsed, syscalls = best
+            print((name + " ").ljust(26, ".") + ": {:.1f} MB/s, {} write calls".format(
+                len(output) / elapsed / 1e6, "?" if syscalls is None else syscalls))
+
+
+class MoveCounter(game.Visitor):
+    """
+    visitor that only counts the moves, like a statistics collector would
+    """
+
+    def __init__(self):
+        self.moves = 0
+
+    def move(self, from_square, to_square, promotion, ply):
+        self.moves += 1
+
+
+def time_visitor(filename, visitor, passes):
+    """
+    :return: time to decode all games of a database the given number of times with a visitor
+    """
+    with database.Database(filename) as db:
+        start = time.perf_counter()
+        for _ in range(passes):
+            for i in range(1, db.nr_records):
+                db.visit_game(i, visitor)
+        return time.perf_counter() - start
+
+
+def bench_visitor(args):
+    if args.input is None:
+        parser.error("the visitor benchmark needs a database (-i)")
+    passes = args.number if args.number is not None else 1
+    with database.Database(args.input) as db:
+        counter = MoveCounter()
+        nr_games = sum(db.visit_record(i, db.record_offset(i), counter, True)[0] for i in range(1, db.nr_records))
+    t_tree = min(time_visitor(args.input, game.GameBuilder(), passes) for _ in range(args.repeat))
+    t_counter = min(time_visitor(args.input, MoveCounter(), passes) for _ in range(args.repeat))
+    print("games.....................: " + str(nr_games * passes))
+    print("moves.....................: " + str(counter.moves * passes))
+    print("python-chess game tree....: {:.0f} games/s".format(nr_games * passes / t_tree))
+    print("counting visitor..........: {:.0f} games/s".format(nr_games * passes / t_counter))
+
+
+def drop_page_cache(filename):
+    """
+    ask the OS to evict the files of a database from the page cache
+    """
+    for ext in [".cbh", ".cbg", ".cbp", ".cbt"]:
+        fd = os.open(filename[:-4] + ext, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def read_games(filename, io_strategy):
+    """
+    read the game bytes and the tags of all games of a database, without decoding any moves
+    :return: (seconds, number of games, number of game bytes)
+    """
+    start = time.perf_counter()
+    nr_games = 0
+    nr_bytes = 0
+    with database.Database(filename, io_strategy=io_strategy) as db:
+        cbh_file = db.cbh_file
+        for first in range(1, db.nr_records, database.READ_AHEAD):
+            batch = range(first, min(first + database.READ_AHEAD, db.nr_records))
+            db.prefetch(batch)
+            for i in batch:
+                record_offset = db.record_offset(i)
+                if not header.is_game(cbh_file, record_offset) or \
+                        header.is_marked_as_deleted(cbh_file, record_offset):
+                    continue
+                cbg, cbg_view, pos = db.game_buffer(header.get_game_offset(cbh_file, record_offset))
+                game_len = game.get_info_gamelen(cbg, pos)[4]
+                # touch every byte of the game
+                zlib.crc32(cbg_view[pos:pos + game_len])
+                db.format_tags(record_offset)
+                nr_games += 1
+                nr_bytes += game_len
+    return time.perf_counter() - start, nr_games, nr_bytes
+
+
+def bench_io(args):
+    if args.input is None:
+        parser.error("the io benchmark needs a database (-i)")
+    filename = args.input if args.input.endswith(".cbh") else args.input + ".cbh"
+    for io_strategy in database.IO_STRATEGIES:
+        for cache in ["cold", "warm"]:
+            best = None
+            for _ in range(args.repeat):
+                if cache == "cold":
+                    drop_page_cache(filename)
+                else:
+                    read_games(filename, io_strategy)
+                measurement = read_games(filename, io_strategy)
+                if best is None or measurement[0] < best[0]:
+                    best = measurement
+            elapsed, nr_games, nr_bytes = best
+            print((io_strategy + ", " + cache + " cache ").ljust(26, ".") +
+                  ": {:.1f} MB/s, {:.0f} games/s".format(nr_bytes / elapsed / 1e6, nr_games / elapsed))
+
+
+def time_command(command, env, repeat):
+    """
+    :return: best wall time of running a command, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_startup(args):
+    if args.input is None:
+        parser.error("the startup benchmark needs a database (-i)")
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(source_dir, "cbh2pgn.py")
+    with database.Database(args.input) as db:
+        first_game = next((i for i in range(1, db.nr_records) if header.is_game(db.cbh_file, db.record_offset(i))
+                           and not header.is_marked_as_deleted(db.cbh_file, db.record_offset(i))), 1)
+    commands = [
+        ("import game", ["-c", "import game"]),
+        ("info", [script, "info", "-i", args.input]),
+        ("first game", [script, "extract", "-i", args.input, "-g", str(first_game), "-o", os.devnull]),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        table_cache = os.path.join(tmp, "tables.marshal")
+        for python in args.python or [sys.executable]:
+            if shutil.which(python) is None:
+                print(python + ": not found")
+                continue
+            for cache in [False, True]:
+                env = dict(os.environ, PYTHONPATH=source_dir)
+                env.pop("CBH2PGN_TABLE_CACHE", None)
+                if cache:
+                    env["CBH2PGN_TABLE_CACHE"] = table_cache
+                for name, command in commands:
+                    elapsed = time_command([python] + command, env, args.repeat)
+                    label = os.path.basename(python) + ", " + name + (", table cache " if cache else " ")
+                    print(label.ljust(40, ".") + ": {:.0f} ms".format(elapsed * 1000))
+
+
+# PGN of the chunks of the ipc benchmark, inherited by the worker processes
+ipc_payloads = []
+
+
+def echo_chunk(k, descriptor):
+    """
+    task of the ipc benchmark: hand the output of a chunk back to the parent, without converting anything
+    """
+    return transport.send(ipc_payloads[k], descriptor)
+
+
+def time_transport(name, tasks, workers, filename):
+    """
+    :return: time to hand all chunks of ipc_payloads back through a transport and write them to a file,
+             with the bookkeeping of batch.run_batch
+    """
+    max_in_flight = 4 * workers
+    # created before the pool, as in batch.run_batch
+    t = transport.create(name, max_in_flight, os.path.dirname(filename))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            # start the worker processes before measuring
+            list(pool.map(abs, range(workers)))
+            start = time.perf_counter()
+            in_flight = collections.deque()
+            with open(filename, "wb", buffering=0) as out:
+                for k in tasks:
+                    if len(in_flight) == max_in_flight:
+                        t.write(in_flight.popleft().result(), out.fileno())
+                    in_flight.append(pool.submit(echo_chunk, k, t.task()))
+                while len(in_flight) > 0:
+                    t.write(in_flight.popleft().result(), out.fileno())
+            return time.perf_counter() - start
+    finally:
+        t.close()
+
+
+def bench_ipc(args):
+    if args.input is None:
+        parser.error("the ipc benchmark needs a database (-i)")
+    workers = args.jobs if args.jobs is not None else os.cpu_count() or 1
+    passes = args.number if args.number is not None else 5
+    # render all chunks beforehand, only handing them back is measured
+    with database.Database(args.input) as db:
+        nr_records = db.nr_records
+        for first in range(1, nr_records, batch.CHUNK_SIZE):
+            pgns = [db.render_game(i)[0] for i in range(first, min(first + batch.CHUNK_SIZE, nr_records))]
+            ipc_payloads.append("".join(pgn for pgn in pgns if pgn is not None).encode("utf-8"))
+    tasks = [k for _ in range(passes) for k in range(len(ipc_payloads))]
+    expected = b"".join(ipc_payloads[k] for k in tasks)
+    print("workers...................: " + str(workers))
+    print("chunks....................: {} of {:.0f} KB on average".format(
+        len(tasks), len(expected) / max(len(tasks), 1) / 1024))
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        filename = os.path.join(tmp_dir, "out.pgn")
+        for name in transport.TRANSPORTS:
+            elapsed = min(time_transport(name, tasks, workers, filename) for _ in range(args.repeat))
+            with open(filename, "rb") as f:
+                if f.read() != expected:
+                    raise ValueError(name + ": output differs")
+            print((name + ", transport only ").ljust(26, ".") + ": {:.1f} MB/s".format(
+                len(expected) / elapsed / 1e6))
+        # the whole conversion, to see how much the transport matters
+        for name in transport.TRANSPORTS:
+            best = None
+            for _ in range(args.repeat):
+                job = batch.Job(args.input, filename)
+                start = time.perf_counter()
+                batch.run_batch([job], workers=workers, transport=name)
+                elapsed = time.perf_counter() - start
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, job.nr_games)
+            print((name + ", conversion ").ljust(26, ".") + ": {:.0f} games/s".format(best[1] / best[0]))
+
+
+BENCHMARKS = {
+    "captures": (bench_captures, "renumbering of pieces after captures (game.decrease_piece_nr)"),
+    "headers": (bench_headers, "formatting of the PGN tags of all games of a database (-i), without moves"),
+    "io": (bench_io, "reading the games and tags of a database (-i) with each I/O strategy, "
+                     "with cold and warm page cache"),
+    "ipc": (bench_ipc, "handing the output of chunks of a database (-i) from worker processes back to the parent "
+                       "with each transport, alone and in the whole conversion"),
+    "startup": (bench_startup, "time to import game.py, to run the info command, and to extract the first game of "
+                               "a database (-i) in a new process, with and without the table cache"),
+    "visitor": (bench_visitor, "decoding all games of a database (-i) into python-chess games, and into "
+                               "a visitor that only counts the moves"),
+    "writer": (bench_writer, "writing the PGN of all games of a database (-i) with different output layers"),
+}
+
+parser = argparse.ArgumentParser(description='micro benchmarks for cbh2pgn')
+parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()),
+                    help='; '.join(k + ": " + v[1] for k, v in sorted(BENCHMARKS.items())))
+parser.add_argument('-i', '--input', help='filename of .cbh, for benchmarks on a database')
+parser.add_argument('-n', '--number', type=int,
+                    help='number of iterations (captures: 2000) or passes over the database '
+                         '(headers: 1, ipc: 5, visitor: 1, writer: 20) per measurement')
+parser.add_argument('-j', '--jobs', type=int, help='number of worker processes for the ipc benchmark '
+                                                   '(default: number of CPUs)')
+parser.add_argument('--tmp-dir', help='directory for the output of the ipc benchmark, e.g. on the file system '
+                                      'the PGN will be written to (default: system temporary directory)')
+parser.add_argument('--buffer-size', type=int, metavar='MB', default=writer.DEFAULT_BUFFER_SIZE >> 20,
+                    help='size of the buffer of writer.BufferedWriter (default: %(default)s)')
+parser.add_argument('--python', action='append',
+                    help='interpreter for the startup benchmark, can be given more than once, e.g. '
+                         '--python python3 --python pypy3 (default: the running one)')
+parser.add_argument('-r', '--repeat', type=int, default=5, help='number of measurements (best is reported)')
+
+args = parser.parse_args()
+BENCHMARKS[args.benchmark][0](args)
@@ -2,19 +2,18 @@
 # Copyright (c) 2022 Dominik Klein.
 # Licensed under MIT (see file LICENSE)
 
-import mmap
 from binascii import hexlify
+import database
 import game
-import header
-import player
-import tournament
+import transport
+import writer
 import argparse
+import os
 import sys
-from tqdm import tqdm
-import chess.pgn
 
-CBH_RECORD_SIZE = 46
-CBH_HEADER_SIZE = 46
+EXTRACT_CACHE_SIZE = 1024
+DEFAULT_MAX_PLIES = 100000
+DEFAULT_MAX_NESTING = 1000
 
 
 def to_hex(ls):
@@ -22,188 +21,522 @@ def to_hex(ls):
     return x[2:-1]
 
 
-parser = argparse.ArgumentParser(
-    description='convert a .cbh + .cbg with chess games into a .pgn file')
-parser.add_argument('-i', '--input', help='filename of .cbh')
-parser.add_argument('-o', '--output', help='filename of output .pgn')
-
-args = parser.parse_args()
-
-if args.input is None or args.output is None:
-    parser.print_usage()
-    sys.exit(1)
-
-filename_cbh = args.input
-filename_out = args.output
-
-if filename_cbh.endswith(".cbh"):
-    filename_cbh = filename_cbh[:-4]
-if not filename_out.endswith(".pgn"):
-    filename_out += ".pgn"
-
-print("input file...: " + str(filename_cbh))
-print("output file..: " + str(filename_out))
-
-DB_ROOT = filename_cbh
-
-CBH = DB_ROOT + ".cbh"  # index
-CBG = DB_ROOT + ".cbg"  # games
-CBP = DB_ROOT + ".cbp"  # players
-CBT = DB_ROOT + ".cbt"  # tournaments
-CBE = DB_ROOT + ".cbe"  # teams
-
-f_cbh = open(CBH, "rb")
-f_cbp = open(CBP, "rb")
-f_cbt = open(CBT, "rb")
-f_cbg = open(CBG, "rb")
-
-cbh_file = mmap.mmap(f_cbh.fileno(), 0, prot=mmap.PROT_READ)
-cbp_file = mmap.mmap(f_cbp.fileno(), 0, prot=mmap.PROT_READ)
-cbt_file = mmap.mmap(f_cbt.fileno(), 0, prot=mmap.PROT_READ)
-cbg_file = mmap.mmap(f_cbg.fileno(), 0, prot=mmap.PROT_READ)
-
-header_bytes = cbh_file[0:46]
-header_id = header_bytes[0:6]
-print("")
-print("header id: " + to_hex(header_id))
-if to_hex(header_id) == "00002c002e01":
-    print("created by CB9+?!")
-if to_hex(header_id) == "000024002e01":
-    print("created by Chess Program X/CB Light?!")
-print("")
-pgn_out = open(filename_out, 'w', encoding="utf-8")
-exporter = chess.pgn.FileExporter(pgn_out)
-
-nr_records = (len(cbh_file) // 46)
-
-errors_encountered = []
-
-# for i in tqdm(range(1, nr_records)):
-for i in tqdm(range(1, nr_records)):
-    # 3036382 Poppner, Dietmar vs Von Herman, Ulf
-    #         corrupted? additional moves at end, no 0c marker...
-    # 3036403 Von Herman, Ulf vs Suchin, Dimitry: game starts with 0x40, i.e. Queen2 (2,2)
-    #         instead of Nf3, i.e. 0xFE: (-1, 2)
-    #         for this, bit 0 in the first byte at the .cbg game offset is set
-    cbh_record = cbh_file[46 * i:46 * (i + 1)]
-
-    # get player names
-    offset_white = header.get_whiteplayer_offset(cbh_record)
-    white_player_name = player.get_name(cbp_file, offset_white)
-
-    offset_black = header.get_blackplayer_offset(cbh_record)
-    black_player_name = player.get_name(cbp_file, offset_black)
-
-    # get date
-    yy, mm, dd = header.get_yymmdd(cbh_record)
-    pgn_yymmdd = ""
-    if yy != 0:
-        pgn_yymmdd += "{:04d}".format(yy)
+def add_variation_arguments(parser):
+    variation_group = parser.add_mutually_exclusive_group()
+    variation_group.add_argument('--mainline-only', action='store_true',
+                                 help='skip all variations and convert only the moves of the game')
+    variation_group.add_argument('--max-variation-depth', type=int, metavar='N',
+                                 help='skip variations that are nested deeper than N (0 = main line only)')
+
+
+def get_max_variation_depth(parser, args):
+    max_variation_depth = args.max_variation_depth
+    if args.mainline_only:
+        max_variation_depth = 0
+    if max_variation_depth is not None and max_variation_depth < 0:
+        parser.print_usage()
+        sys.exit(1)
+    return max_variation_depth
+
+
+def add_limit_arguments(parser):
+    group = parser.add_argument_group('limits per game', 'games that exceed a limit are skipped and logged')
+    group.add_argument('--max-tokens', type=int, metavar='N', help='maximum length of the moves in bytes')
+    group.add_argument('--max-plies', type=int, metavar='N', default=DEFAULT_MAX_PLIES,
+                       help='maximum number of moves including variations (default: %(default)s)')
+    group.add_argument('--max-nesting', type=int, metavar='N', default=DEFAULT_MAX_NESTING,
+                       help='maximum number of nested variations (default: %(default)s)')
+    group.add_argument('--max-decode-time', type=float, metavar='SECONDS', help='maximum time to decode a game')
+
+
+def add_io_argument(parser):
+    parser.add_argument('--io', choices=database.IO_STRATEGIES, default='mmap',
+                        help='how the database is read: memory mapped, memory mapped with sequential access '
+                             'hints, or with batched os.pread calls (default: %(default)s)')
+
+
+def add_opening_cache_argument(parser):
+    parser.add_argument('--opening-cache', type=int, metavar='N', default=0,
+                        help='keep the first moves of games (up to N positions) in a cache, so that the '
+                             'openings shared by many games are decoded only once (default: off)')
+
+
+def add_annotation_argument(parser):
+    parser.add_argument('--no-annotations', action='store_true',
+                        help="don't convert the comments and symbols of the .cba file")
+
+
+def add_transport_argument(parser):
+    parser.add_argument('--transport', choices=transport.TRANSPORTS, default='pipe',
+                        help='how worker processes hand their output back: pickled through the pipe of the pool, '
+                             'through a ring buffer in shared memory, or through temporary files that are '
+                             'copied into the output by the kernel (default: %(default)s)')
+
+
+def print_opening_cache_stats(opening_cache):
+    stats = opening_cache.stats()
+    print("opening cache: " + str(stats["positions"]) + " positions, " + str(stats["evictions"]) + " evictions")
+    print("games by number of cached moves: " +
+          ", ".join(str(depth) + ": " + str(games) for depth, games in stats["hit_depths"].items()))
+
+
+def add_progress_arguments(parser):
+    group = parser.add_argument_group('progress')
+    group.add_argument('--progress-interval', type=float, metavar='SECONDS', default=1.0,
+                       help='time between two progress reports (default: %(default)s)')
+    group.add_argument('--metrics', metavar='FILE',
+                       help='append every progress report to this file, e.g. to graph the throughput of a long run')
+    group.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl',
+                       help='format of the metrics file: one JSON object per line, or Prometheus text format '
+                            '(default: %(default)s)')
+
+
+def get_progress(args, total_bytes):
+    import progress
+    return progress.Progress(total_bytes, interval=args.progress_interval, metrics_file=args.metrics,
+                             metrics_format=args.metrics_format)
+
+
+def get_limits(args):
+    return game.Limits(max_tokens=args.max_tokens, max_plies=args.max_plies, max_nesting=args.max_nesting,
+                       max_seconds=args.max_decode_time)
+
+
+def print_errors(errors_encountered, file=sys.stdout):
+    print("errors logged: "+str(len(errors_encountered)), file=file)
+    for err in errors_encountered:
+        print(str(err), file=file)
+
+
+def convert(argv):
+    parser = argparse.ArgumentParser(
+        description='convert a .cbh + .cbg with chess games into a .pgn file',
+        epilog='other commands: ' + ', '.join(sorted(COMMANDS.keys())) +
+               ' (run "cbh2pgn.py <command> -h" for help)')
+    parser.add_argument('-i', '--input', help='filename of .cbh')
+    parser.add_argument('-o', '--output', help='filename of output .pgn')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='convert with this many worker processes (default: convert in this process)')
+    parser.add_argument('--shard', metavar='K/N',
+                        help='convert only shard K of N, i.e. a contiguous range of records with about 1/N '
+                             'of the games by size, and write a manifest for merge next to the output')
+    parser.add_argument('--sort-by', choices=['date', 'white', 'event', 'elo'],
+                        help='write the games sorted by date, name of the white player, event, '
+                             'or mean Elo (highest first), instead of in the order of the database')
+    parser.add_argument('--split-by', choices=['white', 'black', 'player', 'event'],
+                        help='write the games into one file per player (of the white or black pieces, or both) '
+                             'or per event, in the directory given with -o')
+    parser.add_argument('--max-open-files', type=int, metavar='N', default=256,
+                        help='with --split-by, keep at most this many files open at the same time '
+                             '(default: %(default)s)')
+    parser.add_argument('--buffer-size', type=int, metavar='MB', default=writer.DEFAULT_BUFFER_SIZE >> 20,
+                        help='size of the output buffer, with --split-by of the buffers of all open files '
+                             '(default: %(default)s)')
+    parser.add_argument('--background-flush', action='store_true',
+                        help='write the output in a background thread while converting')
+    parser.add_argument('--tee', metavar='KIND:TARGET', action='append',
+                        help='additional output, from the same decoding: pgn:FILE (compressed for .gz, .bz2 or '
+                             '.xz), headers:FILE (tags as JSON lines), or visitor:MODULE.CLASS (a game.Visitor). '
+                             'can be given more than once')
+    parser.add_argument('--tee-queue', type=int, metavar='N', default=1024,
+                        help='number of games that can wait for each --tee output (default: %(default)s)')
+    parser.add_argument('--memprofile', metavar='FILE',
+                        help='profile the memory usage with tracemalloc (slow): print the peak per stage, the '
+                             'largest game and the memory by module, and write all snapshots as JSON to FILE')
+    parser.add_argument('--memprofile-interval', type=float, metavar='SECONDS', default=10.0,
+                        help='time between two memory snapshots (default: %(default)s)')
+    add_io_argument(parser)
+    add_opening_cache_argument(parser)
+    add_annotation_argument(parser)
+    add_transport_argument(parser)
+    add_variation_arguments(parser)
+    add_limit_arguments(parser)
+    add_progress_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.input is None or args.output is None or (args.jobs is not None and args.jobs < 1) or \
+            args.buffer_size < 1 or args.progress_interval <= 0:
+        parser.print_usage()
+        sys.exit(1)
+    if args.sort_by is not None and (args.jobs is not None or args.shard is not None):
+        parser.error("--sort-by can't be combined with -j or --shard")
+    if args.memprofile is not None and args.jobs is not None:
+        parser.error("--memprofile can't be combined with -j")
+    if args.split_by is not None and (args.jobs is not None or args.shard is not None or args.background_flush):
+        parser.error("--split-by can't be combined with -j, --shard or --background-flush")
+    if args.max_open_files < 1:
+        parser.error("--max-open-files must be at least 1")
+    if args.tee is not None:
+        import tee
+        if args.jobs is not None:
+            parser.error("--tee can't be combined with -j")
+        if args.tee_queue < 1:
+            parser.error("--tee-queue must be at least 1")
+        for spec in args.tee:
+            try:
+                tee.parse_sink(spec)
+            except ValueError as e:
+                parser.error(str(e))
+
+    filename_cbh = args.input
+    filename_out = args.output
+
+    max_variation_depth = get_max_variation_depth(parser, args)
+    shard_spec = None
+    if args.shard is not None:
+        import shard
+        try:
+            shard_spec = shard.parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if filename_cbh.endswith(".cbh"):
+        filename_cbh = filename_cbh[:-4]
+    if not filename_out.endswith(".pgn") and args.split_by is None:
+        filename_out += ".pgn"
+
+    print("input file...: " + str(filename_cbh))
+    print(("output dir...: " if args.split_by is not None else "output file..: ") + str(filename_out))
+
+    limits = get_limits(args)
+    db = database.Database(filename_cbh, max_variation_depth=max_variation_depth, limits=limits,
+                           io_strategy=args.io, opening_cache_size=args.opening_cache,
+                           annotations=not args.no_annotations)
+
+    header_id = db.header_id()
+    print("")
+    print("header id: " + to_hex(header_id))
+    if to_hex(header_id) == "00002c002e01":
+        print("created by CB9+?!")
+    if to_hex(header_id) == "000024002e01":
+        print("created by Chess Program X/CB Light?!")
+    print("")
+
+    first, last = 1, db.nr_records
+    if shard_spec is not None:
+        import shard
+        first, last = shard.shard_range(db, shard_spec[0], shard_spec[1])
+        print("shard " + args.shard + ": records " + str(first) + "-" + str(last - 1))
+        print("")
+
+    if args.jobs is not None:
+        import batch
+        job = batch.Job(filename_cbh, filename_out, first, last)
+        batch.run_batch([job], workers=args.jobs, max_variation_depth=max_variation_depth, limits=limits,
+                        io_strategy=args.io, opening_cache_size=args.opening_cache,
+                        annotations=not args.no_annotations, transport=args.transport,
+                        progress=get_progress(args, db.cbg_bytes(first, last)))
+        errors_encountered = job.errors
+        nr_games = job.nr_games
     else:
-        pgn_yymmdd += "????"
-    pgn_yymmdd += "."
-    if mm != 0:
-        pgn_yymmdd += "{:02d}".format(mm)
+        if args.split_by is not None:
+            import split
+            pgn_out = split.SplitWriter(filename_out, db, args.split_by, buffer_size=args.buffer_size << 20,
+                                        max_open=args.max_open_files)
+            write_game = pgn_out.write_game
+        else:
+            pgn_out = writer.BufferedWriter(filename_out, buffer_size=args.buffer_size << 20,
+                                            background=args.background_flush)
+
+            def write_game(i, pgn):
+                pgn_out.write(pgn)
+
+        tee_out = None
+        if args.tee is not None:
+            try:
+                tee_out = tee.Tee(args.tee, db, args.tee_queue)
+            except (ImportError, AttributeError, ValueError, OSError) as e:
+                pgn_out.close()
+                parser.error("--tee: " + str(e))
+            write_main = write_game
+
+            def write_game(i, pgn):
+                write_main(i, pgn)
+                tee_out.write_game(i, pgn)
+
+        errors_encountered = []
+        nr_games = 0
+
+        recorder = tee_out.recorder if tee_out is not None else None
+        if args.sort_by is not None:
+            import sorting
+            games = sorting.render_sorted(db, args.sort_by, visitor=recorder)
+        else:
+            games = db.render_games(range(first, last), visitor=recorder)
+
+        profiler = None
+        if args.memprofile is not None:
+            import memprofile
+            profiler = memprofile.MemoryProfiler(args.memprofile_interval)
+            profiler.begin()
+            db.visit_record = profiler.wrap("decode", db.visit_record)
+            db.render_game = profiler.wrap("render", db.render_game, per_game=True)
+            write_game = profiler.wrap("write", write_game)
+
+        progress = get_progress(args, db.cbg_bytes(first, last))
+        i = None
+        for records, (i, pgn, errors) in enumerate(games, 1):
+            errors_encountered.extend(errors)
+            if pgn is not None:
+                write_game(i, pgn)
+                nr_games += 1
+            progress.update(records, nr_games, len(errors_encountered), db.cbg_bytes_read, pgn_out.bytes_written)
+            if profiler is not None:
+                profiler.tick(i)
+
+        pgn_out.close()
+        if tee_out is not None:
+            tee_out.close()
+        progress.close()
+        if tee_out is not None:
+            for sink in tee_out.sinks:
+                print("tee..........: " + sink.description + ", " + str(sink.games) + " games")
+        if args.split_by is not None:
+            print("files........: " + str(len(pgn_out.targets)) + " (reopened " + str(pgn_out.reopened) +
+                  " times, see " + split.INDEX_FILENAME + ")")
+        if profiler is not None:
+            import json
+            report = profiler.end(i)
+            memprofile.print_report(report)
+            with open(args.memprofile, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        if db.opening_cache is not None:
+            print_opening_cache_stats(db.opening_cache)
+
+    if shard_spec is not None:
+        filename_manifest = shard.write_manifest(db, shard_spec[0], shard_spec[1], first, last, filename_out,
+                                                 nr_games, len(errors_encountered), max_variation_depth)
+        print("manifest.....: " + filename_manifest)
+    db.close()
+
+    print_errors(errors_encountered)
+
+
+def merge(argv):
+    parser = argparse.ArgumentParser(
+        prog='cbh2pgn.py merge',
+        description='check the manifests of the shards of a database (see --shard) and '
+                    'concatenate the shards into one .pgn file')
+    parser.add_argument('-o', '--output', help='filename of output .pgn')
+    parser.add_argument('manifests', nargs='+', help='manifests of all shards (.manifest.json)')
+
+    args = parser.parse_args(argv)
+
+    if args.output is None:
+        parser.print_usage()
+        sys.exit(1)
+
+    import shard
+    try:
+        manifests = shard.merge(args.manifests, args.output)
+    except ValueError as e:
+        print("merge failed: " + str(e))
+        sys.exit(1)
+    print("merged " + str(len(manifests)) + " shards of " + manifests[0]["database"] + " into " + args.output +
+          ": " + str(sum(m["games"] for m in manifests)) + " games, " +
+          str(sum(m["errors"] for m in manifests)) + " errors")
+
+
+def extract(argv):
+    parser = argparse.ArgumentParser(
+        prog='cbh2pgn.py extract',
+        description='extract single games by record number from a .cbh + .cbg into a .pgn file')
+    parser.add_argument('-i', '--input', help='filename of .cbh')
+    parser.add_argument('-g', '--games', metavar='RECORDS',
+                        help='record numbers and ranges of the games, e.g. 5,10-20 (first game is 1)')
+    parser.add_argument('-o', '--output', help='filename of output .pgn (default: standard output)')
+    add_annotation_argument(parser)
+    add_variation_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.input is None or args.games is None:
+        parser.print_usage()
+        sys.exit(1)
+
+    max_variation_depth = get_max_variation_depth(parser, args)
+    try:
+        records = database.parse_records(args.games)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.output is None:
+        pgn_out = sys.stdout
     else:
-        pgn_yymmdd += "??"
-    pgn_yymmdd += "."
-    if dd != 0:
-        pgn_yymmdd += "{:02d}".format(dd)
+        filename_out = args.output
+        if not filename_out.endswith(".pgn"):
+            filename_out += ".pgn"
+        pgn_out = open(filename_out, 'w', encoding="utf-8")
+
+    import chess.pgn
+    errors_encountered = []
+    # the cache makes records that are requested more than once cheap
+    with database.Database(args.input, max_variation_depth=max_variation_depth,
+                           cache_size=EXTRACT_CACHE_SIZE, annotations=not args.no_annotations) as db:
+        for i in records:
+            if i < 1 or i >= db.nr_records:
+                errors_encountered.append((i, None, "no such record"))
+                continue
+            pgn_game, errors = db.get_game(i)
+            errors_encountered.extend(errors)
+            if pgn_game is None:
+                errors_encountered.append((i, None, "not a game, deleted or unsupported"))
+            else:
+                pgn_game.accept(chess.pgn.FileExporter(pgn_out))
+
+    if pgn_out is not sys.stdout:
+        pgn_out.close()
+
+    print_errors(errors_encountered, file=sys.stderr)
+
+
+def convert_batch(argv):
+    parser = argparse.ArgumentParser(
+        prog='cbh2pgn.py batch',
+        description='convert many databases with one pool of worker processes, largest databases first')
+    parser.add_argument('-i', '--input',
+                        help='directory with .cbh files (searched recursively), or a manifest file with '
+                             'one .cbh file per line, optionally followed by the filename of the output .pgn')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='directory for the .pgn files (default: current directory)')
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--report', help='write a summary report with all errors as JSON to this file')
+    add_io_argument(parser)
+    add_opening_cache_argument(parser)
+    add_annotation_argument(parser)
+    add_transport_argument(parser)
+    add_variation_arguments(parser)
+    add_limit_arguments(parser)
+    add_progress_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.input is None or (args.jobs is not None and args.jobs < 1) or args.progress_interval <= 0:
+        parser.print_usage()
+        sys.exit(1)
+
+    max_variation_depth = get_max_variation_depth(parser, args)
+
+    import batch
+    import time
+    jobs = [batch.Job(filename_cbh, filename_out)
+            for filename_cbh, filename_out in batch.find_databases(args.input, args.output_dir)]
+    if len(jobs) == 0:
+        print("no databases found: " + args.input)
+        sys.exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+    print("databases....: " + str(len(jobs)))
+    print("")
+    start = time.time()
+    restarts = batch.run_batch(jobs, workers=args.jobs, max_variation_depth=max_variation_depth,
+                               limits=get_limits(args), io_strategy=args.io, opening_cache_size=args.opening_cache,
+                               annotations=not args.no_annotations, transport=args.transport,
+                               progress=get_progress(args, sum(job.cbg_size for job in jobs)))
+    elapsed = time.time() - start
+    print("")
+    batch.print_summary(jobs, elapsed, restarts)
+    if args.report is not None:
+        batch.write_report(jobs, elapsed, args.report, restarts)
+
+
+def verify_database(argv):
+    parser = argparse.ArgumentParser(
+        prog='cbh2pgn.py verify',
+        description='check the consistency of a .cbh + .cbg database without decoding the moves')
+    parser.add_argument('-i', '--input', help='filename of .cbh')
+    parser.add_argument('--report', help='write the report with all errors as JSON to this file')
+
+    args = parser.parse_args(argv)
+
+    if args.input is None:
+        parser.print_usage()
+        sys.exit(1)
+
+    import json
+    import verify
+    with database.Database(args.input) as db:
+        report = verify.verify(db)
+
+    for key in ["records", "games", "deleted", "not_games", "setup_position", "not_encoded", "chess960",
+                "special_encoding", "players", "tournaments", "cbg_bytes", "cbg_bytes_used"]:
+        print((key + " ").ljust(18, ".") + ": " + str(report[key]))
+    print("")
+    print_errors([tuple(err) for err in report["error_list"]])
+    if args.report is not None:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if report["errors"] > 0:
+        sys.exit(2)
+
+
+def info(argv):
+    parser = argparse.ArgumentParser(
+        prog='cbh2pgn.py info',
+        description='print statistics of a .cbh + .cbg database as JSON, without decoding the moves')
+    parser.add_argument('-i', '--input', help='filename of .cbh')
+    parser.add_argument('-o', '--output', help='write the JSON to this file instead of standard output')
+
+    args = parser.parse_args(argv)
+
+    if args.input is None:
+        parser.print_usage()
+        sys.exit(1)
+
+    import json
+    import stats
+    with database.Database(args.input) as db:
+        statistics = stats.statistics(db)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(statistics, f, indent=2)
     else:
-        pgn_yymmdd += "??"
-
-    # get result
-    pgn_res = header.get_result(cbh_record)
-
-    # get tournament info
-    tournament_offset = header.get_tournament_offset(cbh_record)
-    event, site = tournament.get_event_site_totalrounds(cbt_file, tournament_offset)
+        print(json.dumps(statistics, indent=2))
 
-    # get round + subround
-    round, subround = header.get_round_subround(cbh_record)
 
-    w_elo, b_elo = header.get_ratings(cbh_record)
+def serve(argv):
+    parser = argparse.ArgumentParser(
+        prog='cbh2pgn.py serve',
+        description='serve games and header searches of a .cbh + .cbg database over HTTP (read-only)')
+    parser.add_argument('-i', '--input', help='filename of .cbh')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--socket', help='listen on this unix socket instead of host and port')
+    parser.add_argument('-w', '--workers', type=int, help='number of decoding processes (default: number of CPUs)')
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='number of games kept in memory (default: 10000)')
+    add_variation_arguments(parser)
 
-    # get game offset
-    game_offset = header.get_game_offset(cbh_record)
+    args = parser.parse_args(argv)
 
-    not_initial, not_encoded, is_960, special_encoding, game_len = game.get_info_gamelen(cbg_file, game_offset)
+    if args.input is None:
+        parser.print_usage()
+        sys.exit(1)
 
-    # cbg_file[game_offset] is the byte that stores various game encoding and setup information
-    # which is useful for debugging
-    if special_encoding:
-        errors_encountered.append((i, hex(cbg_file[game_offset]), "ignored: special encoding flag"))
+    max_variation_depth = get_max_variation_depth(parser, args)
 
-    pgn_game = None
-    if header.is_game(cbh_record) and (not header.is_marked_as_deleted(cbh_record)) \
-            and (not_encoded == 0) and not is_960 and not special_encoding:
-        # cbg header is 26, after that game starts
-        if not_initial:
-            fen, cb_position, piece_list = game.decode_start_position(cbg_file, game_offset)
-            pgn_game, err_string = game.decode(cbg_file[game_offset + 4 + 28:game_offset + game_len], cb_position,
-                                               piece_list, fen=fen)
-            if not (err_string is None):
-                errors_encountered.append((i, hex(cbg_file[game_offset]), err_string))
-        else:
-            # number denotes the 0th, the 1st, 2nd ... piece of one kind (e.g. 0th white rook in upper left corner
-            # 1st white rook in lower left corner
-            cb_position = [
-                [(game.W_ROOK, 0), (game.W_PAWN, 0), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 0),
-                 (game.B_ROOK, 0)],
-                [(game.W_KNIGHT, 0), (game.W_PAWN, 1), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 1),
-                 (game.B_KNIGHT, 0)],
-                [(game.W_BISHOP, 0), (game.W_PAWN, 2), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 2),
-                 (game.B_BISHOP, 0)],
-                [(game.W_QUEEN, 0), (game.W_PAWN, 3), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 3),
-                 (game.B_QUEEN, 0)],
-                [(game.W_KING, None), (game.W_PAWN, 4), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 4),
-                 (game.B_KING, None)],
-                [(game.W_BISHOP, 1), (game.W_PAWN, 5), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 5),
-                 (game.B_BISHOP, 1)],
-                [(game.W_KNIGHT, 1), (game.W_PAWN, 6), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 6),
-                 (game.B_KNIGHT, 1)],
-                [(game.W_ROOK, 1), (game.W_PAWN, 7), (0, None), (0, None), (0, None), (0, None), (game.B_PAWN, 7),
-                 (game.B_ROOK, 1)]
-            ]
-            piece_list = [None,
-                          [(3, 0), None, None, None, None, None, None, None],  # white queen on (3,0)
-                          [(1, 0), (6, 0), None, None, None, None, None, None],
-                          # first white knight on (1,0), second one on (6,0)
-                          [(2, 0), (5, 0), None, None, None, None, None, None],  # white bishops
-                          [(0, 0), (7, 0), None, None, None, None, None, None],  # white rooks
-                          [(3, 7), None, None, None, None, None, None, None],  # black queens
-                          [(1, 7), (6, 7), None, None, None, None, None, None],  # black knights
-                          [(2, 7), (5, 7), None, None, None, None, None, None],  # black bishops
-                          [(0, 7), (7, 7), None, None, None, None, None, None],  # black rooks
-                          [(4, 0)],  # white king
-                          [(4, 7)],  # black king
-                          [(0, 1), (1, 1), (2, 1), (3, 1), (4, 1), (5, 1), (6, 1), (7, 1)],  # white pawns
-                          [(0, 6), (1, 6), (2, 6), (3, 6), (4, 6), (5, 6), (6, 6), (7, 6)]]  # black pawns
-            pgn_game, err_string = game.decode(cbg_file[game_offset + 4:game_offset + game_len], cb_position, piece_list)
-            if not (err_string is None):
-                errors_encountered.append((i, hex(cbg_file[game_offset]), err_string))
-    if pgn_game is not None:
-        pgn_game.headers["White"] = white_player_name
-        pgn_game.headers["Black"] = black_player_name
-        pgn_game.headers["Date"] = pgn_yymmdd
-        pgn_game.headers["Result"] = pgn_res
-        pgn_game.headers["Event"] = event
-        pgn_game.headers["Site"] = site
-        if subround != 0:
-            pgn_game.headers["Round"] = str(round) + "(" + str(subround) + ")"
-        else:
-            pgn_game.headers["Round"] = str(round)
-        if w_elo != 0:
-            pgn_game.headers["WhiteElo"] = str(w_elo)
-        if b_elo != 0:
-            pgn_game.headers["BlackElo"] = str(b_elo)
-        pgn_game.accept(exporter)
-
-f_cbh.close()
-f_cbp.close()
-f_cbt.close()
-f_cbg.close()
-
-print("errors logged: "+str(len(errors_encountered)))
-for err in errors_encountered:
-    print(str(err))
\ No newline at end of file
+    import server
+    if args.socket is not None:
+        print("serving " + args.input + " on " + args.socket)
+    else:
+        print("serving " + args.input + " on http://" + args.host + ":" + str(args.port))
+    server.run(args.input, host=args.host, port=args.port, socket_path=args.socket, workers=args.workers,
+               cache_size=args.cache_size, max_variation_depth=max_variation_depth)
+
+
+COMMANDS = {
+    "batch": convert_batch,
+    "extract": extract,
+    "info": info,
+    "merge": merge,
+    "serve": serve,
+    "stats": info,
+    "verify": verify_database,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        convert(sys.argv[1:])
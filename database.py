@@ -0,0 +1,753 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+import collections
+import io
+import mmap
+import os
+import sys
+import annotation
+import game
+import header
+import player
+import tournament
+
+CBH_RECORD_SIZE = 46
+CBH_HEADER_SIZE = 46
+
+# parts of formatted dates, indexed by month and day (0 = unknown)
+DATE_MONTHS = ["??"] + ["{:02d}".format(mm) for mm in range(1, 16)]
+DATE_DAYS = ["??"] + ["{:02d}".format(dd) for dd in range(1, 32)]
+
+RESULT_TAGS = {res: '[Result "' + res + '"]\n' for res in ["1-0", "0-1", "1/2-1/2", "*"]}
+
+# how the files are read:
+#   mmap    all files are memory mapped
+#   advise  like mmap, but the OS is told that .cbh and .cbg are read sequentially,
+#           and the small .cbp and .cbt files are read into memory completely
+#   pread   games are read with os.pread, in batches of the games of
+#           the next records (see prefetch), and .cbp and .cbt are read completely
+IO_STRATEGIES = ["mmap", "advise", "pread"]
+READ_AHEAD = 256
+READ_AHEAD_BYTES_PER_GAME = 8192
+# games that are further apart are not read with the same os.pread
+MAX_READ_GAP = 65536
+
+
+def format_date(packed_date):
+    """
+    :param packed_date: date as stored in the .cbh record, see header.get_packed_date
+    :return: PGN date, e.g. "1990.??.??"
+    """
+    year = (packed_date & header.MASK_YEAR) >> 9
+    return ("{:04d}".format(year) if year != 0 else "????") + "." + \
+        DATE_MONTHS[(packed_date & header.MASK_MONTH) >> 5] + "." + DATE_DAYS[packed_date & header.MASK_DAY]
+
+
+def parse_records(spec):
+    """
+    parse a list of record numbers and ranges, e.g. "5,10-20,42"
+    :param spec: comma separated record numbers or (inclusive) ranges
+    :return: list of record numbers, in the given order
+    """
+    records = []
+    for part in spec.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            first = int(first)
+            last = int(last)
+            if last < first:
+                raise ValueError("invalid record range: " + part)
+            records.extend(range(first, last + 1))
+        else:
+            records.append(int(part))
+    return records
+
+
+class Database:
+    """
+    a ChessBase database (.cbh, .cbg, .cbp, .cbt), opened read-only via memory mapped files.
+    records are numbered like in the .cbh file, i.e. the first game is record 1
+    """
+
+    def __init__(self, filename, max_variation_depth=None, cache_size=0, limits=None, io_strategy="mmap",
+                 opening_cache_size=0, annotations=True):
+        """
+        :param filename: filename of the .cbh file (with or without extension)
+        :param max_variation_depth: see game.decode
+        :param cache_size: number of decoded games kept by get_game (0 = no caching)
+        :param limits: game.Limits for decoding a single game
+        :param io_strategy: one of IO_STRATEGIES
+        :param opening_cache_size: number of positions in the opening cache (0 = no opening cache),
+                                   see opening.OpeningCache
+        :param annotations: convert the comments and symbols of the .cba file (if there is one). if
+                            False, the .cba file isn't even opened
+        """
+        if filename.endswith(".cbh"):
+            filename = filename[:-4]
+        if io_strategy not in IO_STRATEGIES:
+            raise ValueError("unknown I/O strategy: " + str(io_strategy))
+        self.filename = filename
+        self.io_strategy = io_strategy
+        # with the pread strategy: games read by prefetch, as (buffer, offset in buffer),
+        # keyed by their offset in the .cbg file
+        self.read_ahead = {}
+        # annotations read by prefetch, as parsed by annotation.parse_annotations (or an error message),
+        # keyed by their offset in the .cba file
+        self.annotations_read_ahead = {}
+        # bytes of the .cbg file of all games that were decoded (or looked at), for progress reports
+        self.cbg_bytes_read = 0
+        self.max_variation_depth = max_variation_depth
+        self.limits = limits
+        self.opening_cache = None
+        if opening_cache_size > 0:
+            import opening
+            self.opening_cache = opening.OpeningCache(opening_cache_size)
+        self.cache_size = cache_size
+        # decoded games, keyed by offset in the .cbg file, least recently used first
+        self.cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # names of players and tournaments, keyed by their number in the .cbp/.cbt file
+        self.player_names = {}
+        self.tournaments = {}
+        # formatted PGN tags, see format_tags
+        self.date_tags = {}
+        self.event_site_tags = {}
+        self.white_tags = {}
+        self.black_tags = {}
+        self.round_tags = {}
+        self.white_elo_tags = {}
+        self.black_elo_tags = {}
+
+        self.f_cbh = open(filename + ".cbh", "rb")  # index
+        self.f_cbg = open(filename + ".cbg", "rb")  # games
+        self.f_cbp = open(filename + ".cbp", "rb")  # players
+        self.f_cbt = open(filename + ".cbt", "rb")  # tournaments
+
+        self.cbh_file = mmap.mmap(self.f_cbh.fileno(), 0, prot=mmap.PROT_READ)
+        self.cbg_file = mmap.mmap(self.f_cbg.fileno(), 0, prot=mmap.PROT_READ)
+        if io_strategy == "mmap":
+            self.cbp_file = mmap.mmap(self.f_cbp.fileno(), 0, prot=mmap.PROT_READ)
+            self.cbt_file = mmap.mmap(self.f_cbt.fileno(), 0, prot=mmap.PROT_READ)
+        else:
+            # names are looked up at random, and these files are small
+            self.cbp_file = self.f_cbp.read()
+            self.cbt_file = self.f_cbt.read()
+        if io_strategy == "advise" and hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.cbh_file.madvise(mmap.MADV_SEQUENTIAL)
+            self.cbg_file.madvise(mmap.MADV_SEQUENTIAL)
+        # games are handed to the decoder as slices of a memoryview,
+        # which, unlike slices of the mmap, don't copy the game bytes
+        self.cbg_view = memoryview(self.cbg_file)
+
+        # annotations. with the pread strategy, they are read with os.pread, too
+        self.f_cba = None
+        self.cba_file = None
+        if annotations and os.path.exists(filename + ".cba") and os.path.getsize(filename + ".cba") > 0:
+            self.f_cba = open(filename + ".cba", "rb")
+            if io_strategy != "pread":
+                self.cba_file = mmap.mmap(self.f_cba.fileno(), 0, prot=mmap.PROT_READ)
+                if io_strategy == "advise" and hasattr(mmap, "MADV_SEQUENTIAL"):
+                    self.cba_file.madvise(mmap.MADV_SEQUENTIAL)
+
+        self.nr_records = len(self.cbh_file) // CBH_RECORD_SIZE
+
+    def close(self):
+        self.cbg_view.release()
+        self.read_ahead = {}
+        self.annotations_read_ahead = {}
+        for f in [self.cbh_file, self.cbg_file, self.cbp_file, self.cbt_file, self.cba_file]:
+            if isinstance(f, mmap.mmap):
+                f.close()
+        for f in [self.f_cbh, self.f_cbg, self.f_cbp, self.f_cbt, self.f_cba]:
+            if f is not None:
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def header_id(self):
+        return self.cbh_file[0:6]
+
+    def record_offset(self, i):
+        """
+        :param i: record number
+        :return: offset of the record in the .cbh file
+        """
+        if i < 1 or i >= self.nr_records:
+            raise IndexError("record " + str(i) + " out of range (1-" + str(self.nr_records - 1) + ")")
+        return CBH_RECORD_SIZE * i
+
+    def cbg_bytes(self, first, last):
+        """
+        estimate the number of bytes of the games of a range of records. games are usually stored
+        in the .cbg file in the order of their records
+        :param first: first record number
+        :param last: record number after the last one
+        :return: number of bytes of the .cbg file from the game of record first to the game of record last
+        """
+        cbg_size = len(self.cbg_file)
+
+        def game_offset(i):
+            if i >= self.nr_records:
+                return cbg_size
+            return min(header.get_game_offset(self.cbh_file, self.record_offset(i)), cbg_size)
+
+        if last <= first:
+            return 0
+        return max(game_offset(last) - game_offset(first), 0)
+
+    def prefetch(self, records):
+        """
+        prepare reading the games of the given records. with the pread strategy, the games are read
+        (sorted by their offset, games close to each other with one os.pread), otherwise the OS is
+        asked to read their first bytes into the page cache
+        :param records: list of record numbers
+        """
+        if self.f_cba is not None:
+            self.prefetch_annotations(records)
+        cbh_file = self.cbh_file
+        cbg_size = len(self.cbg_file)
+        offsets = sorted(set(header.get_game_offset(cbh_file, self.record_offset(i)) for i in records))
+        offsets = [offset for offset in offsets if offset + 4 <= cbg_size]
+        if self.io_strategy == "pread":
+            self.read_ahead = {}
+            first = 0
+            for k in range(1, len(offsets) + 1):
+                if k == len(offsets) or offsets[k] - offsets[k - 1] > MAX_READ_GAP:
+                    self.pread_games(offsets[first:k])
+                    first = k
+            return
+        if not hasattr(mmap, "MADV_WILLNEED"):
+            return
+        # join the byte ranges of the games to as few calls as possible
+        start = None
+        end = None
+        for offset in offsets:
+            page_start = offset - (offset % mmap.PAGESIZE)
+            if start is not None and page_start <= end:
+                end = max(end, offset + READ_AHEAD_BYTES_PER_GAME)
+                continue
+            if start is not None:
+                self.cbg_file.madvise(mmap.MADV_WILLNEED, start, min(end, cbg_size) - start)
+            start = page_start
+            end = offset + READ_AHEAD_BYTES_PER_GAME
+        if start is not None:
+            self.cbg_file.madvise(mmap.MADV_WILLNEED, start, min(end, cbg_size) - start)
+
+    def pread_games(self, offsets):
+        """
+        read games with as few calls to os.pread as possible and keep them in read_ahead
+        :param offsets: sorted offsets of the games in the .cbg file
+        """
+        fd = self.f_cbg.fileno()
+        start = offsets[0]
+        last = offsets[-1]
+        data = os.pread(fd, last + 4 - start, start)
+        if len(data) == last + 4 - start:
+            # the length of the last game is only known now
+            game_len = game.get_info_gamelen(data, last - start)[4]
+            if game_len > 4:
+                data += os.pread(fd, game_len - 4, last + 4)
+        for offset in offsets:
+            self.read_ahead[offset] = (data, offset - start)
+
+    def prefetch_annotations(self, records):
+        """
+        read and parse the annotations of the given records, sorted by their offset in the .cba file,
+        i.e. in one sequential pass (with the pread strategy, annotations close to each other are read
+        with one os.pread), and keep them in annotations_read_ahead
+        :param records: list of record numbers
+        """
+        cbh_file = self.cbh_file
+        offsets = sorted(set(header.get_annotation_offset(cbh_file, self.record_offset(i)) for i in records))
+        offsets = [offset for offset in offsets if offset != 0]
+        self.annotations_read_ahead = {}
+        if self.cba_file is not None:
+            for offset in offsets:
+                self.annotations_read_ahead[offset] = self.parse_annotations(self.cba_file, offset)
+            return
+        fd = self.f_cba.fileno()
+        first = 0
+        for k in range(1, len(offsets) + 1):
+            if k == len(offsets) or offsets[k] - offsets[k - 1] > MAX_READ_GAP:
+                start = offsets[first]
+                last = offsets[k - 1]
+                data = os.pread(fd, last + annotation.GAME_HEADER_SIZE - start, start)
+                if len(data) == last + annotation.GAME_HEADER_SIZE - start:
+                    # the length of the last annotations is only known now
+                    length = annotation.get_length(data, last - start)
+                    if length > annotation.GAME_HEADER_SIZE:
+                        data += os.pread(fd, length - annotation.GAME_HEADER_SIZE,
+                                         last + annotation.GAME_HEADER_SIZE)
+                for offset in offsets[first:k]:
+                    self.annotations_read_ahead[offset] = self.parse_annotations(data, offset - start)
+                first = k
+
+    def parse_annotations(self, cba, pos):
+        """
+        :param cba: buffer with the annotations of a game
+        :param pos: offset of the annotations in the buffer
+        :return: the annotations, see annotation.parse_annotations, or an error message
+        """
+        try:
+            if pos + annotation.GAME_HEADER_SIZE > len(cba):
+                raise ValueError("offset beyond end of .cba")
+            length = annotation.get_length(cba, pos)
+            if pos + length > len(cba):
+                raise ValueError("length " + str(length) + " beyond end of .cba")
+            return annotation.parse_annotations(cba[pos:pos + length])
+        except ValueError as e:
+            return str(e)
+
+    def game_annotations(self, record_offset):
+        """
+        :param record_offset: offset of the record in the .cbh file
+        :return: the annotations of the game (None if it has none), see annotation.parse_annotations,
+                 or an error message
+        """
+        if self.f_cba is None:
+            return None
+        offset = header.get_annotation_offset(self.cbh_file, record_offset)
+        if offset == 0:
+            return None
+        annotations = self.annotations_read_ahead.pop(offset, None)
+        if annotations is not None:
+            return annotations
+        # not prefetched
+        if self.cba_file is not None:
+            return self.parse_annotations(self.cba_file, offset)
+        fd = self.f_cba.fileno()
+        data = os.pread(fd, annotation.GAME_HEADER_SIZE, offset)
+        if len(data) == annotation.GAME_HEADER_SIZE:
+            length = annotation.get_length(data, 0)
+            if length > annotation.GAME_HEADER_SIZE:
+                data += os.pread(fd, length - annotation.GAME_HEADER_SIZE, offset + annotation.GAME_HEADER_SIZE)
+        return self.parse_annotations(data, 0)
+
+    def game_buffer(self, game_offset):
+        """
+        :param game_offset: offset of a game in the .cbg file
+        :return: tuple of (buffer, memoryview of the buffer, offset of the game in the buffer)
+        """
+        if self.io_strategy != "pread":
+            return self.cbg_file, self.cbg_view, game_offset
+        data, pos = self.read_ahead.get(game_offset, (None, 0))
+        if data is None or pos + game.get_info_gamelen(data, pos)[4] > len(data):
+            # not prefetched (or longer than expected)
+            data = os.pread(self.f_cbg.fileno(), 4, game_offset)
+            if len(data) == 4:
+                game_len = game.get_info_gamelen(data, 0)[4]
+                if game_len > 4:
+                    data += os.pread(self.f_cbg.fileno(), game_len - 4, game_offset + 4)
+            pos = 0
+        return data, memoryview(data), pos
+
+    def visit_record(self, i, record_offset, visitor, tags):
+        """
+        decode a game and pass its moves to a visitor
+        :param i: record number (only used for error reporting)
+        :param record_offset: offset of the record in the .cbh file
+        :param visitor: game.Visitor
+        :param tags: also pass the PGN tags (see get_tags) to the visitor
+        :return: tuple of (whether the game was visited completely, list of errors encountered
+                 as (record number, first game byte, message)). records that are not games that
+                 can be converted are not visited at all
+        """
+        cbh_file = self.cbh_file
+        errors = []
+
+        # get game offset
+        game_offset = header.get_game_offset(cbh_file, record_offset)
+        cbg, cbg_view, pos = self.game_buffer(game_offset)
+
+        not_initial, not_encoded, is_960, special_encoding, game_len = game.get_info_gamelen(cbg, pos)
+        self.cbg_bytes_read += game_len
+
+        # cbg[pos] is the byte that stores various game encoding and setup information
+        # which is useful for debugging
+        if special_encoding:
+            errors.append((i, hex(cbg[pos]), "ignored: special encoding flag"))
+
+        if not header.is_game(cbh_file, record_offset) or header.is_marked_as_deleted(cbh_file, record_offset) \
+                or not_encoded != 0 or is_960 or special_encoding:
+            return False, errors
+        headers = self.get_tags(record_offset) if tags else ()
+        annotations = self.game_annotations(record_offset)
+        if isinstance(annotations, str):
+            errors.append((i, hex(cbg[pos]), "annotations ignored: " + annotations))
+            annotations = None
+        try:
+            # cbg header is 26, after that game starts
+            if not_initial:
+                fen, cb_position, piece_list = game.decode_start_position(cbg, pos)
+                err_string = game.visit(cbg_view[pos + 4 + 28:pos + game_len], cb_position, piece_list,
+                                        visitor, fen=fen, headers=headers,
+                                        max_variation_depth=self.max_variation_depth, limits=self.limits,
+                                        opening_cache=self.opening_cache, annotations=annotations)
+            else:
+                cb_position, piece_list = game.initial_position()
+                err_string = game.visit(cbg_view[pos + 4:pos + game_len], cb_position, piece_list,
+                                        visitor, headers=headers,
+                                        max_variation_depth=self.max_variation_depth, limits=self.limits,
+                                        opening_cache=self.opening_cache, annotations=annotations)
+        except game.LimitExceeded as e:
+            errors.append((i, hex(cbg[pos]), "skipped: " + str(e)))
+            return False, errors
+        if not (err_string is None):
+            errors.append((i, hex(cbg[pos]), err_string))
+        return True, errors
+
+    def decode_game(self, i, record_offset):
+        """
+        decode the moves of a game, without any header information
+        :param i: record number (only used for error reporting)
+        :param record_offset: offset of the record in the .cbh file
+        :return: tuple of (python-chess game or None if the record is not a game that can be
+                 converted, list of errors encountered as (record number, first game byte, message))
+        """
+        builder = game.GameBuilder()
+        visited, errors = self.visit_record(i, record_offset, builder, False)
+        if not visited:
+            return None, errors
+        return builder.game, errors
+
+    def visit_game(self, i, visitor):
+        """
+        decode a game and pass its tags and moves to a visitor, without building a python-chess game
+        :param i: record number
+        :param visitor: game.Visitor
+        :return: list of errors encountered, see read_game. the visitor is not called for
+                 records that are not games that can be converted
+        """
+        return self.visit_record(i, self.record_offset(i), visitor, True)[1]
+
+    def player_name(self, player_no):
+        """
+        :param player_no: number of the player record in the .cbp file
+        :return: name of the player as "last name, first name". names are cached
+        """
+        name = self.player_names.get(player_no)
+        if name is None:
+            # interned, as the same name is stored in the tags of many games
+            name = sys.intern(player.get_name(self.cbp_file, player_no))
+            self.player_names[player_no] = name
+        return name
+
+    def event_site(self, tournament_no):
+        """
+        :param tournament_no: number of the tournament record in the .cbt file
+        :return: tuple of (event, site). tournaments are cached
+        """
+        event_site = self.tournaments.get(tournament_no)
+        if event_site is None:
+            event_site = tournament.get_event_site_totalrounds(self.cbt_file, tournament_no)
+            self.tournaments[tournament_no] = event_site
+        return event_site
+
+    def get_tags(self, record_offset):
+        """
+        get the PGN tags of a game from its .cbh record
+        :param record_offset: offset of the record in the .cbh file
+        :return: list of (tag name, value) pairs
+        """
+        cbh_file = self.cbh_file
+
+        # get player names
+        offset_white = header.get_whiteplayer_offset(cbh_file, record_offset)
+        white_player_name = self.player_name(offset_white)
+
+        offset_black = header.get_blackplayer_offset(cbh_file, record_offset)
+        black_player_name = self.player_name(offset_black)
+
+        # get date
+        pgn_yymmdd = format_date(header.get_packed_date(cbh_file, record_offset))
+
+        # get result
+        pgn_res = header.get_result(cbh_file, record_offset)
+
+        # get tournament info
+        tournament_offset = header.get_tournament_offset(cbh_file, record_offset)
+        event, site = self.event_site(tournament_offset)
+
+        # get round + subround
+        round, subround = header.get_round_subround(cbh_file, record_offset)
+
+        w_elo, b_elo = header.get_ratings(cbh_file, record_offset)
+
+        tags = [("White", white_player_name),
+                ("Black", black_player_name),
+                ("Date", pgn_yymmdd),
+                ("Result", pgn_res),
+                ("Event", event),
+                ("Site", site)]
+        if subround != 0:
+            tags.append(("Round", str(round) + "(" + str(subround) + ")"))
+        else:
+            tags.append(("Round", str(round)))
+        if w_elo != 0:
+            tags.append(("WhiteElo", str(w_elo)))
+        if b_elo != 0:
+            tags.append(("BlackElo", str(b_elo)))
+        return tags
+
+    def set_headers(self, pgn_game, record_offset):
+        """
+        set the PGN headers of a game from its .cbh record
+        :param pgn_game: python-chess game
+        :param record_offset: offset of the record in the .cbh file
+        """
+        for name, value in self.get_tags(record_offset):
+            pgn_game.headers[name] = value
+
+    def format_tags(self, record_offset):
+        """
+        format the PGN tags of a game from its .cbh record, like get_tags, but directly as lines
+        of a PGN tag section. the lines for the values of all fields are cached
+        :param record_offset: offset of the record in the .cbh file
+        :return: triple of (lines of the seven tag roster, lines of the WhiteElo and BlackElo tags, result)
+        """
+        cbh_file = self.cbh_file
+
+        tournament_no = header.get_tournament_offset(cbh_file, record_offset)
+        event_site = self.event_site_tags.get(tournament_no)
+        if event_site is None:
+            event, site = self.event_site(tournament_no)
+            event_site = '[Event "' + event + '"]\n[Site "' + site + '"]\n'
+            self.event_site_tags[tournament_no] = event_site
+
+        packed_date = header.get_packed_date(cbh_file, record_offset)
+        date = self.date_tags.get(packed_date)
+        if date is None:
+            date = '[Date "' + format_date(packed_date) + '"]\n'
+            self.date_tags[packed_date] = date
+
+        round, subround = header.get_round_subround(cbh_file, record_offset)
+        round_key = (round << 8) | subround
+        round_tag = self.round_tags.get(round_key)
+        if round_tag is None:
+            if subround != 0:
+                round_tag = '[Round "' + str(round) + "(" + str(subround) + ')"]\n'
+            else:
+                round_tag = '[Round "' + str(round) + '"]\n'
+            self.round_tags[round_key] = round_tag
+
+        white_no = header.get_whiteplayer_offset(cbh_file, record_offset)
+        white = self.white_tags.get(white_no)
+        if white is None:
+            white = '[White "' + self.player_name(white_no) + '"]\n'
+            self.white_tags[white_no] = white
+
+        black_no = header.get_blackplayer_offset(cbh_file, record_offset)
+        black = self.black_tags.get(black_no)
+        if black is None:
+            black = '[Black "' + self.player_name(black_no) + '"]\n'
+            self.black_tags[black_no] = black
+
+        result = header.get_result(cbh_file, record_offset)
+
+        w_elo, b_elo = header.get_ratings(cbh_file, record_offset)
+        elos = ""
+        if w_elo != 0:
+            elos = self.white_elo_tags.get(w_elo)
+            if elos is None:
+                elos = '[WhiteElo "' + str(w_elo) + '"]\n'
+                self.white_elo_tags[w_elo] = elos
+        if b_elo != 0:
+            black_elo = self.black_elo_tags.get(b_elo)
+            if black_elo is None:
+                black_elo = '[BlackElo "' + str(b_elo) + '"]\n'
+                self.black_elo_tags[b_elo] = black_elo
+            elos += black_elo
+
+        return event_site + date + round_tag + white + black + RESULT_TAGS[result], elos, result
+
+    def render_game(self, i, visitor=None):
+        """
+        decode a game and export it as PGN. the same as exporting the game returned by read_game
+        with chess.pgn.FileExporter, but faster, as the tags are formatted by format_tags, and the
+        movetext of the moves found in the opening cache is taken from there
+        :param i: record number
+        :param visitor: game.Visitor that is passed the moves of the game, too (without the tags),
+                        from the same decoding
+        :return: tuple of (PGN string or None if the record is not a game that can be converted,
+                 list of errors encountered), see read_game
+        """
+        chess = game.import_chess()
+        record_offset = self.record_offset(i)
+        builder = game.GameBuilder(resume_openings=self.opening_cache is not None)
+        visited, errors = self.visit_record(i, record_offset,
+                                            builder if visitor is None else game.TeeVisitor([builder, visitor]), False)
+        if not visited:
+            return None, errors
+        pgn_game = builder.game
+        roster, elos, result = self.format_tags(record_offset)
+        headers = pgn_game.headers
+        # python-chess takes the result at the end of the moves from the headers
+        headers["Result"] = result
+        out = io.StringIO()
+        out.write(roster)
+        opening_node = builder.opening_node
+        if opening_node is None and len(headers) > len(chess.pgn.TAG_ROSTER):
+            # FEN and SetUp of games with a setup position. a game that starts in the opening
+            # cache is only set up at the position after its cached moves
+            for name, value in headers.items():
+                if name not in chess.pgn.TAG_ROSTER:
+                    out.write("[" + name + ' "' + value + '"]\n')
+        out.write(elos)
+        out.write("\n")
+        exporter = chess.pgn.FileExporter(out, headers=False)
+        if opening_node is not None:
+            _, lines, current_line = opening_node.pgn()
+            out.write(lines)
+            # continue the movetext like the exporter had written the cached moves itself
+            exporter.current_line = current_line
+            exporter.force_movenumber = False
+        pgn_game.accept(exporter)
+        return out.getvalue(), errors
+
+    def render_games(self, records, read_ahead=READ_AHEAD, visitor=None):
+        """
+        render_game for many games. the games of the next records are prefetched in batches
+        :param records: iterable of record numbers
+        :param read_ahead: number of records per batch
+        :param visitor: see render_game
+        :return: generator of (record number, PGN string or None, list of errors)
+        """
+        records = iter(records)
+        batch = []
+        while True:
+            batch.clear()
+            for i in records:
+                batch.append(i)
+                if len(batch) == read_ahead:
+                    break
+            if len(batch) == 0:
+                return
+            self.prefetch(batch)
+            for i in batch:
+                pgn, errors = self.render_game(i, visitor)
+                yield i, pgn, errors
+
+    def read_game(self, i):
+        """
+        decode a game including its headers
+        :param i: record number
+        :return: tuple of (python-chess game or None if the record is not a game that can be
+                 converted, list of errors encountered as (record number, first game byte, message))
+        """
+        # 3036382 Poppner, Dietmar vs Von Herman, Ulf
+        #         corrupted? additional moves at end, no 0c marker...
+        # 3036403 Von Herman, Ulf vs Suchin, Dimitry: game starts with 0x40, i.e. Queen2 (2,2)
+        #         instead of Nf3, i.e. 0xFE: (-1, 2)
+        #         for this, bit 0 in the first byte at the .cbg game offset is set
+        record_offset = self.record_offset(i)
+        pgn_game, errors = self.decode_game(i, record_offset)
+        if pgn_game is not None:
+            self.set_headers(pgn_game, record_offset)
+        return pgn_game, errors
+
+    def get_game(self, i):
+        """
+        like read_game, but recently decoded games are kept in a cache (keyed by their
+        offset in the .cbg file), so that repeated lookups don't decode the game again.
+        games returned from the cache are shared and must not be modified
+        :param i: record number
+        :return: tuple of (python-chess game or None, list of errors), see read_game
+        """
+        record_offset = self.record_offset(i)
+        game_offset = header.get_game_offset(self.cbh_file, record_offset)
+        cached = self.cache.get(game_offset)
+        if cached is not None and cached[0] == i:
+            self.cache.move_to_end(game_offset)
+            self.cache_hits += 1
+            return cached[1], cached[2]
+        self.cache_misses += 1
+        pgn_game, errors = self.read_game(i)
+        if self.cache_size > 0:
+            self.cache[game_offset] = (i, pgn_game, errors)
+            self.cache.move_to_end(game_offset)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return pgn_game, errors
+
+    def extract(self, records):
+        """
+        decode the given games, using the cache of get_game
+        :param records: iterable of record numbers
+        :return: generator of (record number, python-chess game or None, list of errors)
+        """
+        for i in records:
+            pgn_game, errors = self.get_game(i)
+            yield i, pgn_game, errors
+
+    def search(self, white=None, black=None, player=None, event=None, year_from=None, year_to=None,
+               first=1, limit=None):
+        """
+        search the game headers. names are matched as case insensitive substrings. only
+        the .cbh records are read, the moves of the games are not decoded
+        :param white: name of the white player
+        :param black: name of the black player
+        :param player: name of either player
+        :param event: name of the event
+        :param year_from: first year (inclusive)
+        :param year_to: last year (inclusive)
+        :param first: record number to start the search at
+        :param limit: maximum number of results
+        :return: list of record numbers of matching games
+        """
+        cbh_file = self.cbh_file
+        white = white.lower() if white is not None else None
+        black = black.lower() if black is not None else None
+        player = player.lower() if player is not None else None
+        event = event.lower() if event is not None else None
+        # whether a player / tournament number matches, computed once per number
+        white_matches = {}
+        black_matches = {}
+        player_matches = {}
+        event_matches = {}
+        results = []
+        for i in range(max(first, 1), self.nr_records):
+            record_offset = CBH_RECORD_SIZE * i
+            if not header.is_game(cbh_file, record_offset) or header.is_marked_as_deleted(cbh_file, record_offset):
+                continue
+            if year_from is not None or year_to is not None:
+                year = header.get_yymmdd(cbh_file, record_offset)[0]
+                if (year_from is not None and year < year_from) or (year_to is not None and year > year_to):
+                    continue
+            white_no = header.get_whiteplayer_offset(cbh_file, record_offset)
+            black_no = header.get_blackplayer_offset(cbh_file, record_offset)
+            if white is not None and not self.name_matches(white_matches, white, white_no):
+                continue
+            if black is not None and not self.name_matches(black_matches, black, black_no):
+                continue
+            if player is not None and not (self.name_matches(player_matches, player, white_no) or
+                                           self.name_matches(player_matches, player, black_no)):
+                continue
+            if event is not None:
+                tournament_no = header.get_tournament_offset(cbh_file, record_offset)
+                matches = event_matches.get(tournament_no)
+                if matches is None:
+                    matches = event in self.event_site(tournament_no)[0].lower()
+                    event_matches[tournament_no] = matches
+                if not matches:
+                    continue
+            results.append(i)
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def name_matches(self, matches, name, player_no):
+        match = matches.get(player_no)
+        if match is None:
+            match = name in self.player_name(player_no).lower()
+            matches[player_no] = match
+        return match
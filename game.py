@@ -2,11 +2,18 @@
 # Copyright (c) 2022 Dominik Klein.
 # Licensed under MIT (see file LICENSE)
 
-import copy
+import functools
+import marshal
+import os
 import struct
-import chess.pgn
+import sys
+import time
 import traceback
 
+# python-chess is imported by import_chess, when the first GameBuilder is created. tools that
+# only read the headers or decode the moves with their own visitor never import it
+chess = None
+
 MASK_START_WITH_INITIAL = 0x40000000
 MASK_IS_ENCODED = 0x80000000
 
@@ -19,30 +26,29 @@ MASK_SPECIAL_ENCODING = 0x4000000
 MASK_GAME_LEN = 0x00FFFFFF
 MASK_IS_960 = 0x00A000000
 
+UINT32 = struct.Struct(">I")
+
 
 def get_info_gamelen(cbg_file, offset):
     """
     get basic information about stored game
-    :param cbg_file: the (memory mapped) cbg file
+    :param cbg_file: the (memory mapped) cbg file, or a memoryview of it
     :param offset: offset (start of the game bytes) into the cbg file
     :return: quadruple of - boolean, true game does not start with initial position
                           - boolean, true if this entry stores an (encoded) game
                           - boolean, true if game is Chess960
                           - length of the game
     """
-    size_info = struct.unpack(">I", cbg_file[offset:offset + 4])
-    if len(size_info) > 0:
-        not_initial = (size_info[0] & MASK_START_WITH_INITIAL) >> 30
-        not_encoded = (size_info[0] & MASK_IS_ENCODED) >> 31
-        special_encoding = (size_info[0] & MASK_SPECIAL_ENCODING) >> 26
-        if (size_info[0] & MASK_IS_960) > 0:
-            is_960 = 1
-        else:
-            is_960 = 0
-        game_len = (size_info[0] & MASK_GAME_LEN)
-        return not_initial, not_encoded, is_960, special_encoding, game_len
+    size_info = UINT32.unpack_from(cbg_file, offset)[0]
+    not_initial = (size_info & MASK_START_WITH_INITIAL) >> 30
+    not_encoded = (size_info & MASK_IS_ENCODED) >> 31
+    special_encoding = (size_info & MASK_SPECIAL_ENCODING) >> 26
+    if (size_info & MASK_IS_960) > 0:
+        is_960 = 1
     else:
-        raise ValueError("get_info_gamelen: unable to extract size info from game file")
+        is_960 = 0
+    game_len = (size_info & MASK_GAME_LEN)
+    return not_initial, not_encoded, is_960, special_encoding, game_len
 
 
 MASK_EP_FILE = 0x7
@@ -68,17 +74,6 @@ B_KING = 10
 W_PAWN = 11
 B_PAWN = 12
 
-SQN = [
-    ["a1", "a2", "a3", "a4", "a5", "a6", "a7", "a8"],
-    ["b1", "b2", "b3", "b4", "b5", "b6", "b7", "b8"],
-    ["c1", "c2", "c3", "c4", "c5", "c6", "c7", "c8"],
-    ["d1", "d2", "d3", "d4", "d5", "d6", "d7", "d8"],
-    ["e1", "e2", "e3", "e4", "e5", "e6", "e7", "e8"],
-    ["f1", "f2", "f3", "f4", "f5", "f6", "f7", "f8"],
-    ["g1", "g2", "g3", "g4", "g5", "g6", "g7", "g8"],
-    ["h1", "h2", "h3", "h4", "h5", "h6", "h7", "h8"]
-]
-
 
 ABS_TO_XY = [
     (0,0), (0,1), (0,2), (0,3), (0,4), (0,5), (0,6), (0,7),  # a1 ... a8
@@ -92,102 +87,77 @@ ABS_TO_XY = [
 ]
 
 
-def decode_piece_locations(s):
+# 5 bit codes of the pieces in the setup bitstream. the
+# first bit is always set, the second one denotes the color
+SETUP_PIECE_CODES = {
+    0b10001: W_KING,
+    0b10010: W_QUEEN,
+    0b10011: W_KNIGHT,
+    0b10100: W_BISHOP,
+    0b10101: W_ROOK,
+    0b10110: W_PAWN,
+    0b11001: B_KING,
+    0b11010: B_QUEEN,
+    0b11011: B_KNIGHT,
+    0b11100: B_BISHOP,
+    0b11101: B_ROOK,
+    0b11110: B_PAWN
+}
+
+# SETUP_PIECES[code] is the piece type for a 5 bit code, or 0 if the code is invalid
+SETUP_PIECES = [SETUP_PIECE_CODES.get(code, 0) for code in range(0, 32)]
+
+
+def decode_piece_locations(setup_bytes):
     """
     decodes the piece locations of a starting position in a cbg file (if the game does
     not start with the initial position)
-    :param s: a bitstream (string of '0' and '1') extracted from the cbg file
+    :param setup_bytes: the bytes of the bitstream that encodes the piece locations
     :return: tuple of (position as 8x8 array, piece lists)
     """
+    # read the bitstream as one large integer. the bit at position s_idx
+    # (counted from the start of the stream) is then bit n_bits - 1 - s_idx
+    bits = int.from_bytes(setup_bytes, "big")
+    n_bits = len(setup_bytes) * 8
     s_idx = 0
     b_idx = 0
 
     # we create piece lists. each piece list stores (x,y) coordinates
     # e.g. the first entry of w_queens stores the location of the first white queen
-    w_queens = []
-    w_rooks = []
-    w_bishops = []
-    w_knights = []
-    w_kings = [None]  # always 1
-    w_pawns = []
-    b_queens = []
-    b_rooks = []
-    b_bishops = []
-    b_knights = []
-    b_kings = [None]  # always 1
-    b_pawns = []
-
     # put the piece lists for each piece type in one large list
     # we can get the sublist for a type by indexing with the piece type, e.g. piece_list[W_QUEEN]
     piece_list = [None,
-                  w_queens, w_knights, w_bishops, w_rooks, b_queens, b_knights, \
-                  b_bishops, b_rooks, w_kings, b_kings, w_pawns, b_pawns ]
+                  [], [], [], [], [], [], [], [],
+                  [None], [None],  # kings, always 1
+                  [], []]
 
     # chess position is an 8x8 array of tuples (x,y). x denotes the piece type
     # and y counts if this is the 0th, 1st, 2nd, 3d, ... 7th piece of that type
     cb_position = [[(0, None) for x in range(0, 8)] for y in range(0, 8)]
 
-    while s_idx < len(s) and b_idx < 64:
-        if s[s_idx] == '0':
+    while s_idx < n_bits and b_idx < 64:
+        if not (bits >> (n_bits - 1 - s_idx)) & 1:
             s_idx += 1
             b_idx += 1
         else:
-            if len(s) - s_idx < 5:
-                raise ValueError("Error decoding position: " + str(s))
+            if n_bits - s_idx < 5:
+                raise ValueError("Error decoding position: " + format(bits, "0" + str(n_bits) + "b"))
+            code = (bits >> (n_bits - 5 - s_idx)) & 0x1F
+            piece = SETUP_PIECES[code]
+            if piece == 0:
+                raise ValueError(
+                    "Error parsing position setup, piece: " + format(code, "05b") + "@pos " + str(s_idx) +
+                    " from " + format(bits, "0" + str(n_bits) + "b"))
+            i, j = ABS_TO_XY[b_idx]
+            if piece == W_KING or piece == B_KING:
+                cb_position[i][j] = (piece, None)
+                piece_list[piece][0] = (i, j)
             else:
-                piece = s[s_idx:s_idx + 5]
-                i, j = ABS_TO_XY[b_idx]
-                if piece == '10001':
-                    cb_position[i][j] = (W_KING, None)
-                    piece_list[W_KING][0] = (i, j)
-                elif piece == '10010':
-                    l = len(w_queens)  # becomes the l queen, zero-indexed (len 0 -> 0th queen)
-                    cb_position[i][j] = (W_QUEEN, l)
-                    piece_list[W_QUEEN].append((i, j))
-                elif piece == '10011':
-                    l = len(w_knights)
-                    cb_position[i][j] = (W_KNIGHT, l)
-                    piece_list[W_KNIGHT].append((i, j))
-                elif piece == '10100':
-                    l = len(w_bishops)
-                    cb_position[i][j] = (W_BISHOP, l)
-                    piece_list[W_BISHOP].append((i, j))
-                elif piece == '10101':
-                    l = len(w_rooks)
-                    cb_position[i][j] = (W_ROOK, l)
-                    piece_list[W_ROOK].append((i, j))
-                elif piece == '10110':
-                    l = len(w_pawns)
-                    cb_position[i][j] = (W_PAWN, l)
-                    piece_list[W_PAWN].append((i, j))
-                elif piece == '11001':
-                    cb_position[i][j] = (B_KING, None)
-                    piece_list[B_KING][0] = (i, j)
-                elif piece == '11010':
-                    l = len(b_queens)
-                    cb_position[i][j] = (B_QUEEN, l)
-                    piece_list[B_QUEEN].append((i, j))
-                elif piece == '11011':
-                    l = len(b_knights)
-                    cb_position[i][j] = (B_KNIGHT, l)
-                    piece_list[B_KNIGHT].append((i, j))
-                elif piece == '11100':
-                    l = len(b_bishops)
-                    cb_position[i][j] = (B_BISHOP, l)
-                    piece_list[B_BISHOP].append((i, j))
-                elif piece == '11101':
-                    l = len(b_rooks)
-                    cb_position[i][j] = (B_ROOK, l)
-                    piece_list[B_ROOK].append((i, j))
-                elif piece == '11110':
-                    l = len(b_pawns)
-                    cb_position[i][j] = (B_PAWN, l)
-                    piece_list[B_PAWN].append((i, j))
-                else:
-                    raise ValueError(
-                        "Error parsing position setup, piece: " + str(piece) + "@pos " + str(s_idx) + " from " + str(s))
-                s_idx += 5
-                b_idx += 1
+                l = len(piece_list[piece])  # becomes the l-th piece, zero-indexed (len 0 -> 0th queen)
+                cb_position[i][j] = (piece, l)
+                piece_list[piece].append((i, j))
+            s_idx += 5
+            b_idx += 1
     # make sure that all piece lists have 8 elements
     # will make demoting pieces down later easier
     for i in range(W_QUEEN, B_ROOK+1):
@@ -197,6 +167,17 @@ def decode_piece_locations(s):
     return cb_position, piece_list
 
 
+def copy_position(cb_position, piece_list):
+    """
+    copies a position and its piece lists. much faster than copy.deepcopy,
+    as all squares and piece locations are immutable tuples
+    :param cb_position: 8x8 array of tuples; each tuple (x,y) is x = piece_type, y 0th, 1st, 2nd ... of it's kind
+    :param piece_list: piece list with (x,y) locations for each piece type
+    :return: tuple of (copy of cb_position, copy of piece_list)
+    """
+    return [column[:] for column in cb_position], [None] + [pieces[:] for pieces in piece_list[1:]]
+
+
 def cb_pos_to_fen(cb_position, ep_file, is_blacks_turn, w_long, w_short, b_long, b_short, next_move_no):
     """
     turn a position into a FEN string
@@ -298,34 +279,77 @@ def cb_pos_to_fen(cb_position, ep_file, is_blacks_turn, w_long, w_short, b_long,
     return fen
 
 
+@functools.lru_cache(maxsize=4096)
+def decode_setup(setup_bytes):
+    """
+    decodes the 28 bytes that describe the starting position of a game. many games
+    (e.g. studies) share the same starting position, so results are cached. the
+    returned position and piece lists must not be modified, use copy_position
+    :param setup_bytes: the 28 setup bytes (bytes object) that follow the 4 byte game header
+    :return: triple of (FEN string of starting position, cb_position 8x8 array, piece_list)
+    """
+    ep_file = setup_bytes[1] & MASK_EP_FILE
+    black_to_move = (setup_bytes[1] & MASK_TURN) >> 4
+    w_castle_long = setup_bytes[2] & MASK_WHITE_CASTLE_LONG
+    w_castle_short = (setup_bytes[2] & MASK_WHITE_CASTLE_SHORT) >> 1
+    b_castle_long = (setup_bytes[2] & MASK_BLACK_CASTLE_LONG) >> 2
+    b_castle_short = (setup_bytes[2] & MASK_BLACK_CASTLE_SHORT) >> 3
+    next_move_no = setup_bytes[3]
+    cb_position, piece_list = decode_piece_locations(setup_bytes[4:28])
+    # turn into FEN
+    fen = cb_pos_to_fen(cb_position, ep_file, black_to_move,
+                        w_castle_long, w_castle_short, b_castle_long, b_castle_short, next_move_no)
+    return fen, cb_position, piece_list
+
+
 def decode_start_position(cbg_file, offset):
     """
     decodes a starting position in a cbg file (if the game does not start
     with the initial position)
-    :param cbg_file: the (memory mapped) cbg file
+    :param cbg_file: the (memory mapped) cbg file, or a memoryview of it
     :param offset: offset (start of the game bytes) into the cbg file
     :return: triple of (FEN string of starting position, cb_position 8x8 array, piece_list)
     """
     # the information about the startup position are at game offset + 4
-    ep_file = cbg_file[offset + 4 + 1] & MASK_EP_FILE
-    black_to_move = (cbg_file[offset + 4 + 1] & MASK_TURN) >> 4
-    w_castle_long = cbg_file[offset + 4 + 2] & MASK_WHITE_CASTLE_LONG
-    w_castle_short = (cbg_file[offset + 4 + 2] & MASK_WHITE_CASTLE_SHORT) >> 1
-    b_castle_long = (cbg_file[offset + 4 + 2] & MASK_BLACK_CASTLE_LONG) >> 2
-    b_castle_short = (cbg_file[offset + 4 + 2] & MASK_BLACK_CASTLE_SHORT) >> 3
-    next_move_no = cbg_file[offset + 4 + 3]
-    setup_bitstream = cbg_file[offset + 8:offset + 8 + 24]
-    # decode the bitstream
-    setup_bits = ""
-    for i in (range(0, len(setup_bitstream))):
-        setup_bits += format(setup_bitstream[i], '08b')
-    cb_position, piece_list = decode_piece_locations(setup_bits)
-    # turn into FEN
-    fen = cb_pos_to_fen(cb_position, ep_file, black_to_move,
-                        w_castle_long, w_castle_short, b_castle_long, b_castle_short, next_move_no)
+    fen, cb_position, piece_list = decode_setup(bytes(cbg_file[offset + 4:offset + 4 + 28]))
+    cb_position, piece_list = copy_position(cb_position, piece_list)
     return fen, cb_position, piece_list
 
 
+def initial_position():
+    """
+    creates the position and piece lists of the initial position
+    :return: tuple of (cb_position 8x8 array, piece_list)
+    """
+    # number denotes the 0th, the 1st, 2nd ... piece of one kind (e.g. 0th white rook in upper left corner
+    # 1st white rook in lower left corner
+    cb_position = [
+        [(W_ROOK, 0), (W_PAWN, 0), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 0), (B_ROOK, 0)],
+        [(W_KNIGHT, 0), (W_PAWN, 1), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 1), (B_KNIGHT, 0)],
+        [(W_BISHOP, 0), (W_PAWN, 2), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 2), (B_BISHOP, 0)],
+        [(W_QUEEN, 0), (W_PAWN, 3), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 3), (B_QUEEN, 0)],
+        [(W_KING, None), (W_PAWN, 4), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 4), (B_KING, None)],
+        [(W_BISHOP, 1), (W_PAWN, 5), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 5), (B_BISHOP, 1)],
+        [(W_KNIGHT, 1), (W_PAWN, 6), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 6), (B_KNIGHT, 1)],
+        [(W_ROOK, 1), (W_PAWN, 7), (0, None), (0, None), (0, None), (0, None), (B_PAWN, 7), (B_ROOK, 1)]
+    ]
+    piece_list = [None,
+                  [(3, 0), None, None, None, None, None, None, None],  # white queen on (3,0)
+                  [(1, 0), (6, 0), None, None, None, None, None, None],
+                  # first white knight on (1,0), second one on (6,0)
+                  [(2, 0), (5, 0), None, None, None, None, None, None],  # white bishops
+                  [(0, 0), (7, 0), None, None, None, None, None, None],  # white rooks
+                  [(3, 7), None, None, None, None, None, None, None],  # black queens
+                  [(1, 7), (6, 7), None, None, None, None, None, None],  # black knights
+                  [(2, 7), (5, 7), None, None, None, None, None, None],  # black bishops
+                  [(0, 7), (7, 7), None, None, None, None, None, None],  # black rooks
+                  [(4, 0)],  # white king
+                  [(4, 7)],  # black king
+                  [(0, 1), (1, 1), (2, 1), (3, 1), (4, 1), (5, 1), (6, 1), (7, 1)],  # white pawns
+                  [(0, 6), (1, 6), (2, 6), (3, 6), (4, 6), (5, 6), (6, 6), (7, 6)]]  # black pawns
+    return cb_position, piece_list
+
+
 # CB one byte codes for movements
 # (x,y) denotes the x and y movement of the
 # corresponding piece
@@ -629,6 +653,122 @@ CB_PAWN_H_ENC = {
     0x19: (-1, 1)
 }
 
+# all one byte encodings, in the order in which they are looked up,
+# together with the moved piece type (white, black) and piece nr
+CB_ENC_PIECES = [
+    (CB_KING_ENC, W_KING, B_KING, 0),
+    (CB_QUEEN_1_ENC, W_QUEEN, B_QUEEN, 0),
+    (CB_QUEEN_2_ENC, W_QUEEN, B_QUEEN, 1),
+    (CB_QUEEN_3_ENC, W_QUEEN, B_QUEEN, 2),
+    (CB_ROOK_1_ENC, W_ROOK, B_ROOK, 0),
+    (CB_ROOK_2_ENC, W_ROOK, B_ROOK, 1),
+    (CB_ROOK_3_ENC, W_ROOK, B_ROOK, 2),
+    (CB_BISHOP_1_ENC, W_BISHOP, B_BISHOP, 0),
+    (CB_BISHOP_2_ENC, W_BISHOP, B_BISHOP, 1),
+    (CB_BISHOP_3_ENC, W_BISHOP, B_BISHOP, 2),
+    (CB_KNIGHT_1_ENC, W_KNIGHT, B_KNIGHT, 0),
+    (CB_KNIGHT_2_ENC, W_KNIGHT, B_KNIGHT, 1),
+    (CB_KNIGHT_3_ENC, W_KNIGHT, B_KNIGHT, 2),
+    (CB_PAWN_A_ENC, W_PAWN, B_PAWN, 0),
+    (CB_PAWN_B_ENC, W_PAWN, B_PAWN, 1),
+    (CB_PAWN_C_ENC, W_PAWN, B_PAWN, 2),
+    (CB_PAWN_D_ENC, W_PAWN, B_PAWN, 3),
+    (CB_PAWN_E_ENC, W_PAWN, B_PAWN, 4),
+    (CB_PAWN_F_ENC, W_PAWN, B_PAWN, 5),
+    (CB_PAWN_G_ENC, W_PAWN, B_PAWN, 6),
+    (CB_PAWN_H_ENC, W_PAWN, B_PAWN, 7)
+]
+
+# rook relocation for castles: (rook type, rook source square, rook target square)
+CASTLING_ROOKS = {
+    (W_KING, 0x76): (W_ROOK, (7, 0), (5, 0)),  # castles short
+    (W_KING, 0xB5): (W_ROOK, (0, 0), (3, 0)),  # castles long
+    (B_KING, 0x76): (B_ROOK, (7, 7), (5, 7)),
+    (B_KING, 0xB5): (B_ROOK, (0, 7), (3, 7))
+}
+
+@functools.lru_cache(maxsize=None)
+def make_move_targets(add_x, add_y):
+    """
+    precompute the target squares of a one byte encoded move for all source squares.
+    the result is cached, tokens that encode the same movement share it
+    :param add_x: movement in x direction
+    :param add_y: movement in y direction
+    :return: 8x8 array; entry [x][y] is a pair (x1, y1) for source square (x,y)
+    """
+    targets = []
+    for x in range(0, 8):
+        row = []
+        for y in range(0, 8):
+            row.append(((x + add_x) % 8, (y + add_y) % 8))
+        targets.append(row)
+    return targets
+
+
+def make_token_moves():
+    """
+    precompute for each (de-obfuscated) token the one byte move it encodes
+    :return: list indexed by token. entries are None for tokens that don't encode a one byte
+             move, otherwise a pair (move if white is to move, move if black is to move), each of
+             the form (piece type, piece nr, targets as computed by make_move_targets,
+             castling rook relocation or None)
+    """
+    token_moves = [None for x in range(0, 256)]
+    for cb_enc_arr, w_piece_type, b_piece_type, piece_nr in CB_ENC_PIECES:
+        for tkn, (add_x, add_y) in cb_enc_arr.items():
+            if token_moves[tkn] is not None:
+                continue
+            w_targets = make_move_targets(add_x, add_y)
+            if b_piece_type == B_PAWN:
+                # pawn moves are always encoded from the pawn's
+                # own perspective, revert direction for black
+                b_targets = make_move_targets(-add_x, -add_y)
+            else:
+                b_targets = w_targets
+            token_moves[tkn] = ((w_piece_type, piece_nr, w_targets, CASTLING_ROOKS.get((w_piece_type, tkn))),
+                                (b_piece_type, piece_nr, b_targets, CASTLING_ROOKS.get((b_piece_type, tkn))))
+    return token_moves
+
+
+# version of the tables in the table cache, increase it when make_token_moves changes
+TABLES_VERSION = 1
+# precomputed tables are loaded from this file, if it is set (see load_tables)
+TABLE_CACHE = os.environ.get("CBH2PGN_TABLE_CACHE")
+
+
+def load_tables(cache_file=None):
+    """
+    build the tables for decoding moves, or load them from a cache file. marshal is used, which
+    loads faster than the tables are built, in particular under PyPy before the JIT kicks in
+    :param cache_file: filename of the cache. if it doesn't exist or was written by another
+                       version, the tables are built and written to it. None = always build them
+    :return: TOKEN_MOVES, see make_token_moves
+    """
+    key = [TABLES_VERSION, marshal.version, sys.implementation.cache_tag]
+    if cache_file is not None:
+        try:
+            with open(cache_file, "rb") as f:
+                # marshal.loads on the whole file is much faster than marshal.load on the file
+                cached_key, token_moves = marshal.loads(f.read())
+            if cached_key == key:
+                return token_moves
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    token_moves = make_token_moves()
+    if cache_file is not None:
+        try:
+            # write to a temporary file first, so that concurrent processes never read a partial cache
+            tmp_file = cache_file + "." + str(os.getpid())
+            with open(tmp_file, "wb") as f:
+                f.write(marshal.dumps([key, token_moves]))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+    return token_moves
+
+
+TOKEN_MOVES = load_tables(TABLE_CACHE)
+
 
 def decrease_piece_nr(piece_list, cb_position, target_piece_type, target_nr):
     """
@@ -644,48 +784,38 @@ def decrease_piece_nr(piece_list, cb_position, target_piece_type, target_nr):
     :param target_nr: n for the n+1th piece of that kind (e.g. 2 for the 3rd white queen)
     :return:
     """
+    pieces = piece_list[target_piece_type]
     # shift all pieces one down
     for nr in range(target_nr, 7):
-        piece_list[target_piece_type][nr] = piece_list[target_piece_type][nr + 1]
-    piece_list[target_piece_type][7] = None
-    # now update position
-    for x in range(0, 8):
-        for y in range(0, 8):
-            p, t = cb_position[x][y]
-            if p == target_piece_type and t > target_nr:
-                cb_position[x][y] = (p, t - 1)
-
-
-# piece_list  : w_queens, w_rooks, ...
-# cb_position : game position
-# piece_type  : W_KING, W_QUEEN, B_KING, B_QUEEN...
-# piece_nr    : number, denotes e.g. first queen (0), second queen (1), ...
-# cb_enc_arr  : one of e.g. CB_QUEENS_1_ENC ...
-# node        : game node of python chess tree
-# tkn         : encoding byte
-# pawn_flip   : true for black pawns (need to consider direction from black's perspective
-#               for pawns, all other pieces have absolute directions
-def do_move(piece_list, piece_type, piece_nr, cb_position, cb_enc_arr, node, tkn, pawn_flip=False):
+        pieces[nr] = pieces[nr + 1]
+    pieces[7] = None
+    # now update position. only the shifted pieces need to be
+    # renumbered, so there is no need to scan the whole board
+    for nr in range(target_nr, 7):
+        square = pieces[nr]
+        if square is None:
+            break
+        x, y = square
+        p, t = cb_position[x][y]
+        if p == target_piece_type and t > target_nr:
+            cb_position[x][y] = (p, t - 1)
+
+
+def do_move(piece_list, piece_type, piece_nr, cb_position, targets, visitor, ply, castling=None):
     """
     apply a one byte encoded move
     :param piece_list: piece list with x,y locations of all pieces
     :param piece_type: type of piece that is moved (e.g. one of W_KING, W_QUEEN, ...)
     :param piece_nr: n denoting the n+1th piece of that type (e.g. 0 for first queen etc.)
     :param cb_position: 8x8 array of tuples; each tuple (x,y) is x = piece_type, y 0th, 1st, 2nd ... of it's kind
-    :param cb_enc_arr: the corresponding CB encoding array, e.g. CB_KNIGHT_1_ENC
-    :param node: current game node of the python-chess game
-    :param tkn: uint8 value of the currently processed token
-    :param pawn_flip: true if this is a pawn move and it is black's turn
-    :return: child node (result of applying the move to node)
+    :param targets: the precomputed targets of the move for each source square (see make_move_targets)
+    :param visitor: Visitor that is told about the move
+    :param ply: ply of the move
+    :param castling: if the move castles, the rook relocation (see CASTLING_ROOKS)
     """
     (i, j) = piece_list[piece_type][piece_nr]
     cb_position[i][j] = (0, None)
-    (add_x, add_y) = cb_enc_arr[tkn]
-    if pawn_flip:
-        add_x = -add_x  # revert direction as pawn moves are always encoded
-        add_y = -add_y  # from own perspective
-    i1 = (i + add_x) % 8
-    j1 = (j + add_y) % 8
+    (i1, j1) = targets[i][j]
     # check what's on target square
     # and manipulate position accordingly
     target_piece_type, target_nr = cb_position[i1][j1]
@@ -700,40 +830,19 @@ def do_move(piece_list, piece_type, piece_nr, cb_position, cb_enc_arr, node, tkn
     # any other piece moving to that square. python-chess
     # will check for legality though
     # if we have castles, move the rook, too
-    if piece_type == W_KING and tkn == 0x76: # castle short
-        cb_position[7][0] = (0, None)
-        for idx in range(0, len(piece_list[W_ROOK])):
-            if piece_list[W_ROOK][idx] == (7,0):
-                piece_list[W_ROOK][idx] = (5,0)
-                cb_position[5][0] = (W_ROOK, idx)
-                break
-    if piece_type == B_KING and tkn == 0x76:  # castle short
-        cb_position[7][7] = (0, None)
-        for idx in range(0, len(piece_list[B_ROOK])):
-            if piece_list[B_ROOK][idx] == (7, 7):
-                piece_list[B_ROOK][idx] = (5, 7)
-                cb_position[5][7] = (B_ROOK, idx)
+    if castling is not None:
+        rook_type, (x, y), (x1, y1) = castling
+        cb_position[x][y] = (0, None)
+        rooks = piece_list[rook_type]
+        for idx in range(0, len(rooks)):
+            if rooks[idx] == (x, y):
+                rooks[idx] = (x1, y1)
+                cb_position[x1][y1] = (rook_type, idx)
                 break
-    if piece_type == W_KING and tkn == 0xB5:  # castle long
-        cb_position[0][0] = (0, None)
-        for idx in range(0, len(piece_list[W_ROOK])):
-            if piece_list[W_ROOK][idx] == (0, 0):
-                piece_list[W_ROOK][idx] = (3, 0)
-                cb_position[3][0] = (W_ROOK, idx)
-                break
-    if piece_type == B_KING and tkn == 0xB5:  # castle long
-        cb_position[0][7] = (0, None)
-        for idx in range(0, len(piece_list[B_ROOK])):
-            if piece_list[B_ROOK][idx] == (0, 7):
-                piece_list[B_ROOK][idx] = (3, 7)
-                cb_position[3][7] = (B_ROOK, idx)
-                break
-    m = chess.Move.from_uci(SQN[i][j] + SQN[i1][j1])
-    node = node.add_variation(m)
-    return node
+    visitor.move(j * 8 + i, j1 * 8 + i1, None, ply)
 
 
-def do_2b_move(piece_list, i, j, i1, j1, cb_position, node, cb_promotion_code):
+def do_2b_move(piece_list, i, j, i1, j1, cb_position, visitor, ply, cb_promotion_code):
     """
     execute a two-byte encoded move. 2b moves are usually for pawn promotions
     and when the fourth kind of one piece type is moved (e.g. fourth white queen)
@@ -743,9 +852,9 @@ def do_2b_move(piece_list, i, j, i1, j1, cb_position, node, cb_promotion_code):
     :param i1: file of target square
     :param j1: rank of target square
     :param cb_position: 8x8 array of tuples; each tuple (x,y) is x = piece_type, y 0th, 1st, 2nd ... of it's kind
-    :param node: current game node
+    :param visitor: Visitor that is told about the move
+    :param ply: ply of the move
     :param cb_promotion_code: 0 = queen, 1 = rook, 2 = bishop, 3 = knight
-    :return: child node (result of applying the move to node)
     """
     piece_type, piece_nr = cb_position[i][j]
     cb_position[i][j] = (0, None)
@@ -755,7 +864,7 @@ def do_2b_move(piece_list, i, j, i1, j1, cb_position, node, cb_promotion_code):
     if target_piece_type != 0 and target_piece_type != W_KING and target_piece_type != B_KING \
             and target_piece_type != W_PAWN and target_piece_type != B_PAWN:
         decrease_piece_nr(piece_list, cb_position, target_piece_type, target_nr)
-    promotion_str = ""
+    promotion = None
     promoted_piece_type = 0
     if piece_type != W_PAWN and piece_type != B_PAWN:
         # we just assume that two byte encodings never happen for
@@ -768,43 +877,51 @@ def do_2b_move(piece_list, i, j, i1, j1, cb_position, node, cb_promotion_code):
         if piece_type == W_PAWN and j1 == 7:
             if cb_promotion_code == 0:
                 promoted_piece_type = W_QUEEN
-                promotion_str += "q"
+                promotion = PROMOTE_QUEEN
             elif cb_promotion_code == 1:
                 promoted_piece_type = W_ROOK
-                promotion_str += "r"
+                promotion = PROMOTE_ROOK
             elif cb_promotion_code == 2:
                 promoted_piece_type = W_BISHOP
-                promotion_str += "b"
+                promotion = PROMOTE_BISHOP
             elif cb_promotion_code == 3:
                 promoted_piece_type = W_KNIGHT
-                promotion_str += "n"
+                promotion = PROMOTE_KNIGHT
             else:
                 raise ValueError("unknown promotion piece type")
         if piece_type == B_PAWN and j1 == 0:
             if cb_promotion_code == 0:
                 promoted_piece_type = B_QUEEN
-                promotion_str += "q"
+                promotion = PROMOTE_QUEEN
             elif cb_promotion_code == 1:
                 promoted_piece_type = B_ROOK
-                promotion_str += "r"
+                promotion = PROMOTE_ROOK
             elif cb_promotion_code == 2:
                 promoted_piece_type = B_BISHOP
-                promotion_str += "b"
+                promotion = PROMOTE_BISHOP
             elif cb_promotion_code == 3:
                 promoted_piece_type = B_KNIGHT
-                promotion_str += "n"
+                promotion = PROMOTE_KNIGHT
             else:
                 raise ValueError("unknown promotion piece type")
     if promoted_piece_type != 0:
-        # find first free piece nr
-        for free_idx in range(0,8):
-            if piece_list[promoted_piece_type][free_idx] is None:
-                break
-        piece_list[promoted_piece_type][free_idx] = (i1,j1)
+        # find first free piece nr. pieces are always shifted down
+        # when one is removed, so there are no gaps in the piece list
+        pieces = piece_list[promoted_piece_type]
+        if None in pieces:
+            free_idx = pieces.index(None)
+        else:
+            free_idx = 7
+        pieces[free_idx] = (i1,j1)
         cb_position[i1][j1] = (promoted_piece_type, free_idx)
-    m = chess.Move.from_uci(SQN[i][j] + SQN[i1][j1] + promotion_str)
-    node = node.add_variation(m)
-    return node
+    visitor.move(j * 8 + i, j1 * 8 + i1, promotion, ply)
+
+
+# python-chess piece types of promotions (chess.QUEEN, ...)
+PROMOTE_QUEEN = 5
+PROMOTE_ROOK = 4
+PROMOTE_BISHOP = 3
+PROMOTE_KNIGHT = 2
 
 
 # de-obfuscation of 2 byte encoded moves
@@ -890,23 +1007,464 @@ def print_cb_position(cb_pos):
         print(s)
 
 
-def decode(game_bytes, cb_position, piece_list, fen=None):
+def skip_variation(game_bytes, idx, processed_moves):
     """
-    decodes a game of a cbg file
+    skips over the tokens of a variation without decoding them. nested
+    variations are skipped as well, but the processed move counter is
+    kept up to date, as it is needed to de-obfuscate all following bytes
     :param game_bytes: the byte sequence (uint8 array) of the cb encoded game
+    :param idx: index of the first token of the variation
+    :param processed_moves: value of the processed move counter at idx
+    :return: triple of (index of the 0x0C token that ends the variation, processed move counter at that index,
+             number of moves that were skipped)
+    """
+    nesting = 0
+    moves = 0
+    while idx < len(game_bytes):
+        tkn = (game_bytes[idx] - processed_moves) % 256
+        if tkn == 0x29:
+            # two byte move, the following two bytes don't count as moves
+            processed_moves += 1
+            processed_moves %= 256
+            moves += 1
+            idx += 3
+            continue
+        if tkn == 0x0C:
+            if nesting == 0:
+                return idx, processed_moves, moves
+            nesting -= 1
+        elif tkn == 0xDC:
+            nesting += 1
+        elif tkn != 0x9F:
+            processed_moves += 1
+            processed_moves %= 256
+            moves += 1
+        idx += 1
+    return idx, processed_moves, moves
+
+
+# number of plies after which the time limit of a game is checked
+LIMIT_CHECK_INTERVAL = 256
+
+
+class Limits:
+    """
+    limits for decoding a single game, to protect against corrupted games.
+    games that exceed any of them are not decoded any further and skipped
+    """
+
+    def __init__(self, max_tokens=None, max_plies=None, max_nesting=None, max_seconds=None):
+        """
+        :param max_tokens: maximum length of the encoded moves in bytes
+        :param max_plies: maximum number of moves, including moves of variations
+        :param max_nesting: maximum number of variations that are open at the same time
+        :param max_seconds: maximum time for decoding the game
+        (None = unlimited)
+        """
+        self.max_tokens = max_tokens
+        self.max_plies = max_plies
+        self.max_nesting = max_nesting
+        self.max_seconds = max_seconds
+
+
+class LimitExceeded(Exception):
+    pass
+
+
+class Visitor:
+    """
+    receives the contents of a game while it is decoded, see visit. all methods do nothing;
+    subclasses override the ones they need. the calls for a game are
+
+        begin_game()
+        header(name, value)    for each tag (FEN and SetUp first, if the game has a setup position)
+        cached_opening(...)    if the first moves were found in the opening cache
+        comment(...), nags(...)    for the annotations before the first move, if any
+        move(...), null_move(...), begin_variation(), end_variation()    in the order of the moves,
+                               each move followed by comment(...) and nags(...) for its annotations
+        end_game()
+
+    the moves are not stored in a tree, so a visitor that doesn't build one allocates nothing per move
+    """
+
+    def begin_game(self):
+        pass
+
+    def header(self, name, value):
+        """
+        :param name: tag name, e.g. "White"
+        :param value: tag value
+        """
+        pass
+
+    def move(self, from_square, to_square, promotion, ply):
+        """
+        a move from the current position. the moves are not checked for legality
+        :param from_square: source square, numbered like in python-chess (0 = a1, 1 = b1, ..., 63 = h8)
+        :param to_square: target square
+        :param promotion: python-chess piece type of a promotion (e.g. chess.QUEEN = PROMOTE_QUEEN), otherwise None
+        :param ply: number of the move, counted in half moves from the start position
+                    (1 = first move of the game). the first move of a variation has the same
+                    ply as the move it replaces
+        """
+        pass
+
+    def null_move(self, ply):
+        """
+        :param ply: see move
+        """
+        pass
+
+    def cached_opening(self, node):
+        """
+        the first moves of the game were found in the opening cache (see opening.OpeningCache),
+        and were not decoded again. by default, they are passed to move one by one
+        :param node: opening.OpeningNode of the position after these moves
+        """
+        for ply, (from_square, to_square) in enumerate(node.moves(), 1):
+            self.move(from_square, to_square, None, ply)
+
+    def comment(self, text, before_move=False):
+        """
+        a text annotation of the last move, or of the game if no move was made yet
+        :param text: the text
+        :param before_move: the text belongs in front of the last move, not after it
+        """
+        pass
+
+    def nags(self, nags):
+        """
+        symbols of the last move (e.g. 1 = "!") or of the position after it (e.g. 18 = "+-")
+        :param nags: list of numeric annotation glyphs
+        """
+        pass
+
+    def begin_variation(self):
+        """
+        the current position has more than one continuation. the moves up to the matching
+        end_variation are the first of them (e.g. the main line), after end_variation the moves
+        continue from this position again, with the next continuation
+        """
+        pass
+
+    def end_variation(self):
+        pass
+
+    def end_game(self):
+        pass
+
+
+class TeeVisitor(Visitor):
+    """
+    passes everything to several visitors, e.g. to build a game tree and to collect statistics while
+    decoding the game only once
+    """
+
+    def __init__(self, visitors):
+        """
+        :param visitors: list of Visitor, called in this order
+        """
+        self.visitors = visitors
+
+    def begin_game(self):
+        for visitor in self.visitors:
+            visitor.begin_game()
+
+    def header(self, name, value):
+        for visitor in self.visitors:
+            visitor.header(name, value)
+
+    def move(self, from_square, to_square, promotion, ply):
+        for visitor in self.visitors:
+            visitor.move(from_square, to_square, promotion, ply)
+
+    def null_move(self, ply):
+        for visitor in self.visitors:
+            visitor.null_move(ply)
+
+    def cached_opening(self, node):
+        for visitor in self.visitors:
+            visitor.cached_opening(node)
+
+    def comment(self, text, before_move=False):
+        for visitor in self.visitors:
+            visitor.comment(text, before_move)
+
+    def nags(self, nags):
+        for visitor in self.visitors:
+            visitor.nags(nags)
+
+    def begin_variation(self):
+        for visitor in self.visitors:
+            visitor.begin_variation()
+
+    def end_variation(self):
+        for visitor in self.visitors:
+            visitor.end_variation()
+
+    def end_game(self):
+        for visitor in self.visitors:
+            visitor.end_game()
+
+
+class Recorder(Visitor):
+    """
+    records the calls for a game as a list of (method name, arguments), so that they can be passed to
+    another visitor later (see replay), e.g. in another thread. moves from the opening cache are
+    recorded as single moves
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def begin_game(self):
+        self.calls = [("begin_game", ())]
+
+    def header(self, name, value):
+        self.calls.append(("header", (name, value)))
+
+    def move(self, from_square, to_square, promotion, ply):
+        self.calls.append(("move", (from_square, to_square, promotion, ply)))
+
+    def null_move(self, ply):
+        self.calls.append(("null_move", (ply,)))
+
+    def comment(self, text, before_move=False):
+        self.calls.append(("comment", (text, before_move)))
+
+    def nags(self, nags):
+        self.calls.append(("nags", (nags,)))
+
+    def begin_variation(self):
+        self.calls.append(("begin_variation", ()))
+
+    def end_variation(self):
+        self.calls.append(("end_variation", ()))
+
+    def end_game(self):
+        self.calls.append(("end_game", ()))
+
+
+def replay(calls, visitor, headers=()):
+    """
+    pass recorded calls to a visitor
+    :param calls: Recorder.calls of a game
+    :param visitor: Visitor
+    :param headers: (tag name, value) pairs that are passed after the recorded headers
+    """
+    pending = headers
+    for name, args in calls:
+        if len(pending) > 0 and name != "begin_game" and name != "header":
+            for tag, value in pending:
+                visitor.header(tag, value)
+            pending = ()
+        getattr(visitor, name)(*args)
+
+
+def join_comments(comment, text):
+    return text if comment == "" else comment + " " + text
+
+
+def annotate(visitor, annotation):
+    """
+    pass the annotations of a move to a visitor
+    :param annotation: triple of (text in front of the move or None, text after the move or None, list of NAGs)
+    """
+    before, after, nags = annotation
+    if before is not None:
+        visitor.comment(before, True)
+    if after is not None:
+        visitor.comment(after)
+    if len(nags) > 0:
+        visitor.nags(nags)
+
+
+class GameBuilder(Visitor):
+    """
+    builds a python-chess game (tree) of the visited game, see decode
+    """
+
+    def __init__(self, resume_openings=False):
+        """
+        :param resume_openings: if the first moves of a game were found in the opening cache, the
+                                game starts at the position after them (it is set up with its FEN),
+                                and opening_node is set. only useful together with the movetext
+                                stored in the cache, see database.Database.render_game
+        """
+        import_chess()
+        self.resume_openings = resume_openings
+        self.game = None
+        self.node = None
+        self.stack = []
+        self.opening_node = None
+
+    def begin_game(self):
+        self.game = chess.pgn.Game()
+        self.node = self.game
+        self.stack = []
+        self.opening_node = None
+
+    def cached_opening(self, node):
+        if not self.resume_openings:
+            super().cached_opening(node)
+            return
+        self.game.setup(node.pgn()[0])
+        self.opening_node = node
+
+    def header(self, name, value):
+        if name == "FEN":
+            # also sets SetUp
+            self.game.setup(value)
+        else:
+            self.game.headers[name] = value
+
+    def move(self, from_square, to_square, promotion, ply):
+        if promotion is None:
+            m = SQUARE_MOVES[from_square][to_square]
+        else:
+            m = chess.Move(from_square, to_square, promotion=promotion)
+        self.node = self.node.add_variation(m)
+
+    def null_move(self, ply):
+        self.node = self.node.add_variation(chess.Move.null())
+
+    def comment(self, text, before_move=False):
+        node = self.node
+        parent = node.parent
+        if before_move and parent is not None:
+            if parent.variations[0] is node:
+                # in front of the move is the same as after the previous one
+                node = parent
+            else:
+                # the first move of a variation
+                node.starting_comment = join_comments(node.starting_comment, text)
+                return
+        node.comment = join_comments(node.comment, text)
+
+    def nags(self, nags):
+        self.node.nags.update(nags)
+
+    def begin_variation(self):
+        self.stack.append(self.node)
+
+    def end_variation(self):
+        self.node = self.stack.pop()
+
+
+# SQUARE_MOVES[from_square][to_square] is the python-chess move from from_square to to_square,
+# built by import_chess
+SQUARE_MOVES = None
+
+
+def import_chess():
+    """
+    import python-chess (once) and build the tables that need it
+    :return: the chess module, with chess.pgn imported
+    """
+    global chess, SQUARE_MOVES
+    if chess is None:
+        import chess.pgn
+        SQUARE_MOVES = [[chess.Move(from_square, to_square) for to_square in chess.SQUARES]
+                        for from_square in chess.SQUARES]
+    return chess
+
+
+def visit(game_bytes, cb_position, piece_list, visitor, fen=None, headers=(), max_variation_depth=None,
+          limits=None, opening_cache=None, annotations=None):
+    """
+    decodes a game of a cbg file and passes its contents to a visitor
+    :param game_bytes: the byte sequence (uint8 array, e.g. a memoryview of the cbg file) of the cb encoded game
     :param cb_position: starting position (8x8 array of tuples; each tuple (x,y) is x = piece_type, y 0th, 1st, 2nd ... of it's kind)
     :param piece_list: piece list with (x,y) locations for each piece type
+    :param visitor: Visitor
     :param fen: FEN string of the starting position. If not supplied we assume the starting position
-    :return: python chess game (tree)
+    :param headers: (tag name, value) pairs that are passed to the visitor before the moves
+    :param max_variation_depth: variations nested deeper than this are skipped (0 = main line only).
+                                If not supplied, all variations are decoded
+    :param limits: Limits for this game. If the game exceeds them, LimitExceeded is raised (and
+                   end_game is not called)
+    :param opening_cache: opening.OpeningCache. if supplied, games that start with the initial position
+                          are decoded from the deepest position in the cache on, and their first moves
+                          are added to it
+    :param annotations: annotations of the game, as dict of the position (number of moves in the order
+                        they are encoded, including moves of variations, 0 = start of the game) to
+                        the annotations at that position, see annotation.parse_annotations
+    :return: error message or None. after an error, the moves up to the error have been visited
     """
+    max_plies = None
+    max_nesting = None
+    deadline = None
+    if limits is not None:
+        if limits.max_tokens is not None and len(game_bytes) > limits.max_tokens:
+            raise LimitExceeded("more than " + str(limits.max_tokens) + " bytes of moves")
+        max_plies = limits.max_plies
+        max_nesting = limits.max_nesting
+        if limits.max_seconds is not None:
+            deadline = time.monotonic() + limits.max_seconds
+
+    def check_limits(plies):
+        """
+        :return: the ply count at which the limits have to be checked next time
+        """
+        if max_plies is not None and plies > max_plies:
+            raise LimitExceeded("more than " + str(max_plies) + " plies")
+        if deadline is not None and time.monotonic() > deadline:
+            raise LimitExceeded("decoding took longer than " + str(limits.max_seconds) + "s")
+        next_check = sys.maxsize
+        if max_plies is not None:
+            next_check = max_plies + 1
+        if deadline is not None:
+            next_check = min(next_check, plies + LIMIT_CHECK_INTERVAL)
+        return next_check
+
+    # all moves of the game, including variations
+    plies = 0
+    # moves of variations that were skipped. together with plies, this is the position of a move
+    # that annotations refer to
+    skipped_moves = 0
+    next_check = check_limits(plies)
+    # each stack entry stores the position, piece list, side to move and ply at
+    # the start of a variation, and the variation depth of the line that contains it.
+    # if the variation won't be decoded anyway, position and piece list are None
     stack = []
+    depth = 0
     processed_moves = 0
-    game = chess.pgn.Game()
+    # keep track of the side to move ourselves
+    white_to_move = True
+    # ply of the last move of the current line
+    ply = 0
+    visitor.begin_game()
     if fen is not None:
-        board = chess.Board(fen)
-        game.setup(board)
-    node = game
+        visitor.header("FEN", fen)
+        visitor.header("SetUp", "1")
+        white_to_move = fen.split(" ")[1] == "w"
+    for name, value in headers:
+        visitor.header(name, value)
     idx = 0
+    # moves up to this ply may be taken from the opening cache. the movetext of the cached
+    # moves is taken from the cache, too, so it must not contain annotated moves
+    max_cached_ply = None
+    if annotations is not None and len(annotations) == 0:
+        annotations = None
+    if annotations is not None:
+        if 0 in annotations:
+            annotate(visitor, annotations[0])
+        max_cached_ply = min(annotations) - 2
+    # node of the opening cache of the current position, as long as all moves so far were one byte moves
+    opening = None
+    if opening_cache is not None and fen is None:
+        opening = opening_cache.lookup(game_bytes, max_cached_ply)
+        if opening.ply > 0:
+            cb_position, piece_list = opening.position()
+            ply = opening.ply
+            plies = ply
+            if plies >= next_check:
+                next_check = check_limits(plies)
+            # all tokens up to here were moves
+            idx = ply
+            processed_moves = ply % 256
+            white_to_move = ply % 2 == 0
+            visitor.cached_opening(opening)
     err_string = None
     try:
         while idx < len(game_bytes):
@@ -921,23 +1479,34 @@ def decode(game_bytes, cb_position, piece_list, fen=None):
                 idx += 1
                 continue
             if tkn == 0xAA:  # null move, don't increase processed move counter
-                node = node.add_variation(chess.Move.null())
+                opening = None
+                ply += 1
+                visitor.null_move(ply)
+                white_to_move = not white_to_move
+                plies += 1
+                if annotations is not None and plies + skipped_moves in annotations:
+                    annotate(visitor, annotations[plies + skipped_moves])
+                if plies >= next_check:
+                    next_check = check_limits(plies)
                 idx += 1
                 continue
             if tkn == 0x29: # latch to two byte move
-                tmp = [None, None]
-                tmp[0] = DEOBFUSCATE_2B[game_bytes[idx+1] - processed_moves]
-                tmp[1] = DEOBFUSCATE_2B[game_bytes[idx+2] - processed_moves]
-                tmp_uint16 = struct.unpack(">H", bytes(tmp))
-                if len(tmp_uint16) < 1:
-                    raise ValueError("Error decoding 2b move: "+str(tmp_uint16))
-                move_2b = tmp_uint16[0]
+                # big endian uint16
+                move_2b = (DEOBFUSCATE_2B[game_bytes[idx+1] - processed_moves] << 8) \
+                    | DEOBFUSCATE_2B[game_bytes[idx+2] - processed_moves]
                 src = move_2b & 0x3F
                 dst = (move_2b >> 6) & 0x3F
                 promotion_piece = (move_2b >> 12) & 0x3
                 x, y = ABS_TO_XY[src]
                 x1, y1 = ABS_TO_XY[dst]
-                node = do_2b_move(piece_list, x, y, x1, y1, cb_position, node, promotion_piece)
+                ply += 1
+                do_2b_move(piece_list, x, y, x1, y1, cb_position, visitor, ply, promotion_piece)
+                white_to_move = not white_to_move
+                plies += 1
+                if annotations is not None and plies + skipped_moves in annotations:
+                    annotate(visitor, annotations[plies + skipped_moves])
+                if plies >= next_check:
+                    next_check = check_limits(plies)
                 processed_moves += 1
                 processed_moves %= 256
                 # skip next two bytes (they stored the 2b move, and
@@ -945,101 +1514,78 @@ def decode(game_bytes, cb_position, piece_list, fen=None):
                 idx += 3
                 continue
             if tkn == 0xDC: # start of variation, push to stack
-                stack.append((node, copy.deepcopy(cb_position), copy.deepcopy(piece_list)))
+                if max_nesting is not None and len(stack) >= max_nesting:
+                    raise LimitExceeded("more than " + str(max_nesting) + " nested variations")
+                if deadline is not None:
+                    check_limits(plies)
+                if max_variation_depth is None or depth < max_variation_depth:
+                    stack.append(copy_position(cb_position, piece_list) + (depth, white_to_move, ply))
+                    visitor.begin_variation()
+                else:
+                    # the alternative line after the 0x0C will be skipped,
+                    # no need to copy anything
+                    stack.append((None, None, depth, white_to_move, ply))
             if tkn == 0x0C: # end of variation, pop from stack and continue
                 # every game is terminated with 0x0C -> ignore last
                 # otherwise pop from stack
                 if idx < (len(game_bytes) - 1):
-                    node, cb_position, piece_list = stack.pop()
-            if node.board().turn == chess.WHITE:
-                if tkn in CB_KING_ENC:
-                    node = do_move(piece_list, W_KING, 0, cb_position, CB_KING_ENC, node, tkn)
-                elif tkn in CB_QUEEN_1_ENC:
-                    node = do_move(piece_list, W_QUEEN, 0, cb_position, CB_QUEEN_1_ENC, node, tkn)
-                elif tkn in CB_QUEEN_2_ENC:
-                    node = do_move(piece_list, W_QUEEN, 1, cb_position, CB_QUEEN_2_ENC, node, tkn)
-                elif tkn in CB_QUEEN_3_ENC:
-                    node = do_move(piece_list, W_QUEEN, 2, cb_position, CB_QUEEN_3_ENC, node, tkn)
-                elif tkn in CB_ROOK_1_ENC:
-                    node = do_move(piece_list, W_ROOK, 0, cb_position, CB_ROOK_1_ENC, node, tkn)
-                elif tkn in CB_ROOK_2_ENC:
-                    node = do_move(piece_list, W_ROOK, 1, cb_position, CB_ROOK_2_ENC, node, tkn)
-                elif tkn in CB_ROOK_3_ENC:
-                    node = do_move(piece_list, W_ROOK, 2, cb_position, CB_ROOK_3_ENC, node, tkn)
-                elif tkn in CB_BISHOP_1_ENC:
-                    node = do_move(piece_list, W_BISHOP, 0, cb_position, CB_BISHOP_1_ENC, node, tkn)
-                elif tkn in CB_BISHOP_2_ENC:
-                    node = do_move(piece_list, W_BISHOP, 1, cb_position, CB_BISHOP_2_ENC, node, tkn)
-                elif tkn in CB_BISHOP_3_ENC:
-                    node = do_move(piece_list, W_BISHOP, 2, cb_position, CB_BISHOP_3_ENC, node, tkn)
-                elif tkn in CB_KNIGHT_1_ENC:
-                    node = do_move(piece_list, W_KNIGHT, 0, cb_position, CB_KNIGHT_1_ENC, node, tkn)
-                elif tkn in CB_KNIGHT_2_ENC:
-                    node = do_move(piece_list, W_KNIGHT, 1, cb_position, CB_KNIGHT_2_ENC, node, tkn)
-                elif tkn in CB_KNIGHT_3_ENC:
-                    node = do_move(piece_list, W_KNIGHT, 2, cb_position, CB_KNIGHT_3_ENC, node, tkn)
-                elif tkn in CB_PAWN_A_ENC:
-                    node = do_move(piece_list, W_PAWN, 0, cb_position, CB_PAWN_A_ENC, node, tkn)
-                elif tkn in CB_PAWN_B_ENC:
-                    node = do_move(piece_list, W_PAWN, 1, cb_position, CB_PAWN_B_ENC, node, tkn)
-                elif tkn in CB_PAWN_C_ENC:
-                    node = do_move(piece_list, W_PAWN, 2, cb_position, CB_PAWN_C_ENC, node, tkn)
-                elif tkn in CB_PAWN_D_ENC:
-                    node = do_move(piece_list, W_PAWN, 3, cb_position, CB_PAWN_D_ENC, node, tkn)
-                elif tkn in CB_PAWN_E_ENC:
-                    node = do_move(piece_list, W_PAWN, 4, cb_position, CB_PAWN_E_ENC, node, tkn)
-                elif tkn in CB_PAWN_F_ENC:
-                    node = do_move(piece_list, W_PAWN, 5, cb_position, CB_PAWN_F_ENC, node, tkn)
-                elif tkn in CB_PAWN_G_ENC:
-                    node = do_move(piece_list, W_PAWN, 6, cb_position, CB_PAWN_G_ENC, node, tkn)
-                elif tkn in CB_PAWN_H_ENC:
-                    node = do_move(piece_list, W_PAWN, 7, cb_position, CB_PAWN_H_ENC, node, tkn)
-            else:
-                if tkn in CB_KING_ENC:
-                    node = do_move(piece_list, B_KING, 0, cb_position, CB_KING_ENC, node, tkn)
-                elif tkn in CB_QUEEN_1_ENC:
-                    node = do_move(piece_list, B_QUEEN, 0, cb_position, CB_QUEEN_1_ENC, node, tkn)
-                elif tkn in CB_QUEEN_2_ENC:
-                    node = do_move(piece_list, B_QUEEN, 1, cb_position, CB_QUEEN_2_ENC, node, tkn)
-                elif tkn in CB_QUEEN_3_ENC:
-                    node = do_move(piece_list, B_QUEEN, 2, cb_position, CB_QUEEN_3_ENC, node, tkn)
-                elif tkn in CB_ROOK_1_ENC:
-                    node = do_move(piece_list, B_ROOK, 0, cb_position, CB_ROOK_1_ENC, node, tkn)
-                elif tkn in CB_ROOK_2_ENC:
-                    node = do_move(piece_list, B_ROOK, 1, cb_position, CB_ROOK_2_ENC, node, tkn)
-                elif tkn in CB_ROOK_3_ENC:
-                    node = do_move(piece_list, B_ROOK, 2, cb_position, CB_ROOK_3_ENC, node, tkn)
-                elif tkn in CB_BISHOP_1_ENC:
-                    node = do_move(piece_list, B_BISHOP, 0, cb_position, CB_BISHOP_1_ENC, node, tkn)
-                elif tkn in CB_BISHOP_2_ENC:
-                    node = do_move(piece_list, B_BISHOP, 1, cb_position, CB_BISHOP_2_ENC, node, tkn)
-                elif tkn in CB_BISHOP_3_ENC:
-                    node = do_move(piece_list, B_BISHOP, 2, cb_position, CB_BISHOP_3_ENC, node, tkn)
-                elif tkn in CB_KNIGHT_1_ENC:
-                    node = do_move(piece_list, B_KNIGHT, 0, cb_position, CB_KNIGHT_1_ENC, node, tkn)
-                elif tkn in CB_KNIGHT_2_ENC:
-                    node = do_move(piece_list, B_KNIGHT, 1, cb_position, CB_KNIGHT_2_ENC, node, tkn)
-                elif tkn in CB_KNIGHT_3_ENC:
-                    node = do_move(piece_list, B_KNIGHT, 2, cb_position, CB_KNIGHT_3_ENC, node, tkn)
-                elif tkn in CB_PAWN_A_ENC:
-                    node = do_move(piece_list, B_PAWN, 0, cb_position, CB_PAWN_A_ENC, node, tkn, pawn_flip=True)
-                elif tkn in CB_PAWN_B_ENC:
-                    node = do_move(piece_list, B_PAWN, 1, cb_position, CB_PAWN_B_ENC, node, tkn, pawn_flip=True)
-                elif tkn in CB_PAWN_C_ENC:
-                    node = do_move(piece_list, B_PAWN, 2, cb_position, CB_PAWN_C_ENC, node, tkn, pawn_flip=True)
-                elif tkn in CB_PAWN_D_ENC:
-                    node = do_move(piece_list, B_PAWN, 3, cb_position, CB_PAWN_D_ENC, node, tkn, pawn_flip=True)
-                elif tkn in CB_PAWN_E_ENC:
-                    node = do_move(piece_list, B_PAWN, 4, cb_position, CB_PAWN_E_ENC, node, tkn, pawn_flip=True)
-                elif tkn in CB_PAWN_F_ENC:
-                    node = do_move(piece_list, B_PAWN, 5, cb_position, CB_PAWN_F_ENC, node, tkn, pawn_flip=True)
-                elif tkn in CB_PAWN_G_ENC:
-                    node = do_move(piece_list, B_PAWN, 6, cb_position, CB_PAWN_G_ENC, node, tkn, pawn_flip=True)
-                elif tkn in CB_PAWN_H_ENC:
-                    node = do_move(piece_list, B_PAWN, 7, cb_position, CB_PAWN_H_ENC, node, tkn, pawn_flip=True)
+                    cb_position, piece_list, depth, white_to_move, ply = stack.pop()
+                    # what follows is an alternative to the line we just finished
+                    depth += 1
+                    while cb_position is None and idx < (len(game_bytes) - 1):
+                        idx, processed_moves, moves = skip_variation(game_bytes, idx + 1, processed_moves)
+                        skipped_moves += moves
+                        if idx < (len(game_bytes) - 1):
+                            cb_position, piece_list, depth, white_to_move, ply = stack.pop()
+                            depth += 1
+                    if cb_position is None:
+                        # skipped everything up to the end of the game
+                        break
+                    visitor.end_variation()
+            move_info = TOKEN_MOVES[tkn]
+            if move_info is not None:
+                if white_to_move:
+                    piece_type, piece_nr, targets, castling = move_info[0]
+                else:
+                    piece_type, piece_nr, targets, castling = move_info[1]
+                if opening is not None:
+                    # still in the opening, if no other tokens came before this move
+                    if idx == ply:
+                        i, j = piece_list[piece_type][piece_nr]
+                        i1, j1 = targets[i][j]
+                        opening_move = (j * 8 + i, j1 * 8 + i1)
+                    else:
+                        opening = None
+                ply += 1
+                do_move(piece_list, piece_type, piece_nr, cb_position, targets, visitor, ply, castling)
+                if opening is not None:
+                    opening = opening_cache.add(opening, tkn, opening_move, cb_position, piece_list)
+                white_to_move = not white_to_move
+                plies += 1
+                if annotations is not None and plies + skipped_moves in annotations:
+                    annotate(visitor, annotations[plies + skipped_moves])
+                if plies >= next_check:
+                    next_check = check_limits(plies)
             idx += 1
     except ValueError as e:
         err_string = str(e)
-    except TypeError as e:
+    except (TypeError, IndexError) as e:
         err_string = traceback.format_exc()
-    return game, err_string
+    visitor.end_game()
+    return err_string
+
+
+def decode(game_bytes, cb_position, piece_list, fen=None, max_variation_depth=None, limits=None,
+           opening_cache=None, annotations=None):
+    """
+    decodes a game of a cbg file into a python-chess game, see visit
+    :return: tuple of (python chess game (tree) or None if the game exceeded the limits, error message or None)
+    """
+    builder = GameBuilder()
+    try:
+        err_string = visit(game_bytes, cb_position, piece_list, builder, fen=fen,
+                           max_variation_depth=max_variation_depth, limits=limits,
+                           opening_cache=opening_cache, annotations=annotations)
+    except LimitExceeded as e:
+        return None, "skipped: " + str(e)
+    return builder.game, err_string
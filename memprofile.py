@@ -0,0 +1,171 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# memory profiling of a conversion with tracemalloc. the stages of the converter
+# (decoding a game, rendering it as PGN, writing it) are wrapped, see wrap. for each
+# stage, the peak of the traced memory while it runs is recorded, and for each game
+# how much memory it needed on top of what was allocated before (the largest game is
+# reported with its record number). on an interval, a snapshot attributes the traced
+# memory to modules (game.py, player.py, python-chess, ...). the resident set size is
+# sampled as well; what is not traced (e.g. pages of the memory mapped files) is the
+# difference between the two.
+
+import os
+import time
+import tracemalloc
+import chess
+import game
+import progress
+
+DEFAULT_INTERVAL = 10.0
+# number of modules printed for a snapshot (the JSON report has all)
+MODULES_PRINTED = 6
+# directory of python-chess and of the converter, for attributing memory to modules
+CHESS_DIR = os.path.dirname(os.path.abspath(chess.__file__)) + os.sep
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+
+def module_label(filename):
+    """
+    :param filename: filename of a source file
+    :return: name the memory allocated in the file is reported under
+    """
+    if filename.startswith(CHESS_DIR):
+        return "python-chess"
+    if filename.startswith(SOURCE_DIR):
+        return os.path.basename(filename)
+    return "other"
+
+
+class MemoryProfiler:
+    """
+    collects the memory usage of a conversion, see wrap and tick
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        """
+        :param interval: seconds between two snapshots
+        """
+        self.interval = interval
+        # per stage: [number of calls, peak traced memory, largest increase during a single call]
+        self.stages = {}
+        # stack of [stage, traced memory at the start, peak so far] of the stages that are running
+        self.running = []
+        self.largest_game = (None, 0)
+        self.samples = []
+        self.start = None
+        self.next_sample = None
+
+    def begin(self):
+        # python-chess and the tables that need it are set up when the first game is rendered,
+        # which would otherwise be charged to that game
+        game.import_chess()
+        tracemalloc.start()
+        self.start = time.monotonic()
+        self.next_sample = self.start + self.interval
+
+    def enter(self, stage):
+        current, peak = tracemalloc.get_traced_memory()
+        if len(self.running) > 0:
+            self.running[-1][2] = max(self.running[-1][2], peak)
+        self.running.append([stage, current, current])
+        tracemalloc.reset_peak()
+
+    def leave(self):
+        """
+        :return: increase of the traced memory during the stage, at its peak
+        """
+        _, peak = tracemalloc.get_traced_memory()
+        stage, start, peak_before = self.running.pop()
+        peak = max(peak, peak_before)
+        if len(self.running) > 0:
+            self.running[-1][2] = max(self.running[-1][2], peak)
+        stats = self.stages.setdefault(stage, [0, 0, 0])
+        stats[0] += 1
+        stats[1] = max(stats[1], peak)
+        stats[2] = max(stats[2], peak - start)
+        tracemalloc.reset_peak()
+        return peak - start
+
+    def wrap(self, stage, function, per_game=False):
+        """
+        :param stage: name of the stage
+        :param function: function that runs the stage
+        :param per_game: the first argument of function is a record number, and the memory of one
+                         call is the memory needed for that game
+        :return: function that calls function and records its memory usage
+        """
+        def profiled(*args, **kwargs):
+            self.enter(stage)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                increase = self.leave()
+                if per_game and increase > self.largest_game[1]:
+                    self.largest_game = (args[0], increase)
+
+        return profiled
+
+    def tick(self, record=None):
+        """
+        take a snapshot if the interval has passed
+        :param record: record number of the last game, for the report
+        """
+        now = time.monotonic()
+        if now >= self.next_sample:
+            self.sample(now, record)
+
+    def sample(self, now, record=None):
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        modules = {}
+        for stat in snapshot.statistics("filename"):
+            label = module_label(stat.traceback[0].filename)
+            modules[label] = modules.get(label, 0) + stat.size
+        self.samples.append({
+            "elapsed_seconds": now - self.start,
+            "record": record,
+            "traced_bytes": sum(modules.values()),
+            "rss_bytes": progress.rss_bytes(),
+            "modules": dict(sorted(modules.items(), key=lambda item: -item[1]))
+        })
+        self.next_sample = time.monotonic() + self.interval
+
+    def end(self, record=None):
+        """
+        take a last snapshot and stop tracing
+        :return: the report, see report
+        """
+        self.sample(time.monotonic(), record)
+        tracemalloc.stop()
+        return self.report()
+
+    def report(self):
+        """
+        :return: dict with the peak per stage, the largest game and all snapshots
+        """
+        return {
+            "stages": {stage: {"calls": calls, "peak_bytes": peak, "largest_call_bytes": largest}
+                       for stage, (calls, peak, largest) in self.stages.items()},
+            "largest_game": {"record": self.largest_game[0], "bytes": self.largest_game[1]},
+            "samples": self.samples
+        }
+
+
+def print_report(report):
+    print("memory profile (traced by tracemalloc):")
+    print("stage".ljust(12) + "calls".rjust(10) + "peak".rjust(12) + "largest call".rjust(16))
+    for stage, stats in report["stages"].items():
+        print(stage.ljust(12) + str(stats["calls"]).rjust(10) +
+              "{:.1f} MB".format(stats["peak_bytes"] / 1e6).rjust(12) +
+              "{:.2f} MB".format(stats["largest_call_bytes"] / 1e6).rjust(16))
+    largest_game = report["largest_game"]
+    if largest_game["record"] is not None:
+        print("largest game: record " + str(largest_game["record"]) +
+              ", {:.2f} MB".format(largest_game["bytes"] / 1e6))
+    if len(report["samples"]) > 0:
+        sample = max(report["samples"], key=lambda s: s["traced_bytes"])
+        print("largest snapshot ({:.0f}s, record {}): {:.1f} MB traced, {:.1f} MB RSS".format(
+            sample["elapsed_seconds"], sample["record"], sample["traced_bytes"] / 1e6, sample["rss_bytes"] / 1e6))
+        print("  " + ", ".join(label + " {:.1f} MB".format(size / 1e6)
+                               for label, size in list(sample["modules"].items())[:MODULES_PRINTED]))
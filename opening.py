@@ -0,0 +1,187 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# cache of the openings of games. the first moves of a game are shared with many
+# other games, but are decoded, turned into python-chess moves and exported as SAN
+# for every single one of them. the cache is a trie, keyed by the de-obfuscated
+# tokens of the moves from the initial position. each node stores the position
+# after these moves, so that decoding a game starts at the deepest node that is in
+# the cache (see game.visit). for the PGN export, a node also stores the FEN and the
+# movetext of its moves; these are computed once per node, when they are first needed.
+# only the moves before the first token that isn't a one byte move are cached.
+# the number of nodes is bounded, the least recently used ones are evicted
+
+import collections
+import chess
+import game
+
+DEFAULT_MAX_DEPTH = 16
+# line length of the movetext, like chess.pgn.FileExporter
+COLUMNS = 80
+
+
+class OpeningNode:
+    """
+    node of the opening cache, i.e. the position after the moves of a path from the root
+    """
+
+    __slots__ = ["parent", "token", "children", "ply", "move", "cb_position", "piece_list",
+                 "fen", "lines", "current_line"]
+
+    def __init__(self, parent, token, ply, move, cb_position, piece_list):
+        """
+        :param parent: OpeningNode of the position before the move, None for the root
+        :param token: de-obfuscated token of the move
+        :param ply: number of moves from the initial position
+        :param move: the move as pair of (from square, to square), see game.Visitor.move
+        :param cb_position: position after the move (8x8 array of tuples, see game.decode_piece_locations)
+        :param piece_list: piece list after the move
+        """
+        self.parent = parent
+        self.token = token
+        self.children = {}
+        self.ply = ply
+        self.move = move
+        # stored as tuples, which are immutable and therefore shared between all
+        # copies made from them
+        self.cb_position = tuple(tuple(column) for column in cb_position)
+        self.piece_list = tuple(None if pieces is None else tuple(pieces) for pieces in piece_list)
+        self.fen = None
+        self.lines = None
+        self.current_line = None
+
+    def position(self):
+        """
+        :return: tuple of (copy of the position, copy of the piece list) that can be modified
+        """
+        return [list(column) for column in self.cb_position], \
+               [None] + [list(pieces) for pieces in self.piece_list[1:]]
+
+    def moves(self):
+        """
+        :return: list of the moves from the initial position to this node, as (from square, to square)
+        """
+        moves = []
+        node = self
+        while node.parent is not None:
+            moves.append(node.move)
+            node = node.parent
+        moves.reverse()
+        return moves
+
+    def pgn(self):
+        """
+        :return: triple of (FEN of the position, complete lines of the movetext of the moves up to
+                 this node, current line of the movetext). the movetext is written exactly like
+                 chess.pgn.FileExporter writes it
+        """
+        if self.fen is None:
+            _, lines, current_line = self.parent.pgn()
+            board = chess.Board(self.parent.fen)
+            move = chess.Move(self.move[0], self.move[1])
+            tokens = [board.san(move) + " "]
+            if board.turn == chess.WHITE:
+                tokens.insert(0, str(board.fullmove_number) + ". ")
+            board.push(move)
+            for token in tokens:
+                if COLUMNS - len(current_line) < len(token):
+                    if current_line:
+                        lines += current_line.rstrip() + "\n"
+                    current_line = ""
+                current_line += token
+            self.fen = board.fen()
+            self.lines = lines
+            self.current_line = current_line
+        return self.fen, self.lines, self.current_line
+
+
+class OpeningCache:
+    """
+    trie of the positions after the first moves of games, see game.visit
+    """
+
+    def __init__(self, max_size, max_depth=DEFAULT_MAX_DEPTH):
+        """
+        :param max_size: maximum number of positions (nodes) in the cache
+        :param max_depth: maximum number of moves from the initial position
+        """
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.root = OpeningNode(None, None, 0, None, *game.initial_position())
+        self.root.fen = chess.STARTING_FEN
+        self.root.lines = ""
+        self.root.current_line = ""
+        # all nodes except the root, least recently used first. a node is always used
+        # after its children, so the least recently used node is always a leaf
+        self.nodes = collections.OrderedDict()
+        # number of games by the depth of the node where decoding started (0 = no hit)
+        self.hit_depths = collections.Counter()
+        self.evictions = 0
+
+    def touch(self, node):
+        """
+        mark a node and all nodes on the path to it as used
+        """
+        while node.parent is not None:
+            self.nodes.move_to_end(node)
+            node = node.parent
+
+    def lookup(self, game_bytes, max_depth=None):
+        """
+        :param game_bytes: the cb encoded moves of a game that starts with the initial position
+        :param max_depth: the node must not be deeper than this (None = max_depth of the cache)
+        :return: the deepest node whose moves the game starts with (the root if there is none)
+        """
+        node = self.root
+        children = node.children
+        if max_depth is None or max_depth > self.max_depth:
+            max_depth = self.max_depth
+        # as long as all tokens are moves, the processed move counter is the index
+        for idx in range(0, min(len(game_bytes), max_depth)):
+            child = children.get((game_bytes[idx] - idx) % 256)
+            if child is None:
+                break
+            node = child
+            children = node.children
+        self.touch(node)
+        self.hit_depths[node.ply] += 1
+        return node
+
+    def add(self, parent, token, move, cb_position, piece_list):
+        """
+        add the position after a move to the cache
+        :param parent: node of the position before the move
+        :param token: de-obfuscated token of the move
+        :param move: the move as pair of (from square, to square)
+        :param cb_position: position after the move
+        :param piece_list: piece list after the move
+        :return: the node of the position, or None if it can't be added (parent was evicted
+                 or the maximum depth is reached)
+        """
+        if parent.ply >= self.max_depth or (parent.parent is not None and parent not in self.nodes):
+            return None
+        node = parent.children.get(token)
+        if node is None:
+            node = OpeningNode(parent, token, parent.ply + 1, move, cb_position, piece_list)
+            parent.children[token] = node
+            self.nodes[node] = None
+        self.touch(node)
+        while len(self.nodes) > self.max_size:
+            leaf, _ = self.nodes.popitem(last=False)
+            del leaf.parent.children[leaf.token]
+            self.evictions += 1
+            if leaf is node:
+                return None
+        return node
+
+    def stats(self):
+        """
+        :return: dict with the number of positions and evictions, and the number of games by the
+                 number of moves that were found in the cache
+        """
+        return {
+            "positions": len(self.nodes),
+            "evictions": self.evictions,
+            "hit_depths": dict(sorted(self.hit_depths.items()))
+        }
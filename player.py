@@ -20,3 +20,13 @@ def get_name(cbp_file, player_no):
         first_name = tmp[0]
 
     return last_name + ", " + first_name
+
+
+def get_nr_players(cbp_file):
+    if cbp_file[0x18] == 4:
+        header_size = 32
+    elif cbp_file[0x18] == 0:
+        header_size = 28
+    else:
+        raise ValueError("unknown CBP file version")
+    return max(len(cbp_file) - header_size, 0) // 67
@@ -0,0 +1,179 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# progress of long conversions. the converter passes its counters on every game,
+# but they are only reported on a time interval: games/s, input MB/s (bytes of
+# the .cbg file consumed), output MB/s, errors, resident memory and the estimated
+# time left, which is computed from the .cbg bytes that remain, as games differ
+# a lot in length. optionally, every report is also appended to a metrics file,
+# as a JSON line or in the Prometheus text format, to graph the throughput of a
+# long run afterwards.
+
+import json
+import resource
+import sys
+import time
+
+DEFAULT_INTERVAL = 1.0
+METRICS_FORMATS = ["jsonl", "prometheus"]
+
+# name, type and help of the values written to a Prometheus metrics file
+PROMETHEUS_METRICS = [
+    ("records", "counter", "records processed"),
+    ("games", "counter", "games converted"),
+    ("errors", "counter", "errors logged"),
+    ("cbg_bytes", "counter", "bytes of the .cbg file consumed"),
+    ("output_bytes", "counter", "bytes of PGN written"),
+    ("games_per_second", "gauge", "games converted per second since the last sample"),
+    ("input_bytes_per_second", "gauge", ".cbg bytes consumed per second since the last sample"),
+    ("output_bytes_per_second", "gauge", "bytes of PGN written per second since the last sample"),
+    ("error_rate", "gauge", "errors per record processed"),
+    ("rss_bytes", "gauge", "resident set size of the process"),
+    ("eta_seconds", "gauge", "estimated time until all .cbg bytes are consumed"),
+]
+
+
+def rss_bytes():
+    """
+    :return: current resident set size of this process in bytes (on systems without
+             /proc, the peak resident set size)
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+class Progress:
+    """
+    progress reporter, see update
+    """
+
+    def __init__(self, total_bytes, interval=DEFAULT_INTERVAL, metrics_file=None, metrics_format="jsonl",
+                 show=True, out=sys.stderr):
+        """
+        :param total_bytes: number of .cbg bytes that will be consumed in total (for the estimated time left)
+        :param interval: seconds between two reports
+        :param metrics_file: filename of a file that every report is appended to, or None
+        :param metrics_format: one of METRICS_FORMATS
+        :param show: print the reports to out
+        :param out: text file the reports are printed to
+        """
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError("unknown metrics format: " + str(metrics_format))
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.metrics_format = metrics_format
+        self.show = show
+        self.out = out
+        # on a terminal, each report overwrites the previous one
+        self.overwrite = show and out.isatty()
+        self.metrics = None
+        if metrics_file is not None:
+            self.metrics = open(metrics_file, "a", encoding="utf-8")
+            if metrics_format == "prometheus" and self.metrics.tell() == 0:
+                for name, kind, description in PROMETHEUS_METRICS:
+                    self.metrics.write("# HELP cbh2pgn_" + name + " " + description + "\n")
+                    self.metrics.write("# TYPE cbh2pgn_" + name + " " + kind + "\n")
+        self.start = time.monotonic()
+        self.next_report = self.start + interval
+        self.counters = (0, 0, 0, 0, 0)
+        # time and counters of the last report
+        self.last = (self.start, 0, 0, 0, 0, 0)
+        self.line_length = 0
+
+    def update(self, records, games, errors, cbg_bytes, output_bytes):
+        """
+        pass the current counters. this is cheap, a report is only made if the interval has passed
+        :param records: number of records processed so far
+        :param games: number of games converted so far
+        :param errors: number of errors logged so far
+        :param cbg_bytes: number of .cbg bytes consumed so far
+        :param output_bytes: number of bytes written so far
+        """
+        self.counters = (records, games, errors, cbg_bytes, output_bytes)
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.report(now)
+
+    def sample(self, now):
+        """
+        :return: dict of the counters and rates at time now
+        """
+        records, games, errors, cbg_bytes, output_bytes = self.counters
+        last_time, _, last_games, _, last_cbg_bytes, last_output_bytes = self.last
+        seconds = max(now - last_time, 1e-9)
+        elapsed = now - self.start
+        eta = None
+        if cbg_bytes > 0 and elapsed > 0:
+            eta = max(self.total_bytes - cbg_bytes, 0) / (cbg_bytes / elapsed)
+        return {
+            "time": time.time(),
+            "elapsed_seconds": elapsed,
+            "records": records,
+            "games": games,
+            "errors": errors,
+            "cbg_bytes": cbg_bytes,
+            "output_bytes": output_bytes,
+            "games_per_second": (games - last_games) / seconds,
+            "input_bytes_per_second": (cbg_bytes - last_cbg_bytes) / seconds,
+            "output_bytes_per_second": (output_bytes - last_output_bytes) / seconds,
+            "error_rate": errors / records if records > 0 else 0.0,
+            "rss_bytes": rss_bytes(),
+            "eta_seconds": eta
+        }
+
+    def report(self, now):
+        sample = self.sample(now)
+        if self.show:
+            line = "{} games | {:.0f} games/s | in {:.1f} MB/s | out {:.1f} MB/s | {} errors ({:.2%}) | " \
+                   "RSS {:.0f} MB | ETA {}".format(sample["games"], sample["games_per_second"],
+                                                   sample["input_bytes_per_second"] / 1e6,
+                                                   sample["output_bytes_per_second"] / 1e6,
+                                                   sample["errors"], sample["error_rate"], sample["rss_bytes"] / 1e6,
+                                                   "?" if sample["eta_seconds"] is None
+                                                   else format_duration(sample["eta_seconds"]))
+            if self.overwrite:
+                self.out.write("\r" + line.ljust(self.line_length))
+                self.line_length = len(line)
+            else:
+                self.out.write(line + "\n")
+            self.out.flush()
+        if self.metrics is not None:
+            self.write_metrics(sample)
+        self.last = (now,) + self.counters
+        self.next_report = now + self.interval
+
+    def write_metrics(self, sample):
+        if self.metrics_format == "jsonl":
+            self.metrics.write(json.dumps(sample) + "\n")
+        else:
+            timestamp = str(int(sample["time"] * 1000))
+            for name, _, _ in PROMETHEUS_METRICS:
+                value = sample[name]
+                if value is None:
+                    value = "NaN"
+                self.metrics.write("cbh2pgn_" + name + " " + str(value) + " " + timestamp + "\n")
+        self.metrics.flush()
+
+    def close(self):
+        """
+        make a last report (with the final counters, and the rates averaged over the whole run)
+        and close the metrics file
+        """
+        self.last = (self.start, 0, 0, 0, 0, 0)
+        self.report(time.monotonic())
+        if self.overwrite:
+            self.out.write("\n")
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
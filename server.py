@@ -0,0 +1,292 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# a small read-only HTTP server over one database. the asyncio front end
+# answers requests concurrently and dispatches decoding and header searches
+# to a pool of worker processes, each of which keeps the database open.
+#
+#   GET /game/<record>                    PGN of one game
+#   GET /games?records=5,10-20            PGN of several games
+#   GET /search?white=..&black=..&player=..&event=..&year_from=..&year_to=..&first=..&limit=..
+#                                         JSON list of matching records with their tags
+#   GET /metrics                          JSON request latency and cache statistics
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+import urllib.parse
+import database
+
+MAX_RECORDS_PER_REQUEST = 10000
+MAX_SEARCH_RESULTS = 1000
+RECORDS_PER_TASK = 64
+LATENCY_SAMPLES = 1000
+
+# the database of a worker process
+worker_db = None
+
+
+def init_worker(filename, max_variation_depth):
+    global worker_db
+    worker_db = database.Database(filename, max_variation_depth=max_variation_depth)
+
+
+def render_games(records):
+    """
+    decode games in a worker process
+    :param records: list of record numbers
+    :return: list of (record number, PGN string or None, list of errors)
+    """
+    results = []
+    for i in records:
+        pgn, errors = worker_db.render_game(i)
+        results.append((i, pgn, [str(err) for err in errors]))
+    return results
+
+
+def search_headers(criteria):
+    """
+    search the game headers in a worker process
+    :param criteria: keyword arguments for database.Database.search
+    :return: list of dicts with record number and tags
+    """
+    results = []
+    for i in worker_db.search(**criteria):
+        entry = {"record": i}
+        entry.update(worker_db.get_tags(worker_db.record_offset(i)))
+        results.append(entry)
+    return results
+
+
+class Metrics:
+    """
+    request counts and latencies per endpoint, and hit rate of the PGN cache
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.total_latency = collections.Counter()
+        self.max_latency = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_SAMPLES))
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def record(self, endpoint, latency, failed):
+        self.requests[endpoint] += 1
+        if failed:
+            self.errors[endpoint] += 1
+        self.total_latency[endpoint] += latency
+        self.max_latency[endpoint] = max(self.max_latency[endpoint], latency)
+        self.latencies[endpoint].append(latency)
+
+    def as_dict(self, cache_size):
+        endpoints = {}
+        for endpoint, count in self.requests.items():
+            recent = sorted(self.latencies[endpoint])
+            endpoints[endpoint] = {
+                "requests": count,
+                "errors": self.errors[endpoint],
+                "mean_ms": 1000 * self.total_latency[endpoint] / count,
+                "max_ms": 1000 * self.max_latency[endpoint],
+                "p50_ms": 1000 * recent[len(recent) // 2],
+                "p99_ms": 1000 * recent[min(len(recent) - 1, (len(recent) * 99) // 100)]
+            }
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "uptime_s": time.time() - self.started,
+            "endpoints": endpoints,
+            "cache": {
+                "size": cache_size,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / lookups if lookups > 0 else None
+            }
+        }
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class QueryServer:
+
+    def __init__(self, filename, workers=None, cache_size=10000, max_variation_depth=None):
+        """
+        :param filename: filename of the .cbh file
+        :param workers: number of worker processes (default: number of CPUs)
+        :param cache_size: number of rendered games kept in memory
+        :param max_variation_depth: see game.decode
+        """
+        # the server keeps the database open itself, too, for the number of records,
+        # and to make sure that it exists before starting any workers
+        self.db = database.Database(filename)
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                           initargs=(filename, max_variation_depth))
+        self.cache_size = cache_size
+        # rendered PGN of games, keyed by record number, least recently used first
+        self.cache = collections.OrderedDict()
+        self.metrics = Metrics()
+
+    def close(self):
+        self.pool.shutdown()
+        self.db.close()
+
+    async def get_games(self, records):
+        """
+        :param records: list of record numbers
+        :return: list of (record number, PGN string or None, list of errors), in the given order
+        """
+        results = {}
+        missing = []
+        for i in records:
+            if i < 1 or i >= self.db.nr_records:
+                raise HTTPError(404, "no such record: " + str(i))
+            cached = self.cache.get(i)
+            if cached is not None:
+                self.cache.move_to_end(i)
+                self.metrics.cache_hits += 1
+                results[i] = cached
+            elif i not in results:
+                self.metrics.cache_misses += 1
+                results[i] = None
+                missing.append(i)
+        loop = asyncio.get_running_loop()
+        tasks = [loop.run_in_executor(self.pool, render_games, missing[k:k + RECORDS_PER_TASK])
+                 for k in range(0, len(missing), RECORDS_PER_TASK)]
+        for rendered in await asyncio.gather(*tasks):
+            for i, pgn, errors in rendered:
+                results[i] = (i, pgn, errors)
+                if self.cache_size > 0:
+                    self.cache[i] = (i, pgn, errors)
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+        return [results[i] for i in records]
+
+    async def game(self, path, query):
+        try:
+            i = int(path[len("/game/"):])
+        except ValueError:
+            raise HTTPError(400, "invalid record number")
+        _, pgn, errors = (await self.get_games([i]))[0]
+        if pgn is None:
+            raise HTTPError(404, "not a game, deleted or unsupported: " + str(i) + " " + "; ".join(errors))
+        return "application/x-chess-pgn", pgn
+
+    async def games(self, path, query):
+        try:
+            records = database.parse_records(query.get("records", ""))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        if len(records) > MAX_RECORDS_PER_REQUEST:
+            raise HTTPError(400, "at most " + str(MAX_RECORDS_PER_REQUEST) + " records per request")
+        games = await self.get_games(records)
+        return "application/x-chess-pgn", "".join(pgn for _, pgn, _ in games if pgn is not None)
+
+    async def search(self, path, query):
+        criteria = {}
+        try:
+            for key in ["white", "black", "player", "event"]:
+                if key in query:
+                    criteria[key] = query[key]
+            for key in ["year_from", "year_to", "first"]:
+                if key in query:
+                    criteria[key] = int(query[key])
+            criteria["limit"] = min(int(query.get("limit", 100)), MAX_SEARCH_RESULTS)
+        except ValueError:
+            raise HTTPError(400, "invalid number")
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(self.pool, search_headers, criteria)
+        return "application/json", json.dumps(results)
+
+    async def get_metrics(self, path, query):
+        return "application/json", json.dumps(self.metrics.as_dict(len(self.cache)))
+
+    def route(self, path):
+        if path.startswith("/game/"):
+            return "game", self.game
+        if path == "/games":
+            return "games", self.games
+        if path == "/search":
+            return "search", self.search
+        if path == "/metrics":
+            return "metrics", self.get_metrics
+        return "other", None
+
+    async def handle(self, reader, writer):
+        start = time.perf_counter()
+        endpoint = "other"
+        status = 200
+        try:
+            request_line = await reader.readline()
+            # ignore all request headers
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            try:
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            except ValueError:
+                raise HTTPError(400, "bad request")
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            endpoint, handler = self.route(url.path)
+            if handler is None:
+                raise HTTPError(404, "not found")
+            if method != "GET":
+                raise HTTPError(405, "only GET is supported")
+            content_type, body = await handler(url.path, query)
+        except HTTPError as e:
+            status = e.status
+            content_type, body = "text/plain", str(e) + "\n"
+        except Exception as e:
+            status = 500
+            content_type, body = "text/plain", "internal error: " + str(e) + "\n"
+        data = body.encode("utf-8")
+        writer.write(("HTTP/1.1 " + str(status) + " " + STATUS_TEXT.get(status, "") + "\r\n" +
+                      "Content-Type: " + content_type + "; charset=utf-8\r\n" +
+                      "Content-Length: " + str(len(data)) + "\r\n" +
+                      "Connection: close\r\n\r\n").encode("latin-1"))
+        writer.write(data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+        self.metrics.record(endpoint, time.perf_counter() - start, status >= 400)
+
+    async def serve(self, host="127.0.0.1", port=8080, socket_path=None):
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error"
+}
+
+
+def run(filename, host="127.0.0.1", port=8080, socket_path=None, workers=None, cache_size=10000,
+        max_variation_depth=None):
+    query_server = QueryServer(filename, workers=workers, cache_size=cache_size,
+                               max_variation_depth=max_variation_depth)
+    try:
+        asyncio.run(query_server.serve(host, port, socket_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        query_server.close()
@@ -0,0 +1,186 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# conversion of one database split into N shards, e.g. on N machines.
+# shard k/N is a contiguous range of records, chosen such that all shards
+# contain about the same number of .cbg bytes. every shard is written with a
+# manifest; merge checks the manifests and concatenates the shards in order.
+
+import bisect
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import database
+import game
+import header
+
+MANIFEST_VERSION = 1
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+
+def parse_shard(spec):
+    """
+    :param spec: shard as "k/N", with 1 <= k <= N
+    :return: tuple of (k, N)
+    """
+    try:
+        k, n = spec.split("/")
+        k = int(k)
+        n = int(n)
+    except ValueError:
+        raise ValueError("invalid shard (expected k/N): " + spec)
+    if n < 1 or k < 1 or k > n:
+        raise ValueError("invalid shard (expected 1 <= k <= N): " + spec)
+    return k, n
+
+
+def record_weights(db):
+    """
+    :param db: database.Database
+    :return: list of the length of the game of every record in bytes, as stored in the .cbg file
+             (0 for records that are not games or point outside of the .cbg file).
+             index 0 is record 1
+    """
+    cbh_file = db.cbh_file
+    cbg_file = db.cbg_file
+    cbg_size = len(cbg_file)
+    weights = []
+    for record_offset in range(database.CBH_RECORD_SIZE, database.CBH_RECORD_SIZE * db.nr_records,
+                               database.CBH_RECORD_SIZE):
+        weight = 0
+        if header.is_game(cbh_file, record_offset) and not header.is_marked_as_deleted(cbh_file, record_offset):
+            game_offset = header.get_game_offset(cbh_file, record_offset)
+            if game_offset + 4 <= cbg_size:
+                weight = game.get_info_gamelen(cbg_file, game_offset)[4]
+        weights.append(weight)
+    return weights
+
+
+def shard_range(db, k, n):
+    """
+    :param db: database.Database
+    :param k: number of the shard, 1 <= k <= n
+    :param n: number of shards
+    :return: tuple of (first record, record after the last one) of shard k. the shards
+             cover all records, in order, and each contains about 1/n of the .cbg bytes
+    """
+    cumulative = list(itertools.accumulate(record_weights(db)))
+    total = cumulative[-1] if len(cumulative) > 0 else 0
+
+    def boundary(j):
+        # records of zero weight in front of the first game belong to the first shard
+        if j == 0:
+            return 1
+        if j == n:
+            return db.nr_records
+        return 1 + bisect.bisect_right(cumulative, (total * j) // n)
+
+    return boundary(k - 1), boundary(k)
+
+
+def checksum(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(CHECKSUM_BLOCK_SIZE)
+            if not block:
+                break
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def manifest_filename(filename_pgn):
+    if filename_pgn.endswith(".pgn"):
+        filename_pgn = filename_pgn[:-4]
+    return filename_pgn + ".manifest.json"
+
+
+def write_manifest(db, k, n, first, last, filename_pgn, nr_games, nr_errors, max_variation_depth):
+    """
+    write the manifest of a converted shard next to its .pgn file
+    :return: filename of the manifest
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "database": os.path.basename(db.filename),
+        "header_id": db.header_id().hex(),
+        "nr_records": db.nr_records,
+        "cbg_bytes": len(db.cbg_file),
+        "max_variation_depth": max_variation_depth,
+        "shard": k,
+        "shards": n,
+        "first_record": first,
+        "last_record": last - 1,
+        "games": nr_games,
+        "errors": nr_errors,
+        "pgn": os.path.basename(filename_pgn),
+        "pgn_bytes": os.path.getsize(filename_pgn),
+        "sha256": checksum(filename_pgn)
+    }
+    filename = manifest_filename(filename_pgn)
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return filename
+
+
+def read_manifests(filenames):
+    """
+    read and check the manifests of all shards of a database
+    :param filenames: filenames of the manifests, in any order
+    :return: list of (manifest, filename of the shard .pgn), ordered by shard
+    :raises ValueError: if shards are missing, don't belong together or don't match their checksum
+    """
+    shards = []
+    for filename in filenames:
+        with open(filename, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(filename + ": unsupported manifest version")
+        filename_pgn = os.path.join(os.path.dirname(filename), manifest["pgn"])
+        shards.append((manifest, filename_pgn))
+    if len(shards) == 0:
+        raise ValueError("no manifests given")
+    shards.sort(key=lambda shard: shard[0]["shard"])
+
+    first = shards[0][0]
+    for key in ["database", "header_id", "nr_records", "cbg_bytes", "max_variation_depth", "shards"]:
+        for manifest, filename_pgn in shards:
+            if manifest[key] != first[key]:
+                raise ValueError(filename_pgn + ": " + key + " differs from the other shards")
+    found = [manifest["shard"] for manifest, _ in shards]
+    if found != list(range(1, first["shards"] + 1)):
+        raise ValueError("expected shards 1-" + str(first["shards"]) + " exactly once, got " +
+                         ", ".join(str(k) for k in found))
+    next_record = 1
+    for manifest, filename_pgn in shards:
+        if manifest["first_record"] != next_record:
+            raise ValueError(filename_pgn + ": records start at " + str(manifest["first_record"]) +
+                             ", expected " + str(next_record))
+        next_record = manifest["last_record"] + 1
+    if next_record != first["nr_records"]:
+        raise ValueError("records end at " + str(next_record - 1) + ", expected " + str(first["nr_records"] - 1))
+    for manifest, filename_pgn in shards:
+        if not os.path.exists(filename_pgn):
+            raise ValueError(filename_pgn + ": missing")
+        if os.path.getsize(filename_pgn) != manifest["pgn_bytes"] or checksum(filename_pgn) != manifest["sha256"]:
+            raise ValueError(filename_pgn + ": checksum mismatch")
+    return shards
+
+
+def merge(filenames, filename_out):
+    """
+    check the manifests of all shards and concatenate the shards in order
+    :param filenames: filenames of the manifests
+    :param filename_out: filename of the merged .pgn
+    :return: list of the manifests, ordered by shard
+    :raises ValueError: see read_manifests
+    """
+    shards = read_manifests(filenames)
+    with open(filename_out, "wb") as out:
+        for _, filename_pgn in shards:
+            with open(filename_pgn, "rb") as f:
+                shutil.copyfileobj(f, out, CHECKSUM_BLOCK_SIZE)
+    return [manifest for manifest, _ in shards]
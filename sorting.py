@@ -0,0 +1,117 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# conversion in a different order than the order of the records, e.g. by date.
+# the sort keys are computed from the .cbh records only, without decoding any
+# moves. every record is stored with its key as one 64 bit integer (key in the
+# upper, record number in the lower 32 bits). runs of these are sorted and kept
+# in compact arrays, and merged while converting, so no list of all records is
+# ever built. the games are then decoded in sorted order; the next games are
+# prefetched in batches (see Database.prefetch), so that the random access
+# pattern doesn't stall on every game.
+
+import array
+import heapq
+import header
+
+RUN_SIZE = 1 << 20
+MASK_RECORD = 0xFFFFFFFF
+MAX_ELO = 0xFFFF
+
+
+def date_keys(db):
+    """
+    :return: generator of the date of each record, as year, month and day packed into 24 bits
+             (unknown parts are 0 and sort first)
+    """
+    cbh_file = db.cbh_file
+    for i in range(1, db.nr_records):
+        yield header.get_packed_date(cbh_file, db.record_offset(i))
+
+
+def name_ranks(numbers, get_name):
+    """
+    :param numbers: set of player or tournament numbers
+    :param get_name: function that returns the name for a number
+    :return: dict of number to the position of its name in alphabetical (case insensitive) order
+    """
+    names = sorted(numbers, key=lambda no: (get_name(no).lower(), no))
+    return {no: rank for rank, no in enumerate(names)}
+
+
+def white_keys(db):
+    """
+    :return: generator of the alphabetical rank of the white player of each record
+    """
+    cbh_file = db.cbh_file
+    players = array.array("L", (header.get_whiteplayer_offset(cbh_file, db.record_offset(i))
+                                for i in range(1, db.nr_records)))
+    ranks = name_ranks(set(players), db.player_name)
+    return (ranks[no] for no in players)
+
+
+def event_keys(db):
+    """
+    :return: generator of the alphabetical rank of the event of each record
+    """
+    cbh_file = db.cbh_file
+    tournaments = array.array("L", (header.get_tournament_offset(cbh_file, db.record_offset(i))
+                                    for i in range(1, db.nr_records)))
+    ranks = name_ranks(set(tournaments), lambda no: db.event_site(no)[0])
+    return (ranks[no] for no in tournaments)
+
+
+def elo_keys(db):
+    """
+    :return: generator of keys that sort by the mean Elo of both players (of the known one,
+             if only one is known), highest first. games without Elo sort last
+    """
+    cbh_file = db.cbh_file
+    for i in range(1, db.nr_records):
+        w_elo, b_elo = header.get_ratings(cbh_file, db.record_offset(i))
+        known = (w_elo != 0) + (b_elo != 0)
+        elo = (w_elo + b_elo) // known if known > 0 else 0
+        yield MAX_ELO - elo
+
+
+SORT_KEYS = {
+    "date": date_keys,
+    "white": white_keys,
+    "event": event_keys,
+    "elo": elo_keys,
+}
+
+
+def sorted_records(db, sort_by, run_size=RUN_SIZE):
+    """
+    :param db: database.Database
+    :param sort_by: one of SORT_KEYS
+    :param run_size: number of records that are sorted at once
+    :return: generator of all record numbers, sorted by the key. records with the same key
+             stay in the order of the database
+    """
+    runs = []
+    run = []
+    for i, key in enumerate(SORT_KEYS[sort_by](db), 1):
+        run.append((key << 32) | i)
+        if len(run) == run_size:
+            run.sort()
+            runs.append(array.array("Q", run))
+            run = []
+    run.sort()
+    runs.append(array.array("Q", run))
+    del run
+    for value in heapq.merge(*runs):
+        yield value & MASK_RECORD
+
+
+def render_sorted(db, sort_by, visitor=None):
+    """
+    decode all games in sorted order
+    :param db: database.Database
+    :param sort_by: one of SORT_KEYS
+    :param visitor: see Database.render_game
+    :return: generator of (record number, PGN string or None, list of errors), see Database.render_game
+    """
+    return db.render_games(sorted_records(db, sort_by), visitor=visitor)
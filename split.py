@@ -0,0 +1,168 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# output of the converted games into one file per player or event, in the same
+# pass as the conversion. the names are taken from the .cbh record of a game. a
+# database can have tens of thousands of players, more than files can be open at
+# the same time: only a bounded number of files are kept open (least recently used
+# ones are closed, and opened again for appending when they get the next game),
+# and each open file has a write buffer. at the end, all buffers are written, and
+# an index of the files is written next to them. nothing is sorted or read again.
+
+import collections
+import os
+import re
+import resource
+import header
+import writer
+
+SPLIT_BY = ["white", "black", "player", "event"]
+DEFAULT_MAX_OPEN = 256
+# file descriptors that are left for everything else
+RESERVED_FDS = 32
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_FILENAME_LENGTH = 100
+INDEX_FILENAME = "index.tsv"
+
+
+def target_names(db, record_offset, split_by):
+    """
+    :param db: database.Database
+    :param record_offset: offset of the record in the .cbh file
+    :param split_by: one of SPLIT_BY
+    :return: names of the files the game is written to (one, or both players for "player")
+    """
+    cbh_file = db.cbh_file
+    if split_by == "event":
+        return db.event_site(header.get_tournament_offset(cbh_file, record_offset))[0],
+    white = db.player_name(header.get_whiteplayer_offset(cbh_file, record_offset))
+    if split_by == "white":
+        return white,
+    black = db.player_name(header.get_blackplayer_offset(cbh_file, record_offset))
+    if split_by == "black" or white == black:
+        return black,
+    return white, black
+
+
+def safe_filename(name):
+    """
+    :param name: name of a player or event
+    :return: the name with everything but letters, digits, "-" and "." replaced by "_"
+    """
+    filename = re.sub(r"[^\w.-]+", "_", name).strip("_.")[:MAX_FILENAME_LENGTH]
+    return filename if filename != "" else "unknown"
+
+
+def max_open_files():
+    """
+    :return: the number of files that can be open at the same time, minus RESERVED_FDS
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return DEFAULT_MAX_OPEN
+    return max(soft - RESERVED_FDS, 1)
+
+
+class SplitWriter:
+    """
+    directory of PGN files, one per player or event, see write_game
+    """
+
+    def __init__(self, directory, db, split_by, buffer_size, max_open=DEFAULT_MAX_OPEN):
+        """
+        :param directory: directory of the files, created if it doesn't exist. files of the same
+                          names are truncated
+        :param db: database.Database the games are from
+        :param split_by: one of SPLIT_BY
+        :param buffer_size: size of the buffers of all open files together, in bytes
+        :param max_open: maximum number of open files (it is also limited by the limit of the process)
+        """
+        if split_by not in SPLIT_BY:
+            raise ValueError("unknown split: " + str(split_by))
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.db = db
+        self.split_by = split_by
+        self.max_open = max(min(max_open, max_open_files()), 1)
+        self.buffer_size = max(buffer_size // self.max_open, MIN_BUFFER_SIZE)
+        # filename and number of games of each name, in the order the names occurred
+        self.targets = {}
+        self.filenames = set()
+        # (file descriptor, buffer) of the open files, keyed by name, least recently used first
+        self.open_files = collections.OrderedDict()
+        self.bytes_written = 0
+        self.reopened = 0
+
+    def open(self, name):
+        """
+        :return: (file descriptor, buffer) of the file of a name. if too many files are open, the
+                 least recently used one is closed
+        """
+        if len(self.open_files) >= self.max_open:
+            _, (fd, buffer) = self.open_files.popitem(last=False)
+            self.close_file(fd, buffer)
+        target = self.targets.get(name)
+        if target is None:
+            filename = safe_filename(name)
+            # different names can have the same safe filename
+            nr = 1
+            while filename.lower() in self.filenames:
+                nr += 1
+                filename = safe_filename(name)[:MAX_FILENAME_LENGTH - 6] + "_" + str(nr)
+            self.filenames.add(filename.lower())
+            target = [filename + ".pgn", 0]
+            self.targets[name] = target
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        else:
+            flags = os.O_WRONLY | os.O_APPEND
+            self.reopened += 1
+        fd = os.open(os.path.join(self.directory, target[0]), flags, 0o666)
+        open_file = (fd, bytearray())
+        self.open_files[name] = open_file
+        return open_file
+
+    def close_file(self, fd, buffer):
+        try:
+            writer.write_all(fd, buffer)
+        finally:
+            os.close(fd)
+
+    def write_game(self, i, text):
+        """
+        :param i: record number of the game
+        :param text: PGN of the game
+        """
+        data = text.encode("utf-8")
+        for name in target_names(self.db, self.db.record_offset(i), self.split_by):
+            open_file = self.open_files.get(name)
+            if open_file is None:
+                open_file = self.open(name)
+            else:
+                self.open_files.move_to_end(name)
+            fd, buffer = open_file
+            buffer += data
+            if len(buffer) >= self.buffer_size:
+                writer.write_all(fd, buffer)
+                del buffer[:]
+            self.targets[name][1] += 1
+            self.bytes_written += len(data)
+
+    def write_index(self):
+        """
+        write the filename, the number of games and the name of all files, as tab separated lines
+        """
+        with open(os.path.join(self.directory, INDEX_FILENAME), "w", encoding="utf-8") as f:
+            for name, (filename, nr_games) in self.targets.items():
+                f.write(filename + "\t" + str(nr_games) + "\t" + name.replace("\t", " ") + "\n")
+
+    def close(self):
+        try:
+            while len(self.open_files) > 0:
+                _, (fd, buffer) = self.open_files.popitem(last=False)
+                self.close_file(fd, buffer)
+        finally:
+            for fd, _ in self.open_files.values():
+                os.close(fd)
+            self.open_files.clear()
+        self.write_index()
@@ -0,0 +1,119 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# statistics of a database without decoding any moves, e.g. to plan a conversion.
+# everything is computed in one pass over the .cbh records, which are unpacked in
+# bulk, and the 4 byte game headers in the .cbg file (see game.get_info_gamelen).
+# the .cbp and .cbt files are not read
+
+import collections
+import struct
+import game
+import header
+
+# the fields of a .cbh record that are needed: flags, game offset, packed date (24 bit,
+# read as 32 bit starting one byte earlier), result, white and black Elo
+CBH_RECORD = struct.Struct(">BI18xIB3xHH11x")
+CBH_RECORD_SIZE = 46
+
+# width of the Elo buckets
+ELO_BUCKET = 100
+
+
+def unpack_date(packed_date):
+    """
+    :param packed_date: packed date, see header.get_packed_date
+    :return: date as YYYY.MM.DD with ?? for unknown parts, or None if the year is unknown
+    """
+    year = (packed_date & header.MASK_YEAR) >> 9
+    if year == 0:
+        return None
+    month = (packed_date & header.MASK_MONTH) >> 5
+    day = packed_date & header.MASK_DAY
+    return str(year).zfill(4) + "." + (str(month).zfill(2) if month > 0 else "??") + "." + \
+        (str(day).zfill(2) if day > 0 else "??")
+
+
+def statistics(db):
+    """
+    :param db: database.Database
+    :return: dict with the number of records, games, deleted records, records that aren't games,
+             games that aren't encoded, Chess960 games, games with special encoding and games with
+             a setup position, the date range and games without a year, the number of games by
+             result, by decade and by Elo (of both players, in buckets of ELO_BUCKET), and the total
+             and average length of the games in the .cbg file
+    """
+    cbg_file = db.cbg_file
+    cbg_size = len(cbg_file)
+    counts = collections.Counter()
+    results = collections.Counter()
+    decades = collections.Counter()
+    elos = collections.Counter()
+    first_date = None
+    last_date = None
+    game_bytes = 0
+
+    records = memoryview(db.cbh_file)[CBH_RECORD_SIZE:db.nr_records * CBH_RECORD_SIZE]
+    try:
+        for flags, game_offset, packed_date, result, white_elo, black_elo in CBH_RECORD.iter_unpack(records):
+            if (flags & header.MASK_IS_GAME) == 0:
+                counts["not_games"] += 1
+                continue
+            if (flags & header.MASK_MARKED_FOR_DELETION) != 0:
+                counts["deleted"] += 1
+                continue
+            counts["games"] += 1
+
+            packed_date &= header.MASK_UINT24
+            if (packed_date & header.MASK_YEAR) == 0:
+                counts["no_year"] += 1
+            else:
+                if first_date is None or packed_date < first_date:
+                    first_date = packed_date
+                if last_date is None or packed_date > last_date:
+                    last_date = packed_date
+                decades[((packed_date & header.MASK_YEAR) >> 9) // 10 * 10] += 1
+            results[header.result_name(result)] += 1
+            for elo in (white_elo, black_elo):
+                elos[elo // ELO_BUCKET * ELO_BUCKET if elo > 0 else None] += 1
+
+            if game_offset + 4 > cbg_size:
+                counts["bad_offset"] += 1
+                continue
+            not_initial, not_encoded, is_960, special_encoding, game_len = \
+                game.get_info_gamelen(cbg_file, game_offset)
+            game_bytes += game_len
+            if not_encoded:
+                counts["not_encoded"] += 1
+            elif is_960:
+                counts["chess960"] += 1
+            elif special_encoding:
+                counts["special_encoding"] += 1
+            elif not_initial:
+                counts["setup_position"] += 1
+    finally:
+        records.release()
+
+    games_with_length = counts["games"] - counts["bad_offset"]
+    return {
+        "records": db.nr_records - 1,
+        "games": counts["games"],
+        "deleted": counts["deleted"],
+        "not_games": counts["not_games"],
+        "not_encoded": counts["not_encoded"],
+        "chess960": counts["chess960"],
+        "special_encoding": counts["special_encoding"],
+        "setup_position": counts["setup_position"],
+        "bad_offset": counts["bad_offset"],
+        "first_date": None if first_date is None else unpack_date(first_date),
+        "last_date": None if last_date is None else unpack_date(last_date),
+        "no_year": counts["no_year"],
+        "results": dict(sorted(results.items(), key=lambda item: -item[1])),
+        "decades": {str(decade) + "s": nr for decade, nr in sorted(decades.items())},
+        "elos": {("unrated" if elo is None else str(elo) + "-" + str(elo + ELO_BUCKET - 1)): nr
+                 for elo, nr in sorted(elos.items(), key=lambda item: -1 if item[0] is None else item[0])},
+        "cbg_bytes": cbg_size,
+        "game_bytes": game_bytes,
+        "average_game_bytes": game_bytes / games_with_length if games_with_length > 0 else None
+    }
@@ -0,0 +1,240 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# additional outputs of a conversion (--tee), fed from the same decoding of each
+# game as the main output:
+#   pgn:FILE         the PGN once more, compressed if FILE ends with .gz, .bz2 or .xz
+#   headers:FILE     the tags of each game (and its record number) as one JSON object per line
+#   visitor:CLASS    a game.Visitor, given as module.Class, e.g. stats.MyVisitor. it gets the
+#                    tags and moves of each game, and close() (if it has it) at the end
+# each sink runs in its own thread and gets the games through a bounded queue, so
+# a slow sink (e.g. compression) runs in parallel with decoding, and only stalls it
+# when its queue is full. the moves for visitors are recorded while decoding (see
+# game.Recorder) and replayed in the thread of the sink
+
+import bz2
+import gzip
+import importlib
+import json
+import lzma
+import queue
+import threading
+import game
+
+SINK_KINDS = ["pgn", "headers", "visitor"]
+DEFAULT_QUEUE_SIZE = 1024
+
+COMPRESSORS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+
+
+def open_output(filename):
+    """
+    :return: file opened for writing bytes, compressed according to the extension of filename
+    """
+    for extension, open_compressed in COMPRESSORS.items():
+        if filename.endswith(extension):
+            return open_compressed(filename, "wb")
+    return open(filename, "wb")
+
+
+def load_visitor(name):
+    """
+    :param name: module.Class of a game.Visitor
+    :return: an instance of the class
+    """
+    module_name, _, class_name = name.rpartition(".")
+    if module_name == "":
+        raise ValueError("visitor must be given as module.Class: " + name)
+    cls = getattr(importlib.import_module(module_name), class_name)
+    return cls()
+
+
+class Sink:
+    """
+    output that consumes the converted games in its own thread, see put
+    """
+
+    needs_tags = False
+    needs_moves = False
+
+    def __init__(self, description, queue_size=DEFAULT_QUEUE_SIZE):
+        self.description = description
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.games = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.consume(*item)
+                    self.games += 1
+                except Exception as e:
+                    # reported by put or close. the queue is still drained, so that put never blocks
+                    self.error = e
+
+    def consume(self, i, pgn, tags, calls):
+        """
+        called in the thread of the sink for each game
+        :param i: record number
+        :param pgn: PGN of the game
+        :param tags: (tag name, value) pairs of the game, if needs_tags
+        :param calls: recorded visitor calls of the game (see game.Recorder), if needs_moves
+        """
+        pass
+
+    def finish(self):
+        """
+        called in the thread of the sink after the last game
+        """
+        pass
+
+    def put(self, i, pgn, tags, calls):
+        """
+        hand a game over to the sink. blocks while its queue is full
+        """
+        if self.error is not None:
+            raise RuntimeError(self.description + ": " + str(self.error)) from self.error
+        self.queue.put((i, pgn, tags, calls))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None:
+            try:
+                self.finish()
+            except Exception as e:
+                self.error = e
+        if self.error is not None:
+            raise RuntimeError(self.description + ": " + str(self.error)) from self.error
+
+
+class PgnSink(Sink):
+
+    def __init__(self, filename, queue_size=DEFAULT_QUEUE_SIZE):
+        self.out = open_output(filename)
+        super().__init__("pgn:" + filename, queue_size)
+
+    def consume(self, i, pgn, tags, calls):
+        self.out.write(pgn.encode("utf-8"))
+
+    def finish(self):
+        self.out.close()
+
+
+class HeaderSink(Sink):
+
+    needs_tags = True
+
+    def __init__(self, filename, queue_size=DEFAULT_QUEUE_SIZE):
+        self.out = open_output(filename)
+        super().__init__("headers:" + filename, queue_size)
+
+    def consume(self, i, pgn, tags, calls):
+        record = {"record": i}
+        record.update(tags)
+        self.out.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    def finish(self):
+        self.out.close()
+
+
+class VisitorSink(Sink):
+
+    needs_tags = True
+    needs_moves = True
+
+    def __init__(self, name, queue_size=DEFAULT_QUEUE_SIZE):
+        self.visitor = load_visitor(name)
+        super().__init__("visitor:" + name, queue_size)
+
+    def consume(self, i, pgn, tags, calls):
+        game.replay(calls, self.visitor, tags)
+
+    def finish(self):
+        close = getattr(self.visitor, "close", None)
+        if close is not None:
+            close()
+
+
+SINKS = {
+    "pgn": PgnSink,
+    "headers": HeaderSink,
+    "visitor": VisitorSink,
+}
+
+
+def parse_sink(spec):
+    """
+    :param spec: KIND:TARGET, e.g. pgn:games.pgn.gz
+    :return: pair of (kind, target)
+    """
+    kind, _, target = spec.partition(":")
+    if kind not in SINKS or target == "":
+        raise ValueError("invalid output " + spec + ", expected one of " +
+                         ", ".join(kind + ":..." for kind in SINK_KINDS))
+    return kind, target
+
+
+class Tee:
+    """
+    all additional outputs of a conversion, see write_game
+    """
+
+    def __init__(self, specs, db, queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        :param specs: list of KIND:TARGET, see parse_sink
+        :param db: database.Database the games are from
+        :param queue_size: number of games that can wait for each sink
+        """
+        self.db = db
+        self.sinks = []
+        try:
+            for spec in specs:
+                kind, target = parse_sink(spec)
+                self.sinks.append(SINKS[kind](target, queue_size))
+        except BaseException:
+            self.close(raise_errors=False)
+            raise
+        self.needs_tags = any(sink.needs_tags for sink in self.sinks)
+        # records the moves while the game is decoded for the main output
+        self.recorder = game.Recorder() if any(sink.needs_moves for sink in self.sinks) else None
+
+    def write_game(self, i, pgn):
+        """
+        hand a converted game over to all sinks. the moves are taken from recorder, which must have
+        been passed the game (see Database.render_game)
+        :param i: record number
+        :param pgn: PGN of the game
+        """
+        tags = self.db.get_tags(self.db.record_offset(i)) if self.needs_tags else None
+        calls = None
+        if self.recorder is not None:
+            calls = self.recorder.calls
+            self.recorder.calls = []
+        for sink in self.sinks:
+            sink.put(i, pgn, tags, calls)
+
+    def close(self, raise_errors=True):
+        """
+        wait until all sinks have consumed all games, and close them
+        """
+        first_error = None
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                if first_error is None:
+                    first_error = e
+        if first_error is not None and raise_errors:
+            raise first_error
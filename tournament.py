@@ -23,3 +23,13 @@ def get_event_site_totalrounds(cbt_file, tournament_no):
         place = tmp[0]
 
     return title, place
+
+
+def get_nr_tournaments(cbt_file):
+    if cbt_file[0x18] == 4:
+        header_size = 32
+    elif cbt_file[0x18] == 0:
+        header_size = 28
+    else:
+        raise ValueError("unknown CBT file version")
+    return max(len(cbt_file) - header_size, 0) // 99
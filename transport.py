@@ -0,0 +1,188 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# how worker processes hand the PGN of a chunk (utf-8 encoded bytes) back to the
+# parent process, which writes it to the output:
+#   pipe  the bytes are returned as the result of the task, i.e. pickled and sent
+#         through the pipe of the process pool
+#   shm   the bytes are copied into a slot of a ring buffer in shared memory, and only
+#         (offset, length) is returned. the parent assigns the slots in the order in
+#         which it submits the tasks, and consumes the results in the same order; as
+#         there are never more tasks in flight than slots, a slot is always free when
+#         it is assigned again. output larger than a slot is returned through the pipe
+#   file  the bytes are written to a temporary file next to the output, and only its
+#         name is returned. the parent appends it to the output with copy_file_range
+#         (or sendfile), without the data passing through the parent at all
+# the transport object lives in the parent (see task and write), the workers call send.
+# multiprocessing.shared_memory, tempfile and shutil are only imported when needed
+
+import os
+import writer
+
+TRANSPORTS = ["pipe", "shm", "file"]
+DEFAULT_SLOT_SIZE = 4 * 1024 * 1024
+
+# shared memory segments attached by a worker process, keyed by name
+attached = {}
+
+
+def send(data, descriptor):
+    """
+    called in the worker process
+    :param data: output of a task as bytes
+    :param descriptor: how to send it, see task of the transports
+    :return: what the task returns to the parent, see write of the transports
+    """
+    if descriptor is None:
+        return data
+    if descriptor[0] == "shm":
+        _, name, offset, slot_size = descriptor
+        if len(data) > slot_size:
+            return data
+        shm = attached.get(name)
+        if shm is None:
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(name=name)
+            attached[name] = shm
+        shm.buf[offset:offset + len(data)] = data
+        return "shm", offset, len(data)
+    _, directory = descriptor
+    import tempfile
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".pgn")
+    try:
+        writer.write_all(fd, data)
+    finally:
+        os.close(fd)
+    return "file", path, len(data)
+
+
+def copy_file(src_fd, dst_fd, length):
+    """
+    append length bytes from the current position of src_fd to dst_fd, in the kernel if possible
+    """
+    copy = getattr(os, "copy_file_range", None)
+    while length > 0:
+        try:
+            if copy is not None:
+                copied = copy(src_fd, dst_fd, length)
+            else:
+                copied = os.sendfile(dst_fd, src_fd, None, length)
+        except OSError:
+            if copy is not None:
+                # e.g. not supported between these file systems
+                copy = None
+                continue
+            break
+        if copied == 0:
+            break
+        length -= copied
+    while length > 0:
+        data = os.read(src_fd, min(length, writer.DEFAULT_BUFFER_SIZE))
+        if len(data) == 0:
+            raise OSError("temporary file is shorter than expected")
+        writer.write_all(dst_fd, data)
+        length -= len(data)
+
+
+class PipeTransport:
+
+    def task(self):
+        """
+        :return: descriptor for the next task that is submitted, passed to send in the worker
+        """
+        return None
+
+    def write(self, result, out_fd):
+        """
+        write the output of a task
+        :param result: what send returned in the worker
+        :param out_fd: file descriptor of the output
+        :return: number of bytes written
+        """
+        writer.write_all(out_fd, result)
+        return len(result)
+
+    def close(self):
+        pass
+
+
+class SharedMemoryTransport(PipeTransport):
+
+    def __init__(self, slots, slot_size=DEFAULT_SLOT_SIZE):
+        """
+        :param slots: number of slots, at least the number of tasks that are in flight at the same time
+        :param slot_size: size of a slot in bytes. pages of the shared memory are only allocated when
+                          they are written, so mostly empty slots are cheap
+        """
+        from multiprocessing import shared_memory
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self.next_slot = 0
+
+    def task(self):
+        offset = self.next_slot * self.slot_size
+        self.next_slot = (self.next_slot + 1) % self.slots
+        return "shm", self.shm.name, offset, self.slot_size
+
+    def write(self, result, out_fd):
+        if isinstance(result, bytes):
+            return super().write(result, out_fd)
+        _, offset, length = result
+        view = self.shm.buf[offset:offset + length]
+        try:
+            writer.write_all(out_fd, view)
+        finally:
+            view.release()
+        return length
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class FileTransport(PipeTransport):
+
+    def __init__(self, directory):
+        """
+        :param directory: the temporary files are created in a new directory in this one. it should be
+                          on the same file system as the output, so that copying can share the blocks
+        """
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix=".cbh2pgn-", dir=directory)
+
+    def task(self):
+        return "file", self.directory
+
+    def write(self, result, out_fd):
+        if isinstance(result, bytes):
+            return super().write(result, out_fd)
+        _, path, length = result
+        src_fd = os.open(path, os.O_RDONLY)
+        try:
+            copy_file(src_fd, out_fd, length)
+        finally:
+            os.close(src_fd)
+            os.unlink(path)
+        return length
+
+    def close(self):
+        import shutil
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def create(name, slots, directory):
+    """
+    :param name: one of TRANSPORTS
+    :param slots: maximum number of tasks in flight
+    :param directory: directory of the output (for the temporary files)
+    :return: the transport
+    """
+    if name == "pipe":
+        return PipeTransport()
+    if name == "shm":
+        return SharedMemoryTransport(slots)
+    if name == "file":
+        return FileTransport(directory)
+    raise ValueError("unknown transport: " + str(name))
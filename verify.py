@@ -0,0 +1,145 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# consistency check of a database without decoding any moves. for every game it checks
+# - that its offset and length (from the .cbg game header) lie within the .cbg file
+# - that it doesn't overlap with any other game
+# - that its token stream ends with 0x0C after de-obfuscation, and not earlier.
+#   only the tokens are walked (like when skipping a variation), no moves are made
+# - that its players and tournament exist in the .cbp and .cbt files
+
+import collections
+import game
+import header
+import player
+import tournament
+
+
+def check_termination(game_bytes):
+    """
+    :param game_bytes: the cb encoded moves of a game
+    :return: None if the token stream ends with its terminating 0x0C, otherwise an error message
+    """
+    if len(game_bytes) == 0:
+        return "no moves and no terminating 0x0C"
+    idx, _, _ = game.skip_variation(game_bytes, 0, 0)
+    if idx >= len(game_bytes):
+        return "not terminated by 0x0C"
+    if idx < len(game_bytes) - 1:
+        return "terminating 0x0C at byte " + str(idx) + ", followed by " + str(len(game_bytes) - 1 - idx) + \
+               " more bytes"
+    return None
+
+
+def verify(db, progress=True):
+    """
+    check the consistency of a database
+    :param db: database.Database
+    :param progress: show a progress bar
+    :return: dict with counts of all kinds of records and errors, and the list of errors
+             as (record number, first game byte or None, message)
+    """
+    cbh_file = db.cbh_file
+    cbg_file = db.cbg_file
+    cbg_view = db.cbg_view
+    cbg_size = len(cbg_file)
+    counts = collections.Counter()
+    errors = []
+
+    nr_players = None
+    nr_tournaments = None
+    try:
+        nr_players = player.get_nr_players(db.cbp_file)
+    except (ValueError, IndexError) as e:
+        errors.append((None, None, ".cbp: " + str(e)))
+    try:
+        nr_tournaments = tournament.get_nr_tournaments(db.cbt_file)
+    except (ValueError, IndexError) as e:
+        errors.append((None, None, ".cbt: " + str(e)))
+
+    # (start, end, record number) of all games
+    extents = []
+    records = range(1, db.nr_records)
+    if progress:
+        from tqdm import tqdm
+        records = tqdm(records)
+    for i in records:
+        record_offset = db.record_offset(i)
+        if not header.is_game(cbh_file, record_offset):
+            counts["not_games"] += 1
+            continue
+        if header.is_marked_as_deleted(cbh_file, record_offset):
+            counts["deleted"] += 1
+            continue
+        counts["games"] += 1
+
+        for role, player_no in [("white", header.get_whiteplayer_offset(cbh_file, record_offset)),
+                                ("black", header.get_blackplayer_offset(cbh_file, record_offset))]:
+            if nr_players is not None and player_no >= nr_players:
+                errors.append((i, None, role + " player " + str(player_no) + " not in .cbp (" +
+                               str(nr_players) + " players)"))
+        tournament_no = header.get_tournament_offset(cbh_file, record_offset)
+        if nr_tournaments is not None and tournament_no >= nr_tournaments:
+            errors.append((i, None, "tournament " + str(tournament_no) + " not in .cbt (" +
+                           str(nr_tournaments) + " tournaments)"))
+
+        game_offset = header.get_game_offset(cbh_file, record_offset)
+        if game_offset + 4 > cbg_size:
+            errors.append((i, None, "game offset " + str(game_offset) + " beyond end of .cbg (" +
+                           str(cbg_size) + " bytes)"))
+            continue
+        first_byte = hex(cbg_file[game_offset])
+        not_initial, not_encoded, is_960, special_encoding, game_len = game.get_info_gamelen(cbg_file, game_offset)
+        moves_start = game_offset + 4 + (28 if not_initial else 0)
+        if game_len < moves_start - game_offset:
+            errors.append((i, first_byte, "game length " + str(game_len) + " too short"))
+            continue
+        if game_offset + game_len > cbg_size:
+            errors.append((i, first_byte, "game (offset " + str(game_offset) + ", length " + str(game_len) +
+                           ") extends beyond end of .cbg (" + str(cbg_size) + " bytes)"))
+            continue
+        extents.append((game_offset, game_offset + game_len, i))
+
+        if not_encoded:
+            counts["not_encoded"] += 1
+        elif is_960:
+            counts["chess960"] += 1
+        elif special_encoding:
+            counts["special_encoding"] += 1
+        else:
+            if not_initial:
+                counts["setup_position"] += 1
+            message = check_termination(cbg_view[moves_start:game_offset + game_len])
+            if message is not None:
+                errors.append((i, first_byte, message))
+
+    extents.sort()
+    # each game is compared with the game that extends furthest of all games before it, so
+    # a long game is checked against every later game it covers, not only against the next one
+    furthest = None
+    for start, end, i in extents:
+        if furthest is not None and start < furthest[1]:
+            errors.append((i, hex(cbg_file[start]), "game at offset " + str(start) +
+                           " overlaps with game of record " + str(furthest[2]) + " (offset " +
+                           str(furthest[0]) + ", length " + str(furthest[1] - furthest[0]) + ")"))
+        if furthest is None or end > furthest[1]:
+            furthest = (start, end, i)
+
+    errors.sort(key=lambda err: -1 if err[0] is None else err[0])
+    return {
+        "records": db.nr_records - 1,
+        "games": counts["games"],
+        "deleted": counts["deleted"],
+        "not_games": counts["not_games"],
+        "setup_position": counts["setup_position"],
+        "not_encoded": counts["not_encoded"],
+        "chess960": counts["chess960"],
+        "special_encoding": counts["special_encoding"],
+        "players": nr_players,
+        "tournaments": nr_tournaments,
+        "cbg_bytes": cbg_size,
+        "cbg_bytes_used": sum(end - start for start, end, _ in extents),
+        "errors": len(errors),
+        "error_list": [list(err) for err in errors]
+    }
@@ -0,0 +1,125 @@
+# cbh2pgn converter
+# Copyright (c) 2022 Dominik Klein.
+# Licensed under MIT (see file LICENSE)
+
+# output of the converted games. the PGN of many games is collected as utf-8
+# bytes in one large buffer that is allocated once, and written with a single
+# large write when it is full. optionally, full buffers are written by a
+# background thread while the next buffer is filled (the GIL is released while
+# writing, so writing overlaps with decoding).
+
+import os
+import queue
+import threading
+
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def write_all(fd, data):
+    while len(data) > 0:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class BufferedWriter:
+    """
+    file opened for writing PGN, see write
+    """
+
+    def __init__(self, filename, buffer_size=DEFAULT_BUFFER_SIZE, background=False):
+        """
+        :param filename: filename of the output file, which is created or truncated
+        :param buffer_size: size of the buffer in bytes
+        :param background: write full buffers in a background thread (two buffers are used)
+        """
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.buffer_size = buffer_size
+        self.buffer = memoryview(bytearray(buffer_size))
+        self.pos = 0
+        self.bytes_written = 0
+        self.flusher = None
+        if background:
+            # the second buffer circulates between this thread and the flusher
+            self.full = queue.Queue(maxsize=1)
+            self.free = queue.Queue(maxsize=1)
+            self.free.put(memoryview(bytearray(buffer_size)))
+            self.error = None
+            self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flusher.start()
+
+    def flush_loop(self):
+        while True:
+            buffer, length = self.full.get()
+            if buffer is None:
+                return
+            try:
+                if self.error is None:
+                    write_all(self.fd, buffer[:length])
+            except OSError as e:
+                self.error = e
+            self.free.put(buffer)
+
+    def write(self, text):
+        """
+        :param text: PGN string
+        """
+        self.write_bytes(text.encode("utf-8"))
+
+    def write_bytes(self, data):
+        """
+        :param data: utf-8 encoded PGN
+        """
+        length = len(data)
+        if self.pos + length > self.buffer_size:
+            self.flush()
+            if length > self.buffer_size:
+                self.wait()
+                write_all(self.fd, data)
+                self.bytes_written += length
+                return
+        self.buffer[self.pos:self.pos + length] = data
+        self.pos += length
+        self.bytes_written += length
+
+    def flush(self):
+        """
+        write the buffer. with a background thread, this only hands the buffer over to it
+        """
+        if self.pos == 0:
+            return
+        if self.flusher is None:
+            write_all(self.fd, self.buffer[:self.pos])
+        else:
+            if self.error is not None:
+                raise self.error
+            buffer = self.free.get()
+            self.full.put((self.buffer, self.pos))
+            self.buffer = buffer
+        self.pos = 0
+
+    def wait(self):
+        """
+        wait until the background thread has written all buffers handed over to it
+        """
+        if self.flusher is not None:
+            buffer = self.free.get()
+            self.free.put(buffer)
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        try:
+            self.flush()
+            if self.flusher is not None:
+                self.wait()
+                self.full.put((None, 0))
+                self.flusher.join()
+                self.flusher = None
+        finally:
+            os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()